@@ -0,0 +1,6 @@
+#!/bin/bash
+# fails if the hot paths have become slower than the committed baseline, checking a cheap
+# subset of the cases. re-record the baseline after a change that's meant to alter them with:
+#   python -m elife_ga_metrics.benchmark --save
+set -e
+python -m elife_ga_metrics.benchmark --check --quick
@@ -0,0 +1,464 @@
+__description__ = """Benchmarks against the results cached in the output directory."""
+
+# ll: python -m elife_ga_metrics.benchmark
+# ll: python -m elife_ga_metrics.benchmark --suite
+# ll: python -m elife_ga_metrics.benchmark --save
+# ll: python -m elife_ga_metrics.benchmark --check
+
+import os, re, sys, json, time, shutil, argparse, platform, tempfile, resource, subprocess
+from os.path import join
+from collections import Counter, OrderedDict
+from functools import partial
+from datetime import datetime
+from elife_ga_metrics import core, bulk, utils, elife_v1
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+def largest(results_type, n=5):
+    "returns the paths of the `n` largest complete results of the given type"
+    manifest = core.cache_manifest(sync=True)
+    path_list = [path for path, _, _ in manifest.periods(results_type)]
+    return sorted(path_list, key=lambda path: manifest.get(path)['size'], reverse=True)[:n]
+
+def measure(fn, *args):
+    """calls `fn` in a child process so each call starts from the same place.
+    returns a pair of (seconds taken, increase in peak memory in KB)"""
+    return run_case(lambda: args, lambda args: fn(*args))[:2]
+
+#
+# reading rows
+#
+
+def load_rows(path, results_type):
+    "parses the results at the given path after reading the whole response into memory"
+    _, from_date, to_date = core.parse_output_path(path)
+    module = core.module_picker(from_date, to_date)
+    rows = core.read_results(path).get('rows', [])
+    return getattr(module, core.PARSERS[results_type])(rows)
+
+def stream_rows(path, results_type):
+    "parses the results at the given path one row at a time"
+    _, from_date, to_date = core.parse_output_path(path)
+    module = core.module_picker(from_date, to_date)
+    return getattr(module, core.PARSERS[results_type])(utils.iter_rows(path))
+
+def bench_rows(n=5):
+    "compares the time and memory taken to parse the largest cached results whole and streamed"
+    print "%-45s %8s %18s %18s" % ('results', 'size KB', 'json.load s/KB', 'iter_rows s/KB')
+    for results_type in ['views', 'downloads']:
+        for path in largest(results_type, n):
+            loaded = measure(load_rows, path, results_type)
+            streamed = measure(stream_rows, path, results_type)
+            print "%-45s %8d %8.3f %9d %8.3f %9d" % ((os.path.relpath(path, core.output_dir()),
+                os.path.getsize(path) / 1024) + loaded + streamed)
+
+#
+# storage formats
+#
+
+def best_of(fn, repeat=3):
+    "returns the fewest seconds calling `fn` took"
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+def bench_formats(n=5):
+    """compares the size of the largest cached results written pretty-printed and compressed
+    and how quickly each is decoded, whole and streamed. throughput is in MB of the
+    pretty-printed json per second, so the two formats are compared doing the same work"""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print "%-45s %8s %8s %10s %10s %10s %10s" % ('results', 'json KB', 'gz KB', 'load MB/s', 'gz load', 'rows MB/s', 'gz rows')
+        totals = Counter()
+        for results_type in ['views', 'downloads']:
+            for path in largest(results_type, n):
+                results = core.read_results(path)
+                row = [os.path.relpath(path, core.output_dir())]
+                timings = []
+                for compress in [False, True]:
+                    tmp_path = os.path.join(tmp_dir, 'compressed' if compress else 'plain')
+                    with open(tmp_path, 'wb') as fh:
+                        fh.write(core.encode_results(results, compress))
+                    row.append(os.path.getsize(tmp_path) / 1024)
+                    timings.append((best_of(lambda: core.read_results(tmp_path)),
+                                    best_of(lambda: sum(1 for _ in utils.iter_rows(tmp_path)))))
+                megabytes = row[1] / 1024.0
+                row.extend(megabytes / seconds for seconds in [timings[0][0], timings[1][0], timings[0][1], timings[1][1]])
+                totals.update({'json': row[1], 'gz': row[2]})
+                print "%-45s %8d %8d %10.1f %10.1f %10.1f %10.1f" % tuple(row)
+        print "total: %d KB pretty-printed, %d KB compressed" % (totals['json'], totals['gz'])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+#
+# parsing
+#
+
+def v1_rows():
+    "returns the rows of every monthly views result parsed by elife_v1"
+    rows = []
+    for path, from_date, to_date in core.cached_periods('views'):
+        if from_date != to_date and core.module_picker(from_date, to_date) == elife_v1:
+            rows.extend(utils.iter_rows(path))
+    return rows
+
+def bench_path_count():
+    "times the classification of every path in the monthly elife_v1 results"
+    rows = v1_rows()
+    start = time.time()
+    for row in rows:
+        elife_v1.path_count(row)
+    elapsed = time.time() - start
+    print "path_count: %d rows in %.3fs (%.1f us/row)" % (len(rows), elapsed, elapsed / max(len(rows), 1) * 1e6)
+
+def counter_group_results(triplet_list):
+    "`elife_v1.group_results` as it was, reducing a list of Counters per article. kept for comparison"
+    article_groups = {}
+    for art, art_type, count in triplet_list:
+        zeroed_row = Counter({'full': 0, 'abstract': 0, 'digest': 0})
+        group = article_groups.get(art, [zeroed_row])
+        group.append(Counter({art_type: count}))
+        article_groups[art] = group
+    def update(a, b):
+        a.update(b)
+        return a
+    return {utils.enplumpen(art): reduce(update, group) for art, group in article_groups.items()}
+
+def bench_group_results(repeat=5):
+    "times grouping the classified paths of the largest monthly views results"
+    path = largest('views', 1)[0]
+    _, from_date, to_date = core.parse_output_path(path)
+    module = core.module_picker(from_date, to_date)
+    triplet_list = filter(None, map(module.path_count, utils.iter_rows(path)))
+    for fn in [counter_group_results, elife_v1.group_results]:
+        start = time.time()
+        for _ in range(repeat):
+            fn(triplet_list)
+        elapsed = (time.time() - start) / repeat
+        print "%s: %d rows of %s in %.4fs" % (fn.__name__, len(triplet_list), os.path.basename(path), elapsed)
+
+#
+# importing
+#
+
+IMPORTS = [
+    ('elife_ga_metrics.core', 'import elife_ga_metrics.core'),
+    ('elife_ga_metrics.bulk', 'import elife_ga_metrics.bulk'),
+    ('google client libraries', 'import googleapiclient.discovery, googleapiclient.http, oauth2client.service_account'),
+]
+
+def import_time(statement, repeat=5):
+    "returns the fewest seconds the given import statement took in a new interpreter"
+    script = "import time; start = time.time(); %s; print time.time() - start" % statement
+    return min(float(subprocess.check_output([sys.executable, '-c', script])) for _ in range(repeat))
+
+def bench_imports():
+    "times importing our entry points from cold, the google client libraries are only imported to query GA"
+    for label, statement in IMPORTS:
+        print "import %s: %.1fms" % (label, import_time(statement) * 1000)
+
+#
+# regression suite
+#
+
+# representative daily and monthly results, parsed by each of the elife_v* modules
+# ll: (results type, from date, to date)
+FIXTURES = [
+    ('views', '2015-06-01', '2015-06-01'), # elife_v1
+    ('views', '2016-03-01', '2016-03-01'), # elife_v2
+    ('views', '2016-06-01', '2016-06-01'), # elife_v3
+    ('views', '2015-10-01', '2015-10-31'),
+    ('views', '2016-03-01', '2016-03-31'),
+    ('views', '2016-06-01', '2016-06-30'),
+    ('downloads', '2016-06-01', '2016-06-01'),
+    ('downloads', '2016-06-01', '2016-06-30'),
+]
+
+# a fortnight of daily results for `bulk.daily_metrics_between`
+DAILY_RANGE = ('2016-06-01', '2016-06-14')
+
+# nothing is queried, results are only read from the cache
+TABLE_ID = 'ga:0'
+
+# each case is run this many times, each in a new process, and the best run kept
+REPEAT = 3
+
+# seconds. cases that can be are called again and again for at least this long in each run,
+# a single call of most of them is over too quickly to time reliably
+MIN_TIME = 0.2
+
+# times the reference work is done either side of each case
+REFERENCE_CALLS = 5
+
+# bumped whenever what is measured changes, older baselines can't be compared with
+SUITE_VERSION = 1
+
+BASELINE_PATH = join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark-baseline.json')
+
+# a case has regressed if the time it takes, relative to the reference work, or it's peak memory grows by more than this
+TOLERANCE = 0.25
+# KB. small allocations vary from run to run
+MEMORY_SLACK = 1024
+
+# cases that look to have regressed are run again this many times before we believe it
+CONFIRM = 2
+
+# on a machine other than the one the baseline was recorded on only the cost of each case is
+# compared, relative to the reference work, and allowed to vary by this much more
+PORTABLE_TOLERANCE = 0.5
+
+# the cheap subset of cases `test.sh` checks, a daily result of each parser
+QUICK_CASES = [
+    'iter_rows/views/2016-06-01.json',
+    'elife_v1.path_counts/views/2015-06-01.json',
+    'elife_v2.path_counts/views/2016-03-01.json',
+    'elife_v3.path_counts/views/2016-06-01.json',
+    'group_results/views/2016-06-01.json',
+    'elife_v3.event_counts/downloads/2016-06-01.json',
+]
+
+# a fixed amount of the kind of work the cases do, decoding json and matching paths
+REFERENCE_ROWS = json.dumps([['/content/5/e%05dv1/abstract' % i, str(i)] for i in range(2000)])
+REFERENCE_RE = re.compile(r"/content/(?P<volume>\d{1})/(?P<artid>e\d+)")
+
+def reference(_=None):
+    for path, count in json.loads(REFERENCE_ROWS):
+        REFERENCE_RE.match(path)
+
+def timed(fn, data):
+    start = time.time()
+    fn(data)
+    return time.time() - start
+
+def run_case(setup, fn, min_time=0):
+    """calls `setup` and then `fn` with what it returns, in a child process. only `fn` is
+    measured. if given a `min_time`, `fn` is called again and again for at least that many
+    seconds and the fastest call kept. returns a triple of (seconds taken, increase in peak
+    memory in KB, seconds the reference work took in the same process)
+
+    how quickly the same code runs on the same machine varies by as much as half from one
+    minute to the next. the reference work is timed alternately with `fn`, so the speed of
+    the machine at the time can be allowed for"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            data = setup()
+            ref = min(timed(reference, None) for _ in range(REFERENCE_CALLS))
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            elapsed, total = None, 0
+            while elapsed is None or total < min_time:
+                took = timed(fn, data)
+                elapsed, total = min(took, elapsed or took), total + took
+                ref = min(ref, timed(reference, None))
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            ref = min([ref] + [timed(reference, None) for _ in range(REFERENCE_CALLS)])
+            os.write(write_fd, json.dumps([elapsed, after - before, ref]))
+        finally:
+            # the temporary output directories `setup` made. nothing else runs after us
+            for tmp_dir in TMP_DIRS:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'r') as fh:
+        output = fh.read()
+    os.waitpid(pid, 0)
+    assert output, "benchmark failed in child process"
+    return tuple(json.loads(output))
+
+def fixture(results_type, from_str, to_str):
+    "returns the path, parsing module and number of rows of a fixture"
+    from_date, to_date = datetime.strptime(from_str, "%Y-%m-%d"), datetime.strptime(to_str, "%Y-%m-%d")
+    path = core.output_path(results_type, from_date, to_date)
+    entry = core.cache_manifest().get(path)
+    assert entry, "fixture %r is missing from the output directory" % path
+    return path, core.module_picker(from_date, to_date), entry['rows']
+
+# temporary output directories made within a child process, removed by `run_case` as it exits
+TMP_DIRS = []
+
+def copy_output(path_list):
+    """copies the given results to a new output directory and switches to it. called within the
+    child process, so results are read from the copies without the parsed results of earlier runs"""
+    test_output_dir = tempfile.mkdtemp()
+    TMP_DIRS.append(test_output_dir)
+    for path in path_list:
+        dest = join(test_output_dir, core.OUTPUT_SUBDIR, os.path.basename(os.path.dirname(path)))
+        if not os.path.exists(dest):
+            os.makedirs(dest)
+        shutil.copy(path, dest)
+    os.environ['TESTING'] = '1'
+    os.environ['TEST_OUTPUT_DIR'] = test_output_dir
+    core.cache_manifest(sync=True)
+
+def given(value):
+    return value
+
+def read_rows(path):
+    return list(utils.iter_rows(path))
+
+def count_rows(path):
+    return sum(1 for _ in utils.iter_rows(path))
+
+def path_triplets(module, path):
+    "the (article, type, count) triplets the given module's `path_count` makes of the rows at the given path"
+    return filter(None, map(module.path_count, read_rows(path)))
+
+def cases():
+    """yields a tuple of (name, setup, fn, rows, files, repeatable) for each case in the suite.
+    `rows` and `files` are the raw rows and files each call of `fn` works through. cases
+    reading results for the first time aren't repeatable, the second time they're cached"""
+    for results_type, from_str, to_str in FIXTURES:
+        path, module, rows = fixture(results_type, from_str, to_str)
+        label = "%s/%s" % (results_type, os.path.basename(path))
+        yield 'iter_rows/' + label, partial(given, path), count_rows, rows, 1, True
+        parser = getattr(module, core.PARSERS[results_type])
+        yield '%s.%s/%s' % (module.__name__.split('.')[-1], parser.__name__, label), partial(read_rows, path), parser, rows, 1, True
+        if results_type == 'views':
+            yield 'group_results/' + label, partial(path_triplets, module, path), module.group_results, rows, 1, True
+
+    from_date, to_date = [datetime.strptime(dt_str, "%Y-%m-%d") for dt_str in DAILY_RANGE]
+    day_list = utils.dt_range(from_date, to_date)
+    path_list = [core.output_path(results_type, dt, dt) for dt, _ in day_list for results_type in ['views', 'downloads']]
+    rows = sum(core.cache_manifest().get(path)['rows'] for path in path_list)
+    day_paths = path_list[:2]
+    day_rows = sum(core.cache_manifest().get(path)['rows'] for path in day_paths)
+    article_metrics = lambda _: core.article_metrics(TABLE_ID, from_date, from_date, cached=True, only_cached=True)
+    def warmed():
+        copy_output(day_paths)
+        article_metrics(None)
+    yield 'article_metrics/cold', lambda: copy_output(day_paths), article_metrics, day_rows, 2, False
+    yield 'article_metrics/cached', warmed, article_metrics, day_rows, 2, True
+    yield 'daily_metrics_between/cold', lambda: copy_output(path_list), \
+      lambda _: bulk.daily_metrics_between(TABLE_ID, from_date, to_date, use_cached=True, use_only_cached=True), \
+      rows, len(path_list), False
+
+def run_suite(repeat=REPEAT, only=None):
+    "runs every case, or `only` those named, returning a map of case name to it's measurements"
+    results = OrderedDict()
+    for name, setup, fn, rows, files, repeatable in cases():
+        if only is not None and name not in only:
+            continue
+        # cases that can't be repeated within a run are given more runs instead
+        runs = [run_case(setup, fn, MIN_TIME if repeatable else 0) for _ in range(repeat if repeatable else repeat * 3)]
+        seconds, peak_kb = min(seconds for seconds, _, _ in runs), min(kb for _, kb, _ in runs)
+        results[name] = {
+            'seconds': round(seconds, 5),
+            # the time taken in multiples of the reference work, comparable from run to run
+            'cost': round(seconds / min(ref for _, _, ref in runs), 3),
+            'rows': rows,
+            'rows_per_sec': round(rows / max(seconds, 1e-6)),
+            'ms_per_file': round(seconds * 1000 / files, 3),
+            'peak_kb': peak_kb,
+        }
+    return results
+
+def print_suite(results, baseline=None):
+    baseline = baseline or {}
+    print "%-60s %8s %12s %10s %9s %8s %10s" % ('case', 'rows', 'rows/s', 'ms/file', 'peak KB', 'cost', 'vs base')
+    for name, result in results.items():
+        base = baseline.get(name)
+        # relative to the reference work
+        change = "%+.0f%%" % (100.0 * result['cost'] / base['cost'] - 100) if base else ''
+        print "%-60s %8d %12d %10.2f %9d %8.2f %10s" % (name, result['rows'], result['rows_per_sec'],
+                                                       result['ms_per_file'], result['peak_kb'], result['cost'], change)
+
+def compare(results, baseline, tolerance=TOLERANCE, memory=True):
+    """returns a list of (case, reason) for every case slower or bigger than it's baseline.
+    new cases are ignored, as is peak memory if not `memory`"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['cost'] > base['cost'] * (1 + tolerance):
+            regressions.append((name, "%d rows/s, was %d. %.2fx the reference work, up from %.2fx" % (
+                result['rows_per_sec'], base['rows_per_sec'], result['cost'], base['cost'])))
+        if memory and result['peak_kb'] > base['peak_kb'] * (1 + tolerance) + MEMORY_SLACK:
+            regressions.append((name, "peak of %d KB, up from %d KB" % (result['peak_kb'], base['peak_kb'])))
+    return regressions
+
+def read_baseline(path=BASELINE_PATH):
+    """returns the baseline at the given path or None if there is none we can compare with
+    ll: {'version': 1, 'machine': 'ci-1', 'python': '2.7.18', 'recorded': '2016-06-01T12:00:00', 'cases': {...}}"""
+    if os.path.exists(path):
+        with open(path, 'r') as fh:
+            baseline = json.load(fh)
+        if baseline.get('version') == SUITE_VERSION:
+            return baseline
+        LOG.warn("ignoring baseline recorded by a different version of the benchmark suite")
+
+def save_baseline(results, path=BASELINE_PATH):
+    baseline = {
+        'version': SUITE_VERSION,
+        'machine': platform.node(),
+        'python': platform.python_version(),
+        'recorded': datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        'cases': results,
+    }
+    with open(path, 'w') as fh:
+        json.dump(baseline, fh, indent=4, sort_keys=True)
+    return path
+
+def check(tolerance=TOLERANCE, path=BASELINE_PATH, only=None):
+    """runs the suite, or `only` the cases named, and compares it with the baseline.
+    returns True if nothing has regressed"""
+    baseline = read_baseline(path)
+    if not baseline:
+        print "no usable baseline at %r, record one with: python -m elife_ga_metrics.benchmark --save" % path
+        return True
+    memory = baseline['machine'] == platform.node()
+    if not memory:
+        # how long a case takes relative to the reference work carries over to another machine, roughly
+        tolerance = tolerance + PORTABLE_TOLERANCE
+        print "the baseline was recorded on %r, comparing costs only with a tolerance of %d%%" % (
+            baseline['machine'], tolerance * 100)
+    results = run_suite(only=only)
+    regressions = compare(results, baseline['cases'], tolerance, memory)
+    for _ in range(CONFIRM):
+        if not regressions:
+            break
+        # keeping the best of each case, a regression that's really a blip goes away
+        for name, result in run_suite(only=set(name for name, _ in regressions)).items():
+            if result['cost'] < results[name]['cost']:
+                results[name] = result
+        regressions = compare(results, baseline['cases'], tolerance, memory)
+    print_suite(results, baseline['cases'])
+    for name, reason in regressions:
+        print "REGRESSION %s: %s" % (name, reason)
+    return not regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__description__)
+    parser.add_argument('--suite', action='store_true', help="run the regression suite")
+    parser.add_argument('--save', action='store_true', help="run the regression suite and record it as the baseline")
+    parser.add_argument('--check', action='store_true', help="run the regression suite, failing if it's slower than the baseline")
+    parser.add_argument('--quick', action='store_true', help="check only the cheap subset of cases `test.sh` checks")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    # the parsers are noisy about the unhandled paths in older results
+    logging.disable(logging.ERROR)
+    if args.check:
+        sys.exit(0 if check(args.tolerance, only=set(QUICK_CASES) if args.quick else None) else 1)
+    if args.suite or args.save:
+        results = run_suite()
+        print_suite(results, (read_baseline() or {}).get('cases'))
+        if args.save:
+            print "wrote %r" % save_baseline(results)
+        return
+    bench_imports()
+    bench_rows()
+    bench_formats()
+    bench_path_count()
+    bench_group_results()
+
+if __name__ == '__main__':
+    main()
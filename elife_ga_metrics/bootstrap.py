@@ -0,0 +1,197 @@
+__description__ = """Keeps what it takes to start talking to GA between runs: the API's
+discovery document and unexpired access tokens. Short runs otherwise spend most of
+their time fetching both before making a single query."""
+
+# ll: python -m elife_ga_metrics.bootstrap
+
+import os, copy, json, time, fcntl, hashlib, tempfile, threading
+from os.path import join
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from oauth2client.client import Storage
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/analytics/v3/rest'
+DISCOVERY_MAX_AGE = 60 * 60 * 24 * 7 # seconds. the v3 API rarely changes
+
+# the Core Reporting API v3 and the Analytics Reporting API v4
+ANALYTICS = 'analytics-v3'
+REPORTING = 'analyticsreporting-v4'
+DISCOVERY_URLS = {
+    ANALYTICS: DISCOVERY_URL,
+    REPORTING: 'https://analyticsreporting.googleapis.com/$discovery/rest?version=v4',
+}
+
+# stored tokens expiring sooner than this are not reused
+TOKEN_MARGIN = timedelta(minutes=5)
+
+def cache_dir():
+    "where bootstrap files are kept. ll: /path/to/elife-ga-metrics/.cache"
+    if os.environ.get('TESTING'):
+        return join(os.getenv('TEST_OUTPUT_DIR'), '.cache')
+    return os.environ.get('GA_CACHE_DIR') or join(os.path.dirname(os.path.dirname(__file__)), '.cache')
+
+def write_private(path, content):
+    "writes the given content atomically, readable only by us"
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname, 0700)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(path) + '-')
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(content)
+    os.rename(tmp_path, path)
+
+#
+# timings
+#
+
+TIMINGS = OrderedDict()
+_LOGGED = []
+
+@contextmanager
+def timed(label):
+    "records how long the first time the enclosed step took. ll: TIMINGS['discovery'] = 0.002"
+    start = time.time()
+    yield
+    TIMINGS.setdefault(label, time.time() - start)
+
+def log_timings():
+    "logs the time taken by each step of starting up, once"
+    if TIMINGS and not _LOGGED:
+        _LOGGED.append(True)
+        LOG.info("startup took %.3fs: %s", sum(TIMINGS.values()),
+                 ', '.join("%s %.3fs" % pair for pair in TIMINGS.items()))
+
+#
+# discovery document
+#
+
+_DISCOVERY = {}
+_DISCOVERY_LOCK = threading.Lock()
+
+def discovery_path(api=ANALYTICS):
+    return join(cache_dir(), api + '.json')
+
+def discovery_document(http, max_age=DISCOVERY_MAX_AGE, api=ANALYTICS):
+    """returns the discovery document of the given API, by default the Core Reporting API.
+    it's fetched at most once every `max_age` seconds and read at most once per process.
+    if it can't be fetched, an older copy is used if we have one"""
+    with _DISCOVERY_LOCK:
+        path = discovery_path(api)
+        if path in _DISCOVERY:
+            return _DISCOVERY[path]
+        content = None
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age:
+            with open(path, 'r') as fh:
+                content = fh.read()
+        else:
+            LOG.info("fetching %s discovery document", api)
+            try:
+                resp, content = http.request(DISCOVERY_URLS[api])
+                assert resp.status == 200, "unexpected response fetching discovery document: %s" % resp.status
+                json.loads(content) # don't keep anything we can't use
+                write_private(path, content)
+            except Exception, e:
+                if not os.path.exists(path):
+                    raise
+                LOG.warn("failed to fetch discovery document (%s), using the copy from %s", e,
+                         datetime.fromtimestamp(os.path.getmtime(path)))
+                with open(path, 'r') as fh:
+                    content = fh.read()
+        _DISCOVERY[path] = content
+        return content
+
+#
+# access tokens
+#
+
+def token_path(credentials):
+    "each account and set of scopes has it's own token file. the private key is never stored"
+    account = getattr(credentials, 'service_account_email', None) or credentials.client_id
+    scopes = getattr(credentials, '_scopes', None)
+    digest = hashlib.sha1(json.dumps([account, scopes])).hexdigest()[:12]
+    return join(cache_dir(), 'token-%s.json' % digest)
+
+class TokenStorage(Storage):
+    """stores the access token of a set of credentials, not the credentials themselves.
+    oauth2client writes to it whenever it refreshes the token and reads from it
+    before doing so, so a token refreshed by another thread or process is reused"""
+    def __init__(self, credentials):
+        Storage.__init__(self, lock=threading.Lock())
+        self.credentials = credentials
+        self.path = token_path(credentials)
+        self.lock_fh = None
+
+    def acquire_lock(self):
+        Storage.acquire_lock(self)
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), 0700)
+        self.lock_fh = open(self.path + '.lock', 'a')
+        fcntl.flock(self.lock_fh, fcntl.LOCK_EX)
+
+    def release_lock(self):
+        try:
+            fcntl.flock(self.lock_fh, fcntl.LOCK_UN)
+            self.lock_fh.close()
+        finally:
+            Storage.release_lock(self)
+
+    def read_token(self):
+        "returns a pair of (access token, expiry) or None if there is no usable stored token"
+        try:
+            with open(self.path, 'r') as fh:
+                data = json.load(fh)
+            expiry = datetime.strptime(data['token_expiry'], "%Y-%m-%dT%H:%M:%S")
+        except (IOError, ValueError, KeyError):
+            return None
+        if expiry - TOKEN_MARGIN <= datetime.utcnow():
+            return None
+        return data['access_token'], expiry
+
+    def locked_get(self):
+        token = self.read_token()
+        if token:
+            # a copy of our credentials (without their store) with the stored token
+            credentials = copy.copy(self.credentials)
+            credentials.access_token, credentials.token_expiry = token
+            return credentials
+
+    def locked_put(self, credentials):
+        if credentials.access_token and credentials.token_expiry:
+            write_private(self.path, json.dumps({
+                'access_token': credentials.access_token,
+                'token_expiry': credentials.token_expiry.strftime("%Y-%m-%dT%H:%M:%S"),
+            }))
+
+    def locked_delete(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+def reuse_tokens(credentials):
+    """stores the access tokens of the given credentials between runs,
+    starting with any unexpired token already stored"""
+    store = TokenStorage(credentials)
+    store.acquire_lock()
+    try:
+        token = store.read_token()
+    finally:
+        store.release_lock()
+    if token:
+        LOG.debug("reusing access token expiring %s", token[1])
+        credentials.access_token, credentials.token_expiry = token
+    credentials.set_store(store)
+    return credentials
+
+def main():
+    from elife_ga_metrics import core
+    core.ga_service()
+    for label, seconds in TIMINGS.items():
+        print "%-12s %.3fs" % (label, seconds)
+
+if __name__ == '__main__':
+    main()
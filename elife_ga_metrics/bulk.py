@@ -1,15 +1,14 @@
 __description__ = """Bulk loading of eLife metrics from Google Analytics."""
 
-import os, sys, time, random, json, calendar
+import os, sys, time, random, json, calendar, math
+from itertools import groupby
 import core
-from elife_ga_metrics import utils
+from elife_ga_metrics import utils, executor, retry, instrument, reporting, spans
 from elife_ga_metrics.core import ymd
 from datetime import datetime, date, timedelta
-from googleapiclient.http import BatchHttpRequest
-from googleapiclient import errors
 from pprint import pprint
 import logging
-from collections import OrderedDict
+from collections import OrderedDict, Counter
 
 logging.basicConfig()
 LOG = logging.getLogger(__name__)
@@ -23,6 +22,7 @@ def generate_queries(table_id, query_func_name, datetime_list, use_cached=False,
     "returns a list of queries to be executed by google"
     assert isinstance(query_func_name, str), "query func name must be a string"
     query_list = []
+    manifest = core.cache_manifest(sync=True)
     for start_date, end_date in datetime_list:
         module = core.module_picker(start_date, end_date)
         query_func = getattr(module, query_func_name)
@@ -31,7 +31,7 @@ def generate_queries(table_id, query_func_name, datetime_list, use_cached=False,
         output_path = core.output_path(query_type, start_date, end_date)
         LOG.debug("looking for metrics here: %s", output_path)
         if use_cached:
-            if os.path.exists(output_path):
+            if manifest.exists(output_path):
                 LOG.debug("we have %r results for %r to %r already", query_type, ymd(start_date), ymd(end_date))
                 continue
             else:
@@ -52,81 +52,276 @@ def generate_queries(table_id, query_func_name, datetime_list, use_cached=False,
         
     return query_list
 
-def bulk_query(query_list):
-    "executes a list of queries"
-    return map(core.query_ga_write_results, query_list)
+# the Core Reporting API accepts at most this many queries in a single batch request
+MAX_BATCH_SIZE = 10
+
+def BatchHttpRequest(*args, **kwargs):
+    "`googleapiclient.http.BatchHttpRequest`, only imported when queries are batched"
+    from googleapiclient.http import BatchHttpRequest
+    return BatchHttpRequest(*args, **kwargs)
+
+def batch_workers(workers):
+    """the number of batches executed at once so no more than `workers` queries are in
+    flight, each query in a batch counts. ll: 2 for 25 workers"""
+    return max(1, workers // MAX_BATCH_SIZE)
+
+def batch_query(query_list, limiter=None):
+    """executes a list of queries as a single multipart HTTP request.
+    queries that fail within the batch are retried individually using
+    the same back-off rules as `core.query_ga`"""
+    from googleapiclient import errors
+    assert len(query_list) <= MAX_BATCH_SIZE, "a batch can't contain more than %s queries" % MAX_BATCH_SIZE
+    responses = {}
+    def callback(request_id, response, exception):
+        if exception:
+            LOG.warn("query %s failed within batch: %s", request_id, exception)
+        else:
+            responses[int(request_id)] = response
+
+    batch = BatchHttpRequest(callback=callback)
+    for i, query_map in enumerate(query_list):
+        batch.add(core.ga_service().data().ga().get(**query_map), request_id=str(i))
+    if limiter:
+        # each query in a batch counts against our quota
+        for _ in query_list:
+            limiter.acquire()
+    try:
+        LOG.info("querying batch of %s ...", len(query_list))
+        with instrument.timer('ga.batch'):
+            batch.execute()
+    except errors.HttpError, e:
+        LOG.warn("batch request failed (%s), retrying queries individually", e.resp.status)
+
+    results = []
+    for i, query_map in enumerate(query_list):
+        if i in responses:
+            # batched queries need their remaining pages fetching individually
+            response = responses[i]
+            response = core.merge_pages([response] + list(core.remaining_pages(query_map, response, limiter=limiter)))
+            results.append((response, core.write_results(response, core.output_path_from_results(response))))
+        else:
+            results.append(core.query_ga_write_results(query_map, limiter=limiter))
+    return results
+
+def bulk_query(query_list, workers=1, limiter=None, batched=False, client=None, combined=None, span_days=None):
+    """executes a list of queries. if more than one worker is given the
+    queries are executed concurrently, sharing a rate limiter. if `batched`
+    is True, queries are packed into batches of up to `MAX_BATCH_SIZE`, enough
+    of them executed at once to keep `workers` queries in flight, see `batch_workers`.
+    if `combined` is True, or when not given `core.combined_queries()` is True,
+    queries for the same period are executed together, see `reporting`.
+    if `span_days` (or when not given `core.span_days()`) is more than one, daily
+    queries for consecutive days are executed as a single query of up to that many days,
+    see `spans`. spans take precedence over `combined` and `batched`.
+    if a `client.Client` is given, queries are executed by it's workers instead"""
+    if client or workers > 1:
+        limiter = limiter or executor.RateLimiter()
+    if combined is None:
+        combined = core.combined_queries()
+    if span_days is None:
+        span_days = core.span_days()
+    try:
+        # many results are written, record them in the manifest together
+        with core.batched_writes():
+            if client:
+                LOG.info("executing %s queries across %s client workers", len(query_list), client.workers)
+                future_list = [client.query_ga_write_results_async(query_map, limiter=limiter) for query_map in query_list]
+                return [future.result() for future in future_list]
+            if workers > 1:
+                LOG.info("executing %s queries across %s workers", len(query_list), workers)
+            if span_days > 1:
+                group_list = spans.group_queries(query_list, span_days)
+                LOG.info("executing %s queries as %s queries of up to %s days", len(query_list), len(group_list), span_days)
+                return sum(executor.pmap(lambda group: spans.query_ga_write_results(group, limiter=limiter), group_list, workers), [])
+            if combined:
+                group_list = reporting.group_queries(query_list)
+                LOG.info("executing %s queries in %s combined requests", len(query_list), len(group_list))
+                return sum(executor.pmap(lambda group: reporting.query_ga_write_results(group, limiter=limiter), group_list, workers), [])
+            if batched:
+                batch_list = utils.chunks(query_list, MAX_BATCH_SIZE)
+                LOG.info("executing %s queries in %s batches", len(query_list), len(batch_list))
+                return sum(executor.pmap(lambda batch: batch_query(batch, limiter), batch_list, batch_workers(workers)), [])
+            return executor.pmap(lambda q: core.query_ga_write_results(q, limiter=limiter), query_list, workers)
+    finally:
+        if query_list:
+            LOG.info("queries so far: %s", retry.STATS.summary())
 
 #
 # daily metrics
 #
 
-def metrics_for_range(table_id, dt_range_list, use_cached=False, use_only_cached=False):
+# when parsing across processes, each process is given roughly this many chunks of periods
+CHUNKS_PER_PROCESS = 4
+
+def chunk_periods(dt_range_list, num_chunks):
+    """splits the list of periods into roughly `num_chunks` contiguous chunks.
+    periods parsed by different `module_picker` modules are never in the same chunk"""
+    size = max(1, int(math.ceil(len(dt_range_list) / float(num_chunks))))
+    chunk_list = []
+    for _, group in groupby(dt_range_list, lambda dt_pair: core.module_picker(*dt_pair)):
+        chunk_list.extend(utils.chunks(list(group), size))
+    return chunk_list
+
+VIEW_TYPES = ('full', 'abstract', 'digest')
+
+def _init_process():
+    "called in each new process parsing periods. nothing recorded by the parent before the fork is counted twice"
+    core.forget_ga_service()
+    instrument.reset()
+
+def _metrics_for_chunk(args):
+    """`core.article_metrics` for each period in a chunk. called within a process by `metrics_for_range`.
+    views are returned as tuples, a Counter costs several times as much to send back.
+    anything instrumented in the process is returned with them"""
+    table_id, dt_range_list, use_cached, use_only_cached = args
+    packed_list = []
+    for from_date, to_date in dt_range_list:
+        res = core.article_metrics(table_id, from_date, to_date, use_cached, use_only_cached)
+        views = {doi: tuple(counts[view_type] for view_type in VIEW_TYPES) for doi, counts in res['views'].items()}
+        packed_list.append({'views': views, 'downloads': res['downloads']})
+    return packed_list, instrument.collect()
+
+def _unpack_metrics(packed):
+    "the article metrics of a period from the tuples returned by `_metrics_for_chunk`"
+    views = {}
+    for doi, counts in packed['views'].iteritems():
+        # dict.update skips Counter.update, which is slow
+        views[doi] = counter = Counter()
+        dict.update(counter, zip(VIEW_TYPES, counts))
+    return {'views': views, 'downloads': packed['downloads']}
+
+def metrics_for_range(table_id, dt_range_list, use_cached=False, use_only_cached=False, processes=1):
+    """returns the article metrics for each of the given periods, in order. if
+    more than one process is given, the periods are parsed across a pool of processes.
+    profiled if the GA_PROFILE environment variable is set, see `instrument`"""
+    with instrument.profiled(os.environ.get('GA_PROFILE')), instrument.timer('metrics_for_range', processes=processes):
+        instrument.incr('metrics_for_range.periods', len(dt_range_list))
+        return _metrics_for_range(table_id, dt_range_list, use_cached, use_only_cached, processes)
+
+def _metrics_for_range(table_id, dt_range_list, use_cached, use_only_cached, processes):
     # tell core to do it's data wrangling for us (using cached data)
     results = OrderedDict({})
+    if processes > 1:
+        chunk_list = chunk_periods(dt_range_list, processes * CHUNKS_PER_PROCESS)
+        LOG.info("parsing %s periods in %s chunks across %s processes", len(dt_range_list), len(chunk_list), processes)
+        arg_list = [(table_id, chunk, use_cached, use_only_cached) for chunk in chunk_list]
+        metrics_list = []
+        for packed_list, recorded in executor.process_map(_metrics_for_chunk, arg_list, processes, _init_process):
+            metrics_list.extend(packed_list)
+            instrument.merge(recorded)
+        for (from_date, to_date), packed in zip(dt_range_list, metrics_list):
+            results[(ymd(from_date), ymd(to_date))] = _unpack_metrics(packed)
+        return results
+
     for from_date, to_date in dt_range_list:
         res = core.article_metrics(table_id, from_date, to_date, use_cached, use_only_cached)
         results[(ymd(from_date), ymd(to_date))] = res
     return results
 
-def daily_metrics_between(table_id, from_date, to_date, use_cached=True, use_only_cached=False):
-    "does a DAILY query between two dates, NOT a single query within a date range"
-    date_list = utils.dt_range(from_date, to_date)
-    query_list = []
-
+def fetch_metrics(table_id, date_list, use_cached=True, use_only_cached=False, workers=1, batched=False):
+    """queries GA for the views and downloads of each of the given periods,
+    skipping those already cached if `use_cached`. returns the periods
+    there can be views for"""
     views_dt_range = filter(core.valid_view_dt_pair, date_list)
+    pdf_dt_range = filter(core.valid_downloads_dt_pair, date_list)
+
+    query_list = []
     query_list.extend(generate_queries(table_id, \
                                        'path_counts_query', \
                                        views_dt_range, \
                                        use_cached, use_only_cached))
 
-    pdf_dt_range = filter(core.valid_downloads_dt_pair, date_list)
     query_list.extend(generate_queries(table_id, \
                                        'event_counts_query', \
                                        pdf_dt_range,
                                        use_cached, use_only_cached))
 
-    bulk_query(query_list)
+    bulk_query(query_list, workers, batched=batched)
+    return views_dt_range
+
+def daily_metrics_between(table_id, from_date, to_date, use_cached=True, use_only_cached=False, workers=1, batched=False, processes=1):
+    "does a DAILY query between two dates, NOT a single query within a date range"
+    date_list = utils.dt_range(from_date, to_date)
+    views_dt_range = fetch_metrics(table_id, date_list, use_cached, use_only_cached, workers, batched)
     
     # everything should be cached by now
     use_cached = True # DELIBERATE here. the above 
-    return metrics_for_range(table_id, views_dt_range, use_cached, use_only_cached)
+    return metrics_for_range(table_id, views_dt_range, use_cached, use_only_cached, processes)
 
 #
 # monthly metrics
 #
 
-def monthly_metrics_between(table_id, from_date, to_date, use_cached=True, use_only_cached=False):
+def monthly_metrics_between(table_id, from_date, to_date, use_cached=True, use_only_cached=False, workers=1, batched=False, processes=1):
     date_list = utils.dt_month_range(from_date, to_date)
-    views_dt_range = filter(core.valid_view_dt_pair, date_list)
-    pdf_dt_range = filter(core.valid_downloads_dt_pair, date_list)
-
-    query_list = []
-    query_list.extend(generate_queries(table_id, \
-                                       'path_counts_query', \
-                                       views_dt_range,
-                                       use_cached, use_only_cached))
-    
-    query_list.extend(generate_queries(table_id, \
-                                       'event_counts_query', \
-                                       pdf_dt_range,
-                                       use_cached, use_only_cached))
-    bulk_query(query_list)
+    views_dt_range = fetch_metrics(table_id, date_list, use_cached, use_only_cached, workers, batched)
     
     # everything should be cached by now
     use_cached = True # DELIBERATE
-    return metrics_for_range(table_id, views_dt_range, use_cached, use_only_cached)
+    return metrics_for_range(table_id, views_dt_range, use_cached, use_only_cached, processes)
 
 #
 #
 #
 
-# TODO: good idea!
-def fill_gaps():
+# GA keeps revising a day's figures for a day or two afterwards. results for
+# periods that ended within this many days of today are fetched again
+REFRESH_DAYS = 3
+
+def find_gaps(table_id, from_date=core.VIEWS_INCEPTION, to_date=None, refresh_days=REFRESH_DAYS):
+    """returns a list of (query, reason) for every daily and monthly period
+    between the given dates whose results are missing, still in progress,
+    recent enough that GA may still revise them (see `REFRESH_DAYS`)
+    or were fetched using a different query than we would use today,
+    usually because `module_picker` has changed"""
+    to_date = to_date or datetime.now()
+    today = datetime.combine(date.today(), datetime.min.time())
+    refresh_from = today - timedelta(days=refresh_days)
+    manifest = core.cache_manifest(sync=True)
+    gaps = []
+    for dt_range in [utils.dt_range(from_date, to_date), utils.dt_month_range(from_date, to_date)]:
+        for results_type, valid in [('views', core.valid_view_dt_pair), ('downloads', core.valid_downloads_dt_pair)]:
+            for start_date, end_date in filter(valid, dt_range):
+                module = core.module_picker(start_date, end_date)
+                query = getattr(module, core.QUERY_FUNCS[results_type])(table_id, start_date, end_date)
+                path = core.output_path(results_type, start_date, end_date)
+                entry = manifest.get(path)
+                if path.endswith('.partial'):
+                    reason = 'in progress'
+                elif not entry:
+                    reason = 'partial' if manifest.exists(path + '.partial') else 'missing'
+                elif end_date >= refresh_from:
+                    reason = 'recent'
+                elif entry['filters'] != query['filters']:
+                    reason = 'outdated'
+                else:
+                    continue
+                LOG.debug("%s results for %s to %s are %s", results_type, ymd(start_date), ymd(end_date), reason)
+                gaps.append((query, reason))
+    return gaps
+
+def remove_stale_partials():
+    "removes partial results that have since been replaced by complete results"
+    manifest = core.cache_manifest(sync=True)
+    for results_type in core.QUERY_FUNCS.keys():
+        for path, _, _ in list(manifest.periods(results_type, partial=True)):
+            if manifest.exists(path[:-len('.partial')]):
+                LOG.info("removing stale partial results %r", path)
+                os.unlink(path)
+                manifest.remove(path)
+
+def fill_gaps(table_id, from_date=core.VIEWS_INCEPTION, to_date=None, workers=executor.MAX_WORKERS, batched=True):
     """goes through all files we have output and looks for 'gaps' and 
-    then creates a query that will fill it. NOT a replacement for 
-    regenerate_results """
+    then creates a query that will fill it. results for the last few days
+    and the month they're in are fetched again, see `find_gaps`.
+    NOT a replacement for regenerate_results """
+    gaps = find_gaps(table_id, from_date, to_date)
+    LOG.info("found %s gaps: %r", len(gaps), Counter(reason for _, reason in gaps))
+    results = bulk_query([query for query, _ in gaps], workers, batched=batched)
+    remove_stale_partials()
+    return results
 
-def regenerate_results(table_id, from_date=core.VIEWS_INCEPTION):
+def regenerate_results(table_id, from_date=core.VIEWS_INCEPTION, workers=executor.MAX_WORKERS, batched=True, processes=executor.MAX_PROCESSES):
     "this will perform all queries again, overwriting the results in `output`"
     today = datetime.now()
     use_cached, use_only_cached = False, False
@@ -134,13 +329,23 @@ def regenerate_results(table_id, from_date=core.VIEWS_INCEPTION):
     daily_metrics_between(table_id, \
                           from_date, \
                           today, \
-                          use_cached, use_only_cached)    
+                          use_cached, use_only_cached, workers, batched, processes)
 
     LOG.info("querying monthly metrics ...")
     monthly_metrics_between(table_id, \
                             from_date, \
                             today, \
-                            use_cached, use_only_cached)
+                            use_cached, use_only_cached, workers, batched, processes)
+
+def reprocess_results(table_id, from_date=core.VIEWS_INCEPTION, processes=executor.MAX_PROCESSES):
+    """parses all cached results again without querying GA, for when the parsers
+    have changed. the parsed results are cached for the next time they're needed"""
+    today = datetime.now()
+    use_cached, use_only_cached = True, True
+    LOG.info("reprocessing daily metrics ...")
+    daily_metrics_between(table_id, from_date, today, use_cached, use_only_cached, processes=processes)
+    LOG.info("reprocessing monthly metrics ...")
+    monthly_metrics_between(table_id, from_date, today, use_cached, use_only_cached, processes=processes)
 
 def regenerate_results_2016(table_id):
     return regenerate_results(table_id, datetime(2016, 1, 1))
@@ -0,0 +1,259 @@
+__description__ = """A thread-safe client for the Core Reporting API. Unlike the discovery
+client returned by `core.ga_service`, one client can be shared by any number of threads.
+Queries are submitted to a pool of workers and return a `Future`."""
+
+# ll: future = client.query_ga_async(query_map)
+# ll: response = future.result()
+
+# Core Reporting API, data.ga.get:
+# https://developers.google.com/analytics/devguides/reporting/core/v3/reference
+
+import sys, json, socket, threading, httplib, urllib, urlparse, Queue
+import httplib2
+from googleapiclient import errors
+from elife_ga_metrics import core, executor
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+GA_URL = 'https://www.googleapis.com/analytics/v3/data/ga'
+
+def query_params(query_map):
+    """the query string parameters of the given query. the discovery client
+    accepts `start_date`, `max_results` etc, the REST API wants them hyphenated"""
+    params = []
+    for key, val in sorted(query_map.items()):
+        if isinstance(val, unicode):
+            val = val.encode('utf-8')
+        params.append((key.replace('_', '-'), val))
+    return urllib.urlencode(params)
+
+class ConnectionPool(object):
+    """keep-alive connections to a single host. a connection is used by
+    one request at a time and put back in the pool once it's response has
+    been read. at most `size` idle connections are kept"""
+    def __init__(self, url, size=executor.MAX_WORKERS, timeout=60):
+        bits = urlparse.urlsplit(url)
+        self.connection_class = httplib.HTTPSConnection if bits.scheme == 'https' else httplib.HTTPConnection
+        self.host = bits.netloc
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.opened = 0
+
+    def acquire(self):
+        "returns an idle connection and True, or a new connection and False"
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+            self.opened += 1
+        return self.connection_class(self.host, timeout=self.timeout), False
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, path, headers=None):
+        """makes a request, returning a triple of (status, headers, body).
+        a kept-alive connection may have been closed by the server since
+        it was last used, so a request on one that fails is tried once more
+        on a new connection"""
+        while True:
+            conn, reused = self.acquire()
+            try:
+                conn.request(method, path, headers=headers or {})
+                resp = conn.getresponse()
+                body = resp.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    LOG.debug("kept-alive connection to %r failed, retrying on a new one", self.host)
+                    continue
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self.release(conn)
+            return resp.status, dict(resp.getheaders(), status=str(resp.status)), body
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+class Future(object):
+    "the eventual result of work submitted to a `Client`"
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def set_result(self, value):
+        self.value = value
+        self.event.set()
+
+    def set_exception(self, exc_info):
+        self.exc_info = exc_info
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        "blocks until the work is done, returning it's result or raising it's exception"
+        if not self.event.wait(timeout):
+            raise AssertionError("no result after %ss" % timeout)
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+class Request(object):
+    "a single data.ga.get request, executed like those created by the discovery client"
+    def __init__(self, client, query_map):
+        self.client = client
+        self.query_map = query_map
+
+    def execute(self):
+        return self.client.execute(self.query_map)
+
+class Client(object):
+    """talks to the Core Reporting API over a pool of keep-alive connections,
+    signing requests with the service-account credentials of `core.ga_credentials`.
+    `workers` threads execute the work submitted to it"""
+    def __init__(self, workers=executor.MAX_WORKERS, credentials=None, url=GA_URL, timeout=60):
+        self.url = url
+        self.path = urlparse.urlsplit(url).path
+        self.credentials = credentials
+        self.pool = ConnectionPool(url, workers, timeout)
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    #
+    # requests
+    #
+
+    def access_token(self, refresh=False):
+        "the current access token. only one thread at a time will refresh it"
+        with self.lock:
+            if self.credentials is None:
+                self.credentials = core.ga_credentials()
+            if refresh:
+                self.credentials.refresh(httplib2.Http())
+            return self.credentials.get_access_token().access_token
+
+    def execute(self, query_map):
+        """executes the query, returning GA's response. raises a `googleapiclient.errors.HttpError`
+        for any other status than 200, as the discovery client does"""
+        uri = self.path + '?' + query_params(query_map)
+        for attempt in range(2):
+            # an access token can be revoked before it expires, refresh it once if refused
+            headers = {'Authorization': 'Bearer ' + self.access_token(refresh=attempt > 0),
+                       'Accept': 'application/json'}
+            status, headers, body = self.pool.request('GET', uri, headers)
+            if status != 401:
+                break
+        if status != 200:
+            resp = httplib2.Response(headers)
+            resp.reason = httplib.responses.get(status, '')
+            raise errors.HttpError(resp, body, uri=self.url)
+        return json.loads(body)
+
+    def get(self, **query_map):
+        "returns a `Request` for the given query, like `core.ga_service().data().ga().get`"
+        return Request(self, query_map)
+
+    # a client can stand in for the discovery client's service. ll: client.data().ga().get(**query_map)
+    def data(self):
+        return self
+
+    def ga(self):
+        return self
+
+    #
+    # workers
+    #
+
+    def submit(self, fn, *args, **kwargs):
+        "calls `fn` with the given arguments on one of our workers, returning a `Future`"
+        future = Future()
+        self.start()
+        self.queue.put((future, fn, args, kwargs))
+        return future
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, name="ga-client-%s" % len(self.threads))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            future, fn, args, kwargs = job
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException:
+                future.set_exception(sys.exc_info())
+
+    def close(self):
+        "waits for submitted work to finish then stops the workers and closes any connections"
+        with self.lock:
+            thread_list, self.threads = self.threads, []
+        for _ in thread_list:
+            self.queue.put(None)
+        for thread in thread_list:
+            thread.join()
+        self.pool.close()
+
+    #
+    # queries
+    #
+
+    def query_ga_async(self, query_map, num_attempts=5, limiter=None):
+        "like `core.query_ga` but returns a `Future` of the response"
+        return self.submit(core.query_ga, self.get(**query_map), num_attempts, limiter)
+
+    def query_ga_write_results(self, query_map, num_attempts=5, limiter=None):
+        "like `core.query_ga_write_results`. fetches every page of results and writes them"
+        first_page = core.query_ga(self.get(**query_map), num_attempts, limiter)
+        page_list = [core.query_ga(self.get(**page_query), num_attempts, limiter) \
+                     for page_query in core.page_queries(query_map, first_page)]
+        response = core.merge_pages([first_page] + page_list)
+        return response, core.write_results(response, core.output_path_from_results(response))
+
+    def query_ga_write_results_async(self, query_map, num_attempts=5, limiter=None):
+        "like `query_ga_write_results` but returns a `Future` of the (response, path) pair"
+        return self.submit(self.query_ga_write_results, query_map, num_attempts, limiter)
+
+_CLIENT = []
+_CLIENT_LOCK = threading.Lock()
+
+def get_client():
+    "returns a client shared by everything in this process"
+    with _CLIENT_LOCK:
+        if not _CLIENT:
+            _CLIENT.append(Client())
+        return _CLIENT[0]
+
+def query_ga_async(query_map, num_attempts=5, limiter=None):
+    "like `core.query_ga` but returns a `Future` of the response, using the shared client"
+    return get_client().query_ga_async(query_map, num_attempts, limiter)
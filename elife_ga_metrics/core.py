@@ -10,20 +10,18 @@ __author__ = [
 
 from os.path import join
 from collections import Counter
-import os, re, argparse, json, time, random, json
+import os, re, gzip, json, tempfile, threading
+from cStringIO import StringIO
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-import httplib2
-from googleapiclient.errors import HttpError
-from googleapiclient import errors
-from googleapiclient.discovery import build
-from oauth2client.client import AccessTokenRefreshError
-from oauth2client.service_account import ServiceAccountCredentials
-from oauth2client import file as oauth_file
-from httplib2 import Http
-from elife_ga_metrics.utils import ymd, firstof, month_min_max
-from kids.cache import cache
+from elife_ga_metrics.utils import ymd, firstof, month_min_max, open_results, GZIP_MAGIC
+from elife_ga_metrics import executor, parsecache, instrument
 import logging
 
+# the Google client libraries (googleapiclient, oauth2client, httplib2) are slow to
+# import and only needed to talk to GA, so they are imported by the functions that do.
+# results that are already cached can be read without ever importing them
+
 import elife_v1, elife_v2, elife_v3
 
 logging.basicConfig()
@@ -84,6 +82,11 @@ def sanitize_ga_response(ga_response):
         del ga_response['query']['ids']
     return ga_response
 
+def is_sanitized(ga_response):
+    "returns True if there is nothing in the given response `sanitize_ga_response` would remove"
+    return not any(ga_response.has_key(key) for key in SANITISE_THESE) \
+      and not ga_response.get('query', {}).has_key('ids')
+
 def oauth_secrets():
     settings_file_locations = SECRETS_LOCATIONS
     settings_file = firstof(os.path.exists, settings_file_locations)
@@ -93,19 +96,65 @@ def oauth_secrets():
         raise EnvironmentError(msg)
     return settings_file
 
-@cache
+_CREDENTIALS = []
+_CREDENTIALS_LOCK = threading.Lock()
+
+def ga_credentials():
+    "returns the service-account credentials, read once per process"
+    from oauth2client.service_account import ServiceAccountCredentials
+    from elife_ga_metrics import bootstrap
+    with _CREDENTIALS_LOCK:
+        if not _CREDENTIALS:
+            settings_file = oauth_secrets()
+            scope = 'https://www.googleapis.com/auth/analytics.readonly'
+            with bootstrap.timed('credentials'):
+                credentials = ServiceAccountCredentials.from_json_keyfile_name(settings_file, scopes=[scope])
+            # unexpired access tokens are reused between runs
+            _CREDENTIALS.append(bootstrap.reuse_tokens(credentials))
+        return _CREDENTIALS[0]
+
+_THREAD = threading.local()
+
+def build_service(api):
+    """returns a service object for the given API, one of `bootstrap.DISCOVERY_URLS`.
+    httplib2.Http objects are not threadsafe, so each thread gets it's own service and
+    connection. the discovery document describing the service is cached between runs"""
+    services = _THREAD.__dict__.setdefault('services', {})
+    if api not in services:
+        from httplib2 import Http
+        from googleapiclient.discovery import build_from_document
+        from elife_ga_metrics import bootstrap
+        http = Http()
+        credentials = ga_credentials()
+        credentials.authorize(http)
+        with bootstrap.timed('token'):
+            credentials.get_access_token()
+        with bootstrap.timed('discovery'):
+            document = bootstrap.discovery_document(http, api=api)
+        with bootstrap.timed('build'):
+            services[api] = build_from_document(document, http=http)
+        bootstrap.log_timings()
+    return services[api]
+
 def ga_service():
-    service_name = 'analytics'
-    settings_file = oauth_secrets()
-    scope = 'https://www.googleapis.com/auth/analytics.readonly'
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(settings_file, scopes=[scope])
-    http = Http()
-    credentials.authorize(http) # does this 'put' back into the credentials file??
-    service = build(service_name, 'v3', http=http)
-    return service
-
-def query_ga(query_map, num_attempts=5):
-    "talks to google with the given query, applying exponential back-off if rate limited"
+    "returns a Core Reporting API (v3) service object for this thread"
+    return build_service('analytics-v3')
+
+def reporting_service():
+    "returns an Analytics Reporting API (v4) service object for this thread, see `reporting`"
+    return build_service('analyticsreporting-v4')
+
+def forget_ga_service():
+    "a forked process must build it's own GA services rather than share the connections of it's parent"
+    global _THREAD
+    _THREAD = threading.local()
+
+def query_ga(query_map, num_attempts=5, limiter=None, policy=None):
+    """talks to google with the given query, retrying according to the given `retry.RetryPolicy`
+    (or one of `num_attempts`) when rate limited. if an `executor.RateLimiter` is given,
+    queries wait their turn and back-offs pause all workers"""
+    from oauth2client.client import AccessTokenRefreshError
+    from elife_ga_metrics import retry
 
     # build the query
     if isinstance(query_map, dict):
@@ -115,47 +164,73 @@ def query_ga(query_map, num_attempts=5):
         query = query_map
 
     # execute it
-    for n in range(0, num_attempts):
-        try:
-            if n > 1:
-                LOG.info("query attempt %r" % (n + 1))
-            else:
-                LOG.info("querying ...")
-            return query.execute()
-
-        except TypeError, error:      
-            # Handle errors in constructing a query.
-            LOG.exception('There was an error in constructing your query : %s', error)
-            raise
-        
-        except errors.HttpError, e:
-            LOG.warn("HttpError ... can we recover?")
-
-            status_code = e.resp.status
-            
-            if status_code in [403, 503]:
-
-                # apply exponential backoff.
-                val = (2 ** n) + random.randint(0, 1000) / 1000
-                if status_code == 503:
-                    # wait even longer
-                    val = val * 2
-                
-                LOG.info("rate limited. backing off %r", val)
-                time.sleep(val)
-
-            else:
-                # some other sort of HttpError, re-raise
-                LOG.exception("unhandled exception!")
-                raise
-
-        except AccessTokenRefreshError:
-            # Handle Auth errors.
-            LOG.exception ('The credentials have been revoked or expired, please re-run ' \
-                   'the application to re-authorize')
-            raise
-    
-    raise AssertionError("Failed to execute query after %s attempts" % num_attempts)
+    policy = policy or retry.RetryPolicy(num_attempts)
+    try:
+        # includes any waits for the rate limiter and to retry
+        with instrument.timer('ga.query', type=query_type(query_map)):
+            return policy.execute(query, limiter)
+
+    except TypeError, error:
+        # Handle errors in constructing a query.
+        LOG.exception('There was an error in constructing your query : %s', error)
+        raise
+
+    except AccessTokenRefreshError:
+        # Handle Auth errors.
+        LOG.exception ('The credentials have been revoked or expired, please re-run ' \
+               'the application to re-authorize')
+        raise
+
+def page_queries(query_map, first_page):
+    """returns a query for each page of results that follows the given first page. GA
+    returns at most `max_results` rows at a time, the first page tells us how many rows
+    there are in total"""
+    per_page = first_page.get('itemsPerPage') or query_map.get('max_results')
+    total = first_page.get('totalResults', 0)
+    if not isinstance(query_map, dict) or not per_page or total <= per_page:
+        # no more pages or a query object we can't page through
+        return []
+    # start_index is 1-based. ll: [10001, 20001, 30001]
+    start_index_list = range(1 + per_page, total + 1, per_page)
+    LOG.info("fetching %s more pages of results (%s rows total)", len(start_index_list), total)
+    return [dict(query_map, start_index=start_index) for start_index in start_index_list]
+
+def remaining_pages(query_map, first_page, num_attempts=5, limiter=None, workers=1):
+    """yields the pages of results that follow the given first page.
+    pages may be fetched concurrently if `workers` > 1"""
+    fetch = lambda page_query: query_ga(page_query, num_attempts, limiter)
+    page_query_list = page_queries(query_map, first_page)
+    if workers > 1:
+        page_list = executor.pmap(fetch, page_query_list, workers)
+    else:
+        page_list = (fetch(page_query) for page_query in page_query_list)
+    for page in page_list:
+        yield page
+
+def query_pages(query_map, num_attempts=5, limiter=None, workers=1):
+    "yields every page of results for the given query"
+    first_page = query_ga(query_map, num_attempts, limiter)
+    yield first_page
+    for page in remaining_pages(query_map, first_page, num_attempts, limiter, workers):
+        yield page
+
+def merge_pages(page_list):
+    """merges pages of results into the first page, ensuring the
+    number of rows matches the total GA says there should be"""
+    page_list = iter(page_list)
+    response = next(page_list)
+    rows = response.get('rows', [])
+    for page in page_list:
+        rows.extend(page.get('rows', []))
+    if rows:
+        response['rows'] = rows
+    total = response.get('totalResults', len(rows))
+    if len(rows) != total:
+        raise AssertionError("expected %s rows of results, received %s" % (total, len(rows)))
+    # links to other pages no longer make sense
+    for key in ['nextLink', 'previousLink']:
+        response.pop(key, None)
+    return response
 
 def output_path(results_type, from_date, to_date):
     "generates a path for results of the given type"
@@ -167,7 +242,8 @@ def output_path(results_type, from_date, to_date):
         from_date_dt, to_date_dt = from_date, to_date
         from_date, to_date = ymd(from_date), ymd(to_date)
 
-    now, now_dt = ymd(datetime.now()), datetime.now()
+    now_dt = datetime.now()
+    now = ymd(now_dt)
 
     # different formatting if two different dates are provided
     if from_date == to_date:
@@ -186,6 +262,56 @@ def output_path(results_type, from_date, to_date):
     # ll: output/views/2014-01-01_2014-01-31.json.partial
     return join(output_dir(), results_type, dt_str + ".json" + partial)
 
+def parse_output_path(path):
+    "the inverse of `output_path`, returns a triple of (results_type, from_date, to_date)"
+    results_type = os.path.basename(os.path.dirname(path))
+    # ll: 2014-01-01_2014-01-31.json.partial => 2014-01-01_2014-01-31
+    dt_str = os.path.basename(path).split('.')[0]
+    from_str, _, to_str = dt_str.partition('_')
+    from_date = datetime.strptime(from_str, "%Y-%m-%d")
+    to_date = datetime.strptime(to_str, "%Y-%m-%d") if to_str else from_date
+    return results_type, from_date, to_date
+
+def cache_manifest(sync=False):
+    "returns the manifest of results cached in the output directory"
+    from elife_ga_metrics import manifest # manifest depends on core
+    return manifest.get_manifest(sync)
+
+def cached_periods(results_type):
+    """yields a triple of (path, from_date, to_date) for every complete
+    period of results of the given type in the output directory"""
+    return cache_manifest(sync=True).periods(results_type)
+
+# results are written with sorted keys, so the query always precedes the rows
+QUERY_RE = re.compile(r'"query":\s*(\{[^{}]*\})')
+
+def cached_query(path, chunk_size=4096):
+    """returns the query of the cached response at the given path,
+    reading no more of the file than necessary"""
+    with open_results(path) as fh:
+        head = ''
+        for _ in range(16):
+            chunk = fh.read(chunk_size)
+            head += chunk
+            match = QUERY_RE.search(head)
+            if match:
+                return json.loads(match.group(1))
+            if not chunk:
+                break
+    # not where we expected it to be, read the whole response
+    return read_results(path)['query']
+
+def read_results(path):
+    "returns the whole of the cached response at the given path, compressed or not"
+    with instrument.timer('read_results'), open_results(path) as fh:
+        return json.load(fh)
+
+def query_type(query):
+    "guesses the type of results the given query or it's response's query returns. ll: 'downloads'"
+    if not isinstance(query, dict):
+        return 'unknown'
+    return 'downloads' if 'ga:eventLabel' in query.get('filters', '') else 'views'
+
 def output_path_from_results(response):
     """determines a path where the given response can live, using the
     dates within the response and guessing the request type"""
@@ -194,22 +320,124 @@ def output_path_from_results(response):
     query = response['query']
     from_date = datetime.strptime(query['start-date'], "%Y-%m-%d")
     to_date = datetime.strptime(query['end-date'], "%Y-%m-%d")
-    results_type = 'downloads' if 'ga:eventLabel' in query['filters'] else 'views'
-    return output_path(results_type, from_date, to_date)
+    return output_path(query_type(query), from_date, to_date)
 
-def write_results(results, path):
-    "writes sanitised response from Google as json to the given path"
+def write_file(path, content):
+    """writes the given content to a hidden temporary file beside the given path and then
+    renames it into place. the path holds either all of the old content or all of the new,
+    a crash part way through never leaves a truncated file behind"""
     dirname = os.path.dirname(path)
-    if not os.path.exists(dirname):
-        assert os.system("mkdir -p %s" % dirname) == 0, "failed to make output dir %r" % dirname
+    try:
+        os.makedirs(dirname)
+    except OSError:
+        if not os.path.isdir(dirname):
+            raise
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(content)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+# results written within `batched_writes` that are yet to be recorded in the manifest
+_PENDING = {'depth': 0, 'size': 0, 'entries': []}
+_PENDING_LOCK = threading.Lock()
+
+# during bulk runs, written results are recorded in the manifest this many at a time
+WRITE_BATCH_SIZE = 50
+
+@contextmanager
+def batched_writes(size=WRITE_BATCH_SIZE):
+    """results written within this are recorded in the manifest `size` at a time rather
+    than one at a time. the results themselves are still written straight away and if
+    we crash before recording them the manifest finds them the next time it looks"""
+    with _PENDING_LOCK:
+        if not _PENDING['depth']:
+            _PENDING['size'] = size
+        _PENDING['depth'] += 1
+    try:
+        yield
+    finally:
+        with _PENDING_LOCK:
+            _PENDING['depth'] -= 1
+            entries = _PENDING['entries'] if not _PENDING['depth'] else []
+            if entries:
+                _PENDING['entries'] = []
+        cache_manifest().record_many(entries)
+
+def record_results(path, results):
+    "records the results written to the given path in the manifest, now or as part of a batch"
+    from elife_ga_metrics import manifest # manifest depends on core
+    entry = manifest.entry_for(path, results)
+    with _PENDING_LOCK:
+        if not _PENDING['depth']:
+            entries = [(path, entry)]
+        else:
+            _PENDING['entries'].append((path, entry))
+            entries = []
+            if len(_PENDING['entries']) >= _PENDING['size']:
+                entries, _PENDING['entries'] = _PENDING['entries'], []
+    cache_manifest().record_many(entries)
+
+# gzip's default of 9 is much slower to write for barely smaller results
+COMPRESS_LEVEL = 6
+
+def is_compressed(path):
+    "returns True if the results at the given path are gzipped"
+    with open(path, 'rb') as fh:
+        return fh.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+def combined_queries():
+    "views and downloads are fetched together if the GA_COMBINED_QUERIES environment variable is set, see `reporting`"
+    return bool(os.environ.get('GA_COMBINED_QUERIES'))
+
+def span_days():
+    """daily results are fetched this many days at a time if the GA_SPAN_DAYS environment
+    variable is set, otherwise one day at a time. see `spans`"""
+    return int(os.environ.get('GA_SPAN_DAYS') or 1)
+
+def compress_results():
+    "results are written compressed if the GA_COMPRESS_RESULTS environment variable is set"
+    return bool(os.environ.get('GA_COMPRESS_RESULTS'))
+
+def encode_results(results, compress=False):
+    """returns the given response as pretty-printed json or, compressed, as gzipped
+    compact json. either way keys are sorted, so the query precedes the rows, and
+    the same response always encodes to the same bytes"""
+    if not compress:
+        return json.dumps(results, indent=4, sort_keys=True)
+    buf = StringIO()
+    # a fixed timestamp in the gzip header, otherwise rewriting unchanged results changes them
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=COMPRESS_LEVEL, mtime=0) as fh:
+        fh.write(json.dumps(results, separators=(',', ':'), sort_keys=True))
+    return buf.getvalue()
+
+def write_results(results, path, compress=None):
+    """writes sanitised response from Google as json to the given path. compressed
+    if `compress` is True or, when not given, if `compress_results()` is True.
+    the path is the same either way and readers don't need to know which it is"""
     LOG.info("writing %r", path)
     #json.dump(results, open(path + '.raw', 'w'), indent=4, sort_keys=True)
-    json.dump(sanitize_ga_response(results), open(path, 'w'), indent=4, sort_keys=True)
+    results = sanitize_ga_response(results)
+    if compress is None:
+        compress = compress_results()
+    results_type = query_type(results.get('query'))
+    with instrument.timer('write_results', type=results_type):
+        content = encode_results(results, compress)
+        write_file(path, content)
+    instrument.incr('write_results.bytes', len(content), type=results_type)
+    if cache_manifest().tracks(path):
+        record_results(path, results)
     return path
 
-def query_ga_write_results(query, num_attempts=5):
-    "convenience. queries GA then writes the results, returning both the original response and the path to results"
-    response = query_ga(query, num_attempts)
+def query_ga_write_results(query, num_attempts=5, limiter=None):
+    """convenience. queries GA, fetching all pages of results, then writes the results,
+    returning both the original response and the path to results"""
+    response = merge_pages(query_pages(query, num_attempts, limiter))
     path = output_path_from_results(response)
     return response, write_results(response, path)
 
@@ -257,6 +485,32 @@ def module_picker(from_date, to_date):
 #
 #
 
+# the function in each elife_v* module that parses results of each type
+PARSERS = {
+    'views': 'path_counts',
+    'downloads': 'event_counts',
+}
+
+# the function in each elife_v* module that builds queries for results of each type
+QUERY_FUNCS = {
+    'views': 'path_counts_query',
+    'downloads': 'event_counts_query',
+}
+
+def cached_results(results_type, from_date, to_date, module):
+    """returns the parsed results for the given period from the store or
+    from the cached raw results. returns None if nothing is cached"""
+    from elife_ga_metrics import store # store depends on core
+    results = store.read(results_type, from_date, to_date, module)
+    source = 'store'
+    if results is None:
+        path = output_path(results_type, from_date, to_date)
+        source = 'missing'
+        if cache_manifest().exists(path):
+            results = parsecache.parse(path, module, PARSERS[results_type])
+            source = 'raw'
+    instrument.incr('cached_results', type=results_type, source=source)
+    return results
 
 def article_views(table_id, from_date, to_date, cached=False, only_cached=False):
     "returns article view data either from the cache or from talking to google"
@@ -266,8 +520,9 @@ def article_views(table_id, from_date, to_date, cached=False, only_cached=False)
     
     path = output_path('views', from_date, to_date)
     module = module_picker(from_date, to_date)
-    if cached and os.path.exists(path):
-        raw_data = json.load(open(path, 'r'))
+    results = cached_results('views', from_date, to_date, module) if cached else None
+    if results is not None:
+        return results
     elif only_cached:
         # no cache exists and we've been told to only use cache.
         # no results found.
@@ -286,8 +541,9 @@ def article_downloads(table_id, from_date, to_date, cached=False, only_cached=Fa
         return {}
     path = output_path('downloads', from_date, to_date)
     module = module_picker(from_date, to_date)
-    if cached and os.path.exists(path):
-        raw_data = json.load(open(path, 'r'))
+    results = cached_results('downloads', from_date, to_date, module) if cached else None
+    if results is not None:
+        return results
     elif only_cached:
         # no cache exists and we've been told to only use cache.
         # no results found.
@@ -299,8 +555,25 @@ def article_downloads(table_id, from_date, to_date, cached=False, only_cached=Fa
         assert path == actual_path, "the expected output path (%s) doesn't match the path actually written to (%s)" % (path, actual_path)
     return module.event_counts(raw_data.get('rows', []))
 
+def fetch_combined(table_id, from_date, to_date, cached=False):
+    """fetches the views and downloads for the given period in a single request, skipping
+    those already cached if `cached`. returns the paths written to, see `reporting`"""
+    from elife_ga_metrics import reporting # reporting depends on core
+    query_list = reporting.period_queries(table_id, from_date, to_date)
+    if cached:
+        query_list = [query_map for query_map in query_list if not cache_manifest().exists(output_path(
+            query_type(query_map), from_date, to_date))]
+    if not query_list:
+        return []
+    return [path for _, path in reporting.query_ga_write_results(query_list)]
+
 def article_metrics(table_id, from_date, to_date, cached=False, only_cached=False):
-    "returns a dictionary of article metrics, combining both article views and pdf downloads"
+    """returns a dictionary of article metrics, combining both article views and pdf downloads.
+    if `combined_queries()` is True, both are fetched from GA in a single request"""
+    if combined_queries() and not only_cached:
+        fetch_combined(table_id, from_date, to_date, cached)
+        # everything is cached now
+        cached = True
     views = article_views(table_id, from_date, to_date, cached, only_cached)
     downloads = article_downloads(table_id, from_date, to_date, cached, only_cached)
 
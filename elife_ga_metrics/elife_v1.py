@@ -11,6 +11,7 @@ __author__ = [
 import os, re
 from os.path import join
 from collections import Counter
+from itertools import imap, ifilter
 from datetime import datetime
 from elife_ga_metrics import utils
 from elife_ga_metrics.utils import ymd
@@ -47,7 +48,7 @@ def event_counts(row_list):
     def parse(row):
         label, count = row
         return label.split('::')[0], int(count)
-    return dict(map(parse, row_list))
+    return dict(imap(parse, row_list))
 
 #
 # views handling
@@ -100,65 +101,55 @@ TYPE_MAP = {
 }
 SPLITTER = re.compile('\.|/')
 
+# classifies a (lowercased) path in a single pass. the path prefixes are
+# tried in order, each consuming up to the same number of leading path
+# segments as the `str.split('/', n)` calls this pattern replaces
+PATH_RE = re.compile(r"""^(?:
+    # POA article variation 1 "/content/early/yyyy/mm/dd/doi/" type urls
+    /content/early/(?:[^/]*/){0,3}(?P<early>.*)|
+    # POA article variation 2 "/content/elife/early/yyyy/mm/dd/doi/" type urls
+    /content/elife/early/(?:[^/]*/){0,3}(?P<elife_early>.*)|
+    # valid but unsupported /content/elife/volume/id paths. these paths appear in PDF files I've been told
+    (?:/content/elife/(?:[^/]*/)?|
+    # standard /content/volume/id/ paths
+    (?:[^/]*/){0,3})
+    # the article id, split from it's suffix (if one available)
+    (?P<art>[^./]*)(?:[./](?P<suffix>.*))?
+)$""", re.VERBOSE | re.DOTALL)
+
 def path_count(pair):
     "figures out the type of the given path using the suffix (if one available)"
-    try:
-        if pair[0].lower().startswith('/content/early/'):
-            # handles POA article variation 1 "/content/early/yyyy/mm/dd/doi/" type urls
-            bits = pair[0].split('/', 6)
-            bits[-1] = utils.deplumpen(bits[-1])
-
-        elif pair[0].lower().startswith('/content/elife/early/'):
-            # handles POA article variation 2 "/content/elife/early/yyyy/mm/dd/doi/" type urls
-            bits = pair[0].split('/', 7)
-            bits[-1] = utils.deplumpen(bits[-1])
-
-        elif pair[0].lower().startswith('/content/elife/'):
-            # handles valid but unsupported /content/elife/volume/id paths
-            # these paths appear in PDF files I've been told
-            bits = pair[0].split('/', 4)
-            
-        else:
-            # handles standard /content/volume/id/ paths
-            bits = pair[0].split('/', 3)
-        
-        art = bits[-1]
-        art = art.lower() # website isn't case sensitive, we are
-        more_bits = re.split(SPLITTER, art, maxsplit=1)
-        
-        suffix = None
-        if len(more_bits) > 1:
-            art, suffix = more_bits
-        assert suffix in TYPE_MAP, "unknown suffix %r! received: %r split to %r" % (suffix, pair, more_bits)
-        return art, TYPE_MAP[suffix], int(pair[1])
-
-    except AssertionError, e:
+    match = PATH_RE.match(pair[0].lower()) # website isn't case sensitive, we are
+    early = match.group('early')
+    if early is None:
+        early = match.group('elife_early')
+    if early is None:
+        art, suffix = match.group('art', 'suffix')
+    else:
+        more_bits = SPLITTER.split(utils.deplumpen(early), maxsplit=1)
+        art, suffix = more_bits if len(more_bits) > 1 else (more_bits[0], None)
+    if suffix not in TYPE_MAP:
         # we have an unhandled path
-        #LOG.warn("skpping unhandled path %s (%r)", pair, e)
         LOG.warn("skpping unhandled path %s", pair)
+        return
+    return art, TYPE_MAP[suffix], int(pair[1])
+
+# each article's counts are accumulated in a list with a slot for each type of view
+SLOTS = {'full': 0, 'abstract': 1, 'digest': 2}
 
-def group_results(triplet_list):    
-    # for each path, build a list of path_type: value
-    article_groups = {}
+def group_results(triplet_list):
+    """sums the counts of each type of view for each article.
+    every article always has a count for every type of view"""
+    article_slots = {}
     for art, art_type, count in triplet_list:
-        zeroed_row = Counter({
-            'full': 0,
-            'abstract': 0,
-            'digest': 0,
-        })
-        group = article_groups.get(art, [zeroed_row]) # every article always has a zeroed result 
-        group.append(Counter({art_type: count}))
-        article_groups[art] = group
-
-    # take our list of Counter objects and count them up
-    def update(a,b):
-        # https://docs.python.org/2/library/collections.html#collections.Counter.update
-        a.update(b)
-        return a
-
-    return {utils.enplumpen(art): reduce(update, group) for art, group in article_groups.items()}
+        slots = article_slots.get(art)
+        if slots is None:
+            slots = article_slots[art] = [0, 0, 0]
+        slots[SLOTS[art_type]] += count
+    return {utils.enplumpen(art): Counter(full=full, abstract=abstract, digest=digest) \
+            for art, (full, abstract, digest) in article_slots.iteritems()}
 
 def path_counts(path_count_pairs):
     """takes raw path data from GA and groups by article, returning a
     list of (artid, full-count, abstract-count, digest-count)"""
-    return group_results(filter(None, map(path_count, path_count_pairs)))
+    return group_results(ifilter(None, imap(path_count, path_count_pairs)))
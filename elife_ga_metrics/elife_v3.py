@@ -13,6 +13,7 @@ import elife_v1
 # these seemingly unused imports are actually used
 from elife_ga_metrics.elife_v1 import event_counts, event_counts_query, group_results
 import re
+from itertools import imap, ifilter
 import logging
 
 logging.basicConfig()
@@ -61,4 +62,4 @@ def path_count(pair):
     return data['artid'], TYPE_MAP[data['type']], int(count)
 
 def path_counts(path_count_pairs):
-    return group_results(filter(None, map(path_count, path_count_pairs)))
+    return group_results(ifilter(None, imap(path_count, path_count_pairs)))
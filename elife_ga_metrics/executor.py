@@ -0,0 +1,103 @@
+__description__ = """Concurrent execution of GA queries, within GA's quotas."""
+
+# Core Reporting API limits:
+# https://developers.google.com/analytics/devguides/reporting/core/v3/limits-quotas
+
+import time, threading, multiprocessing
+from datetime import date
+from multiprocessing.pool import ThreadPool
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+QUERIES_PER_SECOND = 10 # per IP address
+QUERIES_PER_DAY = 50000 # per project
+MAX_WORKERS = 10 # concurrent requests per view
+MAX_PROCESSES = multiprocessing.cpu_count() # for work bound by cpu rather than GA
+
+# when rate limited, the shared rate is halved but never drops below this fraction of the max
+MAX_SLOWDOWN = 8
+# queries-per-second regained with every successful query after being rate limited
+RECOVERY_STEP = 0.1
+
+class RateLimiter(object):
+    """a token bucket shared by all workers. tokens trickle in at the
+    per-second rate and each query costs one. when any worker is
+    rate limited *every* worker is paused and the rate is reduced."""
+
+    def __init__(self, per_second=QUERIES_PER_SECOND, per_day=QUERIES_PER_DAY, clock=time.time, sleep=time.sleep):
+        self.max_rate = self.rate = float(per_second)
+        self.capacity = self.tokens = float(per_second) # allow a burst of one second's worth
+        self.per_day = per_day
+        self.clock, self.sleep = clock, sleep
+        self.last = clock()
+        self.paused_until = 0
+        self.day, self.day_count = None, 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        "blocks until a query can be made"
+        while True:
+            with self.lock:
+                now = self.clock()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    today = date.fromtimestamp(now)
+                    if today != self.day:
+                        self.day, self.day_count = today, 0
+                    if self.day_count >= self.per_day:
+                        raise AssertionError("daily quota of %s queries exhausted" % self.per_day)
+                    self._refill(now)
+                    if self.tokens >= 1 - 1e-9: # floating point rounding
+                        self.tokens = max(0, self.tokens - 1)
+                        self.day_count += 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def backoff(self, seconds):
+        "pauses all workers for the given number of seconds and slows down the rate queries are made"
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+            self.rate = max(self.max_rate / MAX_SLOWDOWN, self.rate / 2)
+            # no burst of queries once the pause is over
+            self.tokens, self.last = 0, self.paused_until
+        LOG.info("all workers paused for %.2fs, rate reduced to %.2f queries/sec", seconds, self.rate)
+
+    def success(self):
+        "a query succeeded, recover some of the rate lost to any backoffs"
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + RECOVERY_STEP)
+
+def pmap(fn, item_list, workers=1):
+    """like `map` but spreads the work across a pool of threads.
+    results are returned in the same order as the given items."""
+    item_list = list(item_list)
+    if workers < 2 or len(item_list) < 2:
+        return map(fn, item_list)
+    pool = ThreadPool(min(workers, len(item_list)))
+    try:
+        return pool.map(fn, item_list, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def process_map(fn, item_list, processes=1, initializer=None):
+    """like `pmap` but spreads the work across a pool of processes. `fn`
+    and the items must be picklable, so `fn` must be a module-level function.
+    `initializer` is called in each new process."""
+    item_list = list(item_list)
+    if processes < 2 or len(item_list) < 2:
+        return map(fn, item_list)
+    pool = multiprocessing.Pool(min(processes, len(item_list)), initializer)
+    try:
+        return pool.map(fn, item_list, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
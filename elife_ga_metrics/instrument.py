@@ -0,0 +1,165 @@
+__description__ = """Opt-in counters and timings of each stage of querying GA and parsing it's results.
+
+set GA_INSTRUMENT to record them. a summary is written as json when the process exits,
+to the path in GA_INSTRUMENT_OUTPUT or, if that isn't set, logged as a single line.
+set GA_PROFILE to a path to also profile `bulk.metrics_for_range` with cProfile.
+
+    GA_INSTRUMENT=1 GA_INSTRUMENT_OUTPUT=instrument.json GA_PROFILE=metrics.pstats ./run-bulk.sh
+    python -m pstats metrics.pstats
+"""
+
+import os, json, time, bisect, atexit, threading
+import cProfile, pstats
+from collections import Counter
+from contextlib import contextmanager
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+# the upper bounds, in seconds, of the buckets timings are counted in
+BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+
+ENABLED = bool(os.environ.get('GA_INSTRUMENT'))
+
+_LOCK = threading.Lock()
+_COUNTERS = Counter()
+_HISTOGRAMS = {}
+_STARTED = time.time()
+# profiles written to during this run. the first profile overwrites the file, the rest are added to it
+_PROFILED = set()
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+def key(name, labels):
+    "ll: 'parse{module=elife_v3,parser=path_counts}'"
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s=%s' % pair for pair in sorted(labels.items())))
+
+def incr(name, n=1, **labels):
+    "adds `n` to the named counter"
+    if not ENABLED:
+        return
+    with _LOCK:
+        _COUNTERS[key(name, labels)] += n
+
+def new_histogram():
+    return {'count': 0, 'sum': 0.0, 'min': None, 'max': None, 'buckets': [0] * (len(BUCKETS) + 1)}
+
+def observe(name, seconds, **labels):
+    "records a timing in the named histogram"
+    if not ENABLED:
+        return
+    with _LOCK:
+        hist = _HISTOGRAMS.setdefault(key(name, labels), new_histogram())
+        hist['count'] += 1
+        hist['sum'] += seconds
+        hist['min'] = seconds if hist['min'] is None else min(hist['min'], seconds)
+        hist['max'] = seconds if hist['max'] is None else max(hist['max'], seconds)
+        hist['buckets'][bisect.bisect_left(BUCKETS, seconds)] += 1
+
+@contextmanager
+def timer(name, **labels):
+    "records how long the block takes in the named histogram, whether it succeeds or not"
+    if not ENABLED:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, **labels)
+
+def snapshot():
+    "a copy of everything recorded so far that can be pickled and `merge`d elsewhere"
+    with _LOCK:
+        return {'counters': dict(_COUNTERS),
+                'histograms': {k: dict(hist, buckets=list(hist['buckets'])) for k, hist in _HISTOGRAMS.items()}}
+
+def reset():
+    with _LOCK:
+        _COUNTERS.clear()
+        _HISTOGRAMS.clear()
+
+def collect():
+    "returns a `snapshot` and resets, so nothing is counted twice. None if instrumentation is disabled"
+    if not ENABLED:
+        return None
+    with _LOCK:
+        data = {'counters': dict(_COUNTERS), 'histograms': dict(_HISTOGRAMS)}
+        _COUNTERS.clear()
+        _HISTOGRAMS.clear()
+    return data
+
+def merge(data):
+    "adds a `snapshot` taken elsewhere, usually another process, to what has been recorded here"
+    if not data:
+        return
+    with _LOCK:
+        _COUNTERS.update(data['counters'])
+        for k, other in data['histograms'].items():
+            hist = _HISTOGRAMS.setdefault(k, new_histogram())
+            hist['count'] += other['count']
+            hist['sum'] += other['sum']
+            hist['min'] = min(x for x in [hist['min'], other['min']] if x is not None)
+            hist['max'] = max(hist['max'], other['max'])
+            hist['buckets'] = [a + b for a, b in zip(hist['buckets'], other['buckets'])]
+
+def bucket_label(i):
+    "ll: '<=0.05'"
+    return '<=%s' % BUCKETS[i] if i < len(BUCKETS) else '>%s' % BUCKETS[-1]
+
+def summary():
+    """ll: {'elapsed': 81.2, 'counters': {'parse.cache{hit=false,module=elife_v3,parser=path_counts}': 31, ...},
+            'histograms': {'ga.query{type=views}': {'count': 31, 'sum': 40.1, 'mean': 1.29, 'min': 0.4, 'max': 6.2,
+                                                    'buckets': {'<=0.5': 3, '<=1': 12, ...}}, ...}}"""
+    data = snapshot()
+    histograms = {}
+    for k, hist in data['histograms'].items():
+        buckets = {bucket_label(i): n for i, n in enumerate(hist['buckets']) if n}
+        mean = hist['sum'] / hist['count'] if hist['count'] else None
+        histograms[k] = dict(hist, mean=mean, buckets=buckets)
+    return {'pid': os.getpid(), 'elapsed': round(time.time() - _STARTED, 3),
+            'counters': data['counters'], 'histograms': histograms}
+
+def report(path=None):
+    "writes the `summary` as json to the given path or GA_INSTRUMENT_OUTPUT, otherwise logs it"
+    path = path or os.environ.get('GA_INSTRUMENT_OUTPUT')
+    if path:
+        with open(path, 'w') as fh:
+            json.dump(summary(), fh, indent=4, sort_keys=True)
+        LOG.info("wrote instrumentation summary %r", path)
+    else:
+        LOG.info("instrumentation summary: %s", json.dumps(summary(), sort_keys=True))
+
+@contextmanager
+def profiled(path):
+    """profiles the block with cProfile, writing the stats to the given path.
+    only the current process is profiled. nothing is done if no path is given"""
+    if not path:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        stats = pstats.Stats(profile)
+        if path in _PROFILED:
+            stats.add(path)
+        stats.dump_stats(path)
+        _PROFILED.add(path)
+        LOG.info("wrote profile %r", path)
+
+if ENABLED:
+    # pooled processes exit without calling these, their stats are collected by their parent
+    atexit.register(report)
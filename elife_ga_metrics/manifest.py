@@ -0,0 +1,353 @@
+__description__ = """A persistent index of the results cached in the output directory."""
+
+# the manifest is a snapshot of every cached result plus a journal of changes made since.
+# each change is a single line appended to the journal. the journal is folded into a new
+# snapshot every so often. before recording a change, the changes other processes have
+# journaled since are applied. if a results directory changes without the manifest being
+# told (a `git pull`, a file deleted by hand) the directory is scanned again when synced.
+# results changed in place leave their directory untouched and are only found by a scan.
+
+import os, json, time, fcntl, tempfile, threading
+from os.path import join
+from contextlib import contextmanager
+from datetime import datetime
+from elife_ga_metrics import core, elife_v1, elife_v2, elife_v3
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+# hidden, so they're not mistaken for results
+SNAPSHOT = '.manifest'
+JOURNAL = '.manifest.journal'
+LOCK = '.manifest.lock'
+
+RESULTS_TYPES = ['views', 'downloads']
+
+# fold the journal into the snapshot once it has this many changes
+COMPACT_AFTER = 500
+
+# seconds between checking the results directories for changes we weren't told about
+SYNC_INTERVAL = 1
+
+def query_module(results_type, from_date, to_date, filters):
+    """returns the name of the elife_v* module that builds a query with the given
+    filters for the given dates, preferring the module `module_picker` chooses"""
+    picked = core.module_picker(from_date, to_date)
+    for module in [picked, elife_v1, elife_v2, elife_v3]:
+        query = getattr(module, core.QUERY_FUNCS[results_type])('', from_date, to_date)
+        if query['filters'] == filters:
+            return module.__name__.split('.')[-1]
+
+def entry_for(path, response=None):
+    "returns a manifest entry for the results at the given path, reading them if not given"
+    results_type, from_date, to_date = core.parse_output_path(path)
+    if response is None:
+        response = core.read_results(path)
+    filters = response.get('query', {}).get('filters')
+    stat = os.stat(path)
+    return {
+        'type': results_type,
+        'from': core.ymd(from_date),
+        'to': core.ymd(to_date),
+        'partial': path.endswith('.partial'),
+        'filters': filters,
+        'module': query_module(results_type, from_date, to_date, filters),
+        'rows': len(response.get('rows', [])),
+        'clean': core.is_sanitized(response),
+        'compressed': core.is_compressed(path),
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+    }
+
+def is_results_file(filename):
+    return filename.endswith('.json') or filename.endswith('.json.partial')
+
+class Manifest(object):
+    def __init__(self, root):
+        self.root = root
+        self.entries = {} # ll: {'views/2016-01-01.json': {...}, ...}
+        self.dirs = {} # the mtime of each results directory the last time we knew what was in it
+        self.journal_length = 0
+        self.journal_offset = 0 # how far into the journal we've read, in bytes
+        self.snapshot_id = None # the snapshot we've read, see `snapshot_stamp`
+        self.last_sync = 0
+        self.lock = threading.RLock()
+        self.lock_depth = 0
+        self.load()
+
+    def key(self, path):
+        "ll: /path/to/output/views/2016-01-01.json => views/2016-01-01.json"
+        return os.path.relpath(path, self.root)
+
+    def tracks(self, path):
+        "returns True if the given path is somewhere the manifest keeps track of"
+        key = self.key(path)
+        return key.split(os.sep)[0] in RESULTS_TYPES and is_results_file(key)
+
+    @contextmanager
+    def locked(self):
+        "guards against other threads and other processes"
+        with self.lock:
+            if self.lock_depth:
+                # already held. flock-ing a second handle on the lock file would block on the first
+                self.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth -= 1
+                return
+            if not os.path.exists(self.root):
+                os.makedirs(self.root)
+            with open(join(self.root, LOCK), 'a') as fh:
+                fcntl.flock(fh, fcntl.LOCK_EX)
+                self.lock_depth = 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth = 0
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def dir_mtime(self, results_type):
+        path = join(self.root, results_type)
+        return os.path.getmtime(path) if os.path.exists(path) else None
+
+    def listing(self, results_type):
+        "returns the names of the results files actually in a results directory"
+        path = join(self.root, results_type)
+        return set(filter(is_results_file, os.listdir(path))) if os.path.exists(path) else set()
+
+    def current(self, path, entry):
+        "returns True if the results at the given path are still those the entry was made from"
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return (entry['mtime'], entry['size']) == (stat.st_mtime, stat.st_size)
+
+    def known(self, results_type):
+        "returns the names of the results files we think are in a results directory"
+        prefix = results_type + os.sep
+        return set(key[len(prefix):] for key in self.entries if key.startswith(prefix))
+
+    #
+    # reading
+    #
+
+    def snapshot_stamp(self):
+        "changes whenever another snapshot is written, and the journal emptied"
+        try:
+            stat = os.stat(join(self.root, SNAPSHOT))
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    def load(self):
+        with self.locked():
+            self.read()
+        self.sync(force=True)
+
+    def read(self):
+        "reads the snapshot and every change journaled since"
+        with self.locked():
+            self.entries, self.dirs, self.journal_length, self.journal_offset = {}, {}, 0, 0
+            self.snapshot_id = self.snapshot_stamp()
+            path = join(self.root, SNAPSHOT)
+            if os.path.exists(path):
+                with open(path, 'r') as fh:
+                    snapshot = json.load(fh)
+                self.entries, self.dirs = snapshot['entries'], snapshot['dirs']
+            self.read_journal()
+
+    def read_journal(self):
+        "applies the changes journaled since we last read it"
+        path = join(self.root, JOURNAL)
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as fh:
+            fh.seek(self.journal_offset)
+            content = fh.read()
+        # a change still being written is read next time
+        content = content[:content.rfind('\n') + 1]
+        for line in content.splitlines():
+            try:
+                self.apply(json.loads(line))
+            except ValueError:
+                # a change that never finished being written
+                LOG.warn("skipping bad line in manifest journal")
+            self.journal_length += 1
+        self.journal_offset += len(content)
+
+    def catch_up(self):
+        "applies the changes other processes have made since we last looked"
+        with self.locked():
+            if self.snapshot_stamp() != self.snapshot_id:
+                # compacted by another process
+                self.read()
+            else:
+                self.read_journal()
+
+    def apply(self, change):
+        if change['key'] is None:
+            # only records what is in a directory
+            pass
+        elif change['entry']:
+            self.entries[change['key']] = change['entry']
+        else:
+            self.entries.pop(change['key'], None)
+        self.dirs.update(change['dirs'])
+
+    def sync(self, force=False):
+        "scans any results directory that has changed since we last knew what was in it"
+        if not force and time.time() - self.last_sync < SYNC_INTERVAL:
+            return
+        self.last_sync = time.time()
+        for results_type in RESULTS_TYPES:
+            if self.dir_mtime(results_type) != self.dirs.get(results_type):
+                self.scan(results_type)
+
+    def scan(self, results_type):
+        """brings the entries for a results directory up to date with what is actually there.
+        what changed is journaled, the journal is compacted as usual"""
+        LOG.info("scanning %r results", results_type)
+        with self.locked():
+            self.catch_up()
+            results_dir = join(self.root, results_type)
+            mtime = self.dir_mtime(results_type)
+            found = self.listing(results_type)
+            prefix = results_type + os.sep
+            change_list = [{'key': prefix + filename, 'entry': None, 'dirs': {}}
+                           for filename in sorted(self.known(results_type) - found)]
+            for filename in sorted(found):
+                path = join(results_dir, filename)
+                entry = self.entries.get(prefix + filename)
+                if not entry or not self.current(path, entry):
+                    try:
+                        change_list.append({'key': prefix + filename, 'entry': entry_for(path), 'dirs': {}})
+                    except ValueError:
+                        # still being written by another process, which will record it
+                        LOG.warn("skipping unreadable results %r", path)
+            change_list.append({'key': None, 'entry': None, 'dirs': {results_type: mtime}})
+            for change in change_list:
+                self.apply(change)
+            self.journal(change_list)
+
+    def get(self, path):
+        "returns the entry for the given path or None if nothing is cached there"
+        self.sync()
+        return self.entries.get(self.key(path))
+
+    def exists(self, path):
+        return self.get(path) is not None
+
+    def items(self, results_type):
+        "yields a pair of (path, entry) for every results file of the given type, complete or partial"
+        self.sync()
+        prefix = results_type + os.sep
+        for key in sorted(self.entries):
+            if key.startswith(prefix):
+                yield join(self.root, key), self.entries[key]
+
+    def periods(self, results_type, partial=False):
+        """yields a triple of (path, from_date, to_date) for every period
+        of results of the given type, ordered by date"""
+        self.sync()
+        prefix = results_type + os.sep
+        for key in sorted(self.entries):
+            entry = self.entries[key]
+            if key.startswith(prefix) and entry['partial'] == partial:
+                yield join(self.root, key), \
+                  datetime.strptime(entry['from'], "%Y-%m-%d"), \
+                  datetime.strptime(entry['to'], "%Y-%m-%d")
+
+    #
+    # writing
+    #
+
+    def record(self, path, response=None):
+        "records the results at the given path, written by us"
+        self.change(path, entry_for(path, response))
+
+    def record_many(self, path_entry_list):
+        "records many results written by us at once, each a pair of (path, entry)"
+        self.change_many(path_entry_list)
+
+    def remove(self, path):
+        "records the results at the given path have been removed"
+        self.change(path, None)
+
+    def change(self, path, entry):
+        self.change_many([(path, entry)])
+
+    def change_many(self, path_entry_list):
+        if not path_entry_list:
+            return
+        with self.locked():
+            # we then know what every other process has recorded
+            self.catch_up()
+            change_list = [{'key': self.key(path), 'entry': entry, 'dirs': {}} for path, entry in path_entry_list]
+            for change in change_list:
+                self.apply(change)
+            # our changes have changed the directory's mtime. anything else that changed it without
+            # being recorded since we last synced is overlooked until the directory is scanned
+            for results_type in set(change['key'].split(os.sep)[0] for change in change_list):
+                self.dirs[results_type] = self.dir_mtime(results_type)
+            for change in change_list:
+                results_type = change['key'].split(os.sep)[0]
+                change['dirs'][results_type] = self.dirs[results_type]
+            self.journal(change_list)
+
+    def journal(self, change_list):
+        """appends the given changes to the journal, compacting it once it's long enough.
+        we must have caught up with the journal first"""
+        with self.locked():
+            with open(join(self.root, JOURNAL), 'a') as fh:
+                fh.write(''.join(json.dumps(change) + '\n' for change in change_list))
+                self.journal_offset = fh.tell()
+            self.journal_length += len(change_list)
+            if self.journal_length >= COMPACT_AFTER:
+                self.compact()
+
+    def compact(self):
+        "writes a new snapshot and empties the journal"
+        with self.locked():
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=SNAPSHOT + '-')
+            with os.fdopen(fd, 'w') as fh:
+                json.dump({'entries': self.entries, 'dirs': self.dirs}, fh)
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, join(self.root, SNAPSHOT))
+            open(join(self.root, JOURNAL), 'w').close()
+            self.journal_length, self.journal_offset = 0, 0
+            self.snapshot_id = self.snapshot_stamp()
+
+    def coverage(self):
+        "returns a summary of the results we have cached"
+        summary = {}
+        for key, entry in self.entries.items():
+            granularity = 'daily' if entry['from'] == entry['to'] else 'monthly'
+            stats = summary.setdefault(entry['type'], {}).setdefault(granularity, \
+                {'count': 0, 'partial': 0, 'rows': 0, 'from': entry['from'], 'to': entry['to']})
+            stats['count'] += 1
+            stats['partial'] += entry['partial']
+            stats['rows'] += entry['rows']
+            stats['from'] = min(stats['from'], entry['from'])
+            stats['to'] = max(stats['to'], entry['to'])
+        return summary
+
+_MANIFESTS = {}
+
+def get_manifest(sync=False):
+    """returns the manifest for the current output directory. operations
+    covering many periods should `sync` first to see any changes made
+    within the last `SYNC_INTERVAL` seconds"""
+    root = core.output_dir()
+    if root not in _MANIFESTS:
+        _MANIFESTS[root] = Manifest(root)
+    elif sync:
+        _MANIFESTS[root].sync(force=True)
+    return _MANIFESTS[root]
+
+if __name__ == '__main__':
+    # ll: python -m elife_ga_metrics.manifest
+    print json.dumps(get_manifest().coverage(), indent=4, sort_keys=True)
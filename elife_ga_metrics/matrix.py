@@ -0,0 +1,174 @@
+__description__ = """Article metrics as dense NumPy arrays, for analysis across long date ranges."""
+
+# numpy is optional, only this module needs it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from bisect import bisect_left, bisect_right
+from elife_ga_metrics import core, bulk, store, utils
+from elife_ga_metrics.utils import ymd
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+VIEW_TYPES = ['full', 'abstract', 'digest']
+VIEW_TYPE_IDX = {name: idx for idx, name in enumerate(VIEW_TYPES)}
+
+DTYPE = 'int32'
+
+def _requires_numpy():
+    assert np is not None, "numpy is required for this: pip install numpy"
+
+class Metrics(object):
+    """the views and downloads of every article over consecutive periods.
+    `views` has the shape (periods, articles, view types) and `downloads`
+    has the shape (periods, articles). `dois` maps each article column to
+    it's DOI and `doi_idx` maps each DOI back to it's column"""
+    def __init__(self, periods, dois, views, downloads):
+        self.periods = periods # ll: [('2016-01-01', '2016-01-01'), ('2016-01-02', '2016-01-02'), ...]
+        self.dois = dois
+        self.doi_idx = {doi: idx for idx, doi in enumerate(dois)}
+        self.views = views
+        self.downloads = downloads
+
+    def period_slice(self, from_date=None, to_date=None):
+        "returns a slice of the periods starting between the two given dates, inclusive"
+        starts = [from_str for from_str, _ in self.periods]
+        lo = bisect_left(starts, ymd(from_date)) if from_date else 0
+        hi = bisect_right(starts, ymd(to_date)) if to_date else len(starts)
+        return slice(lo, hi)
+
+    def data(self, results_type):
+        assert results_type in ['views', 'downloads'], "results type must be either 'views' or 'downloads'"
+        return self.views if results_type == 'views' else self.downloads
+
+    def totals(self, from_date=None, to_date=None):
+        """returns a pair of (views, downloads) summed over the periods between
+        the two given dates, with the shapes (articles, view types) and (articles,)"""
+        idx = self.period_slice(from_date, to_date)
+        return self.views[idx].sum(axis=0, dtype='int64'), self.downloads[idx].sum(axis=0, dtype='int64')
+
+    def rolling(self, window, results_type='views'):
+        """returns the sum over every run of `window` consecutive periods.
+        the first axis has one entry per run, ending with the last period"""
+        data = self.data(results_type)
+        assert 0 < window <= len(data), "window must be between 1 and the number of periods (%s)" % len(data)
+        cumulative = np.cumsum(data, axis=0, dtype='int64')
+        rolled = cumulative[window - 1:].copy()
+        rolled[1:] -= cumulative[:-window]
+        return rolled
+
+    def top(self, n, results_type='views', view_type='full', from_date=None, to_date=None):
+        """returns the `n` articles with the most views of the given type
+        (or downloads) between the two given dates as a list of (doi, count)"""
+        views, downloads = self.totals(from_date, to_date)
+        counts = views[:, VIEW_TYPE_IDX[view_type]] if results_type == 'views' else downloads
+        n = min(n, len(counts))
+        if not n:
+            return []
+        idx = np.argpartition(-counts, n - 1)[:n]
+        # most first, ties broken by DOI
+        idx = sorted(idx, key=lambda i: (-counts[i], self.dois[i]))
+        return [(self.dois[i], int(counts[i])) for i in idx]
+
+    def article(self, doi):
+        """returns a pair of (views, downloads) for a single article over every
+        period, with the shapes (periods, view types) and (periods,)"""
+        idx = self.doi_idx[doi]
+        return self.views[:, idx], self.downloads[:, idx]
+
+class Builder(object):
+    "accumulates the rows of each period as columns, then assembles them into `Metrics`"
+    def __init__(self, periods):
+        self.periods = periods
+        self.doi_idx = {}
+        self.columns = {'views': [], 'downloads': []}
+
+    def index(self, doi_list):
+        "returns the column of each of the given DOIs, adding those not seen before"
+        for doi in doi_list:
+            if doi not in self.doi_idx:
+                self.doi_idx[doi] = len(self.doi_idx)
+        return np.array([self.doi_idx[doi] for doi in doi_list], dtype='int64')
+
+    def add(self, period_idx, results_type, doi_col, type_col, count_col):
+        "adds the rows of a period, `doi_col` being the columns returned by `index`"
+        self.columns[results_type].append((np.full(len(doi_col), period_idx, dtype='int64'), doi_col, type_col, count_col))
+
+    def add_results(self, period_idx, results_type, results):
+        "adds the parsed results of a period"
+        rows = list(store.to_rows(results_type, results))
+        if rows:
+            dois, types, counts = zip(*rows)
+            self.add(period_idx, results_type, self.index(dois), np.array(types, dtype='int64'), np.array(counts, dtype=DTYPE))
+
+    def build(self):
+        columns = {results_type: [np.concatenate(col) for col in zip(*col_list)]
+                   for results_type, col_list in self.columns.items() if col_list}
+        # only articles with rows, a store file's DOIs include those of periods we haven't added.
+        # articles are ordered by DOI
+        names = sorted(self.doi_idx, key=self.doi_idx.get)
+        used = np.unique(np.concatenate([col[1] for col in columns.values()])) if columns else []
+        dois = sorted(names[idx] for idx in used)
+        rank = np.zeros(len(names), dtype='int64')
+        rank[[self.doi_idx[doi] for doi in dois]] = np.arange(len(dois))
+        views = np.zeros((len(self.periods), len(dois), len(VIEW_TYPES)), dtype=DTYPE)
+        downloads = np.zeros((len(self.periods), len(dois)), dtype=DTYPE)
+        for results_type, data in [('views', views), ('downloads', downloads)]:
+            if results_type not in columns:
+                continue
+            period_col, doi_col, type_col, count_col = columns[results_type]
+            if results_type == 'views':
+                data[period_col, rank[doi_col], type_col] = count_col
+            else:
+                data[period_col, rank[doi_col]] = count_col
+        return Metrics(self.periods, dois, views, downloads)
+
+def from_metrics(results):
+    "converts the results of `bulk.metrics_for_range` to `Metrics`"
+    _requires_numpy()
+    builder = Builder(sorted(results.keys()))
+    for period_idx, period in enumerate(builder.periods):
+        for results_type in ['views', 'downloads']:
+            builder.add_results(period_idx, results_type, results[period][results_type])
+    return builder.build()
+
+def load(dt_range_list):
+    """returns `Metrics` for the given periods from the cached results. periods
+    in the store are read straight into arrays, without being parsed into dicts.
+    periods with no cached results are all zeroes"""
+    _requires_numpy()
+    dt_range_list = sorted(dt_range_list)
+    builder = Builder([(ymd(from_date), ymd(to_date)) for from_date, to_date in dt_range_list])
+    # each store file's DOI dictionary as our columns, shared by all periods in the file
+    lookups = {}
+    for period_idx, (from_date, to_date) in enumerate(dt_range_list):
+        module = core.module_picker(from_date, to_date)
+        for results_type, valid in [('views', core.valid_view_dt_pair), ('downloads', core.valid_downloads_dt_pair)]:
+            if not valid((from_date, to_date)):
+                continue
+            found = store.find(results_type, from_date, to_date, module)
+            if found:
+                store_file, key = found
+                if lookups.get(store_file.path, (None,))[0] is not store_file:
+                    lookups[store_file.path] = (store_file, builder.index(store_file.dois))
+                cols = store_file.period_columns(key)
+                builder.add(period_idx, results_type, lookups[store_file.path][1][np.frombuffer(cols['doi'], dtype='I')],
+                            np.frombuffer(cols['type'], dtype='B'), np.frombuffer(cols['count'], dtype='I'))
+            else:
+                builder.add_results(period_idx, results_type, core.cached_results(results_type, from_date, to_date, module) or {})
+    return builder.build()
+
+def daily_metrics_between(table_id, from_date, to_date, use_cached=True, use_only_cached=False):
+    "like `bulk.daily_metrics_between` but returns `Metrics`"
+    _requires_numpy()
+    return load(bulk.fetch_metrics(table_id, utils.dt_range(from_date, to_date), use_cached, use_only_cached))
+
+def monthly_metrics_between(table_id, from_date, to_date, use_cached=True, use_only_cached=False):
+    "like `bulk.monthly_metrics_between` but returns `Metrics`"
+    _requires_numpy()
+    return load(bulk.fetch_metrics(table_id, utils.dt_month_range(from_date, to_date), use_cached, use_only_cached))
@@ -0,0 +1,102 @@
+__description__ = """Caches the results of parsing raw GA responses so they are only parsed once."""
+
+import os, hashlib, inspect, tempfile
+import cPickle as pickle
+from elife_ga_metrics import utils, instrument
+import elife_v1
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+# ll: output/views/2016-01-01.json.parsed
+PARSED_SUFFIX = '.parsed'
+
+# the code and patterns parsing depends on, a change to anything else in these modules
+# (a query, a date helper) doesn't change what is parsed. each parser module and elife_v1,
+# whose parsing code they share, are fingerprinted by `PARSER_NAMES`, utils by `UTILS_NAMES`
+PARSER_NAMES = ['path_count', 'path_counts', 'event_counts', 'group_results',
+                'TYPE_MAP', 'SPLITTER', 'PATH_RE', 'SLOTS']
+UTILS_NAMES = ['iter_rows', 'open_results', 'GZIP_MAGIC', 'ROWS_RE', 'WHITESPACE', 'deplumpen', 'enplumpen']
+
+_VERSIONS = {}
+
+def fingerprint(obj):
+    "ll: the source of a function, the pattern of a regular expression or the repr of anything else"
+    if inspect.isfunction(obj):
+        return inspect.getsource(obj)
+    if hasattr(obj, 'pattern'):
+        return "%r:%r" % (obj.pattern, obj.flags)
+    return repr(obj)
+
+def parser_version(module):
+    """returns a fingerprint of the code the given parser module parses with, see
+    `PARSER_NAMES`. every parser shares code with elife_v1 and utils, so a change
+    to what's used of them changes it too"""
+    if module not in _VERSIONS:
+        digest = hashlib.md5()
+        for mod, names in [(module, PARSER_NAMES), (elife_v1, PARSER_NAMES), (utils, UTILS_NAMES)]:
+            for name in names:
+                if hasattr(mod, name):
+                    digest.update("%s.%s=%s" % (mod.__name__, name, fingerprint(getattr(mod, name))))
+        _VERSIONS[module] = "%s:%s" % (module.__name__, digest.hexdigest())
+    return _VERSIONS[module]
+
+def cache_key(path, module, parser_name):
+    "parsed results are valid for as long as the raw file and the code parsing it stay the same"
+    stat = os.stat(path)
+    return (stat.st_mtime, stat.st_size, parser_version(module), parser_name)
+
+def read(parsed_path, key):
+    "returns the parsed results at the given path or None if they're missing or stale"
+    try:
+        with open(parsed_path, 'rb') as fh:
+            # the key is pickled separately so stale results are never decoded
+            if pickle.load(fh) == key:
+                return pickle.load(fh)
+    except Exception:
+        # missing or corrupt, either way the raw results need parsing
+        pass
+
+def write(parsed_path, key, results):
+    "writes the parsed results atomically. failing to write them isn't fatal"
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(parsed_path), prefix='.parsed-')
+    except (IOError, OSError), e:
+        LOG.warn("failed to cache parsed results %r: %s", parsed_path, e)
+        return
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump(key, fh, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(results, fh, pickle.HIGHEST_PROTOCOL)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, parsed_path)
+    except (IOError, OSError), e:
+        LOG.warn("failed to cache parsed results %r: %s", parsed_path, e)
+        os.unlink(tmp_path)
+
+def parse(path, module, parser_name):
+    """returns the results of `module.parser_name` applied to the rows of the
+    raw GA response at `path`, parsing the raw response only if it or the
+    parser has changed since it was last parsed"""
+    key = cache_key(path, module, parser_name)
+    parsed_path = path + PARSED_SUFFIX
+    labels = {'module': module.__name__.split('.')[-1], 'parser': parser_name}
+    with instrument.timer('parse.cache_read', **labels):
+        results = read(parsed_path, key)
+    instrument.incr('parse.cache', hit=results is not None, **labels)
+    if results is None:
+        LOG.debug("parsing %r", path)
+        parser = getattr(module, parser_name)
+        if instrument.ENABLED:
+            # rows are read before they're parsed, so decoding and parsing are timed separately
+            with instrument.timer('parse.decode', **labels):
+                rows = list(utils.iter_rows(path))
+            with instrument.timer('parse.parse', **labels):
+                results = parser(rows)
+        else:
+            results = parser(utils.iter_rows(path))
+        with instrument.timer('parse.cache_write', **labels):
+            write(parsed_path, key, results)
+    return results
@@ -0,0 +1,137 @@
+__description__ = """Fetches the views and downloads of a period in a single round trip
+using the Analytics Reporting API (v4), whose `batchGet` accepts several report requests
+at once. Each report is converted back into the shape of a Core Reporting API (v3)
+response and cached like any other, so nothing reading the cache knows the difference."""
+
+# Analytics Reporting API v4, reports.batchGet:
+# https://developers.google.com/analytics/devguides/reporting/core/v4/rest/v4/reports/batchGet
+
+# ll: pair = reporting.period_queries(table_id, from_date, to_date)
+# ll: [(views_response, views_path), (downloads_response, downloads_path)] = reporting.query_ga_write_results(pair)
+
+from collections import OrderedDict
+from elife_ga_metrics import core, utils
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+# a batchGet request accepts at most this many report requests
+MAX_REPORTS = 5
+
+def period_queries(table_id, from_date, to_date):
+    "returns the v3 queries for every type of results there can be for the given period"
+    module = core.module_picker(from_date, to_date)
+    query_list = []
+    for results_type, valid in [('views', core.valid_view_dt_pair), ('downloads', core.valid_downloads_dt_pair)]:
+        if valid((from_date, to_date)):
+            query_list.append(getattr(module, core.QUERY_FUNCS[results_type])(table_id, from_date, to_date))
+    return query_list
+
+def group_queries(query_list):
+    """groups the given v3 queries into lists that can be fetched together. the report
+    requests of a batchGet must all be for the same view and the same dates"""
+    groups = OrderedDict()
+    for query_map in query_list:
+        groups.setdefault((query_map['ids'], query_map['start_date'], query_map['end_date']), []).append(query_map)
+    return sum([utils.chunks(group, MAX_REPORTS) for group in groups.values()], [])
+
+def split(val):
+    "v3 accepts comma separated lists of metrics, dimensions and sort orders. ll: ['ga:pageviews']"
+    return [bit for bit in val.split(',') if bit] if val else []
+
+def report_request(query_map):
+    "returns the v4 report request equivalent to the given v3 query"
+    request = {
+        'viewId': query_map['ids'][len('ga:'):] if query_map['ids'].startswith('ga:') else query_map['ids'],
+        'dateRanges': [{'startDate': query_map['start_date'], 'endDate': query_map['end_date']}],
+        'metrics': [{'expression': metric} for metric in split(query_map['metrics'])],
+        'dimensions': [{'name': dimension} for dimension in split(query_map.get('dimensions'))],
+        'orderBys': [{'fieldName': field.lstrip('-'), 'sortOrder': 'DESCENDING' if field.startswith('-') else 'ASCENDING'}
+                     for field in split(query_map.get('sort'))],
+        'pageSize': query_map.get('max_results', 10000),
+    }
+    if query_map.get('filters'):
+        # v4 accepts v3 filter expressions as they are
+        request['filtersExpression'] = query_map['filters']
+    return request
+
+def echoed_query(query_map):
+    "returns the query a v3 response echoes back for the given v3 query"
+    query = {
+        'ids': query_map['ids'],
+        'start-date': query_map['start_date'],
+        'end-date': query_map['end_date'],
+        'metrics': split(query_map['metrics']),
+        'start-index': 1,
+        'max-results': query_map.get('max_results', 10000),
+    }
+    for key in ['dimensions', 'filters']:
+        if query_map.get(key):
+            query[key] = query_map[key]
+    if query_map.get('sort'):
+        query['sort'] = split(query_map['sort'])
+    return query
+
+def to_v3(query_map, report_list):
+    """returns the v3 response equivalent to the given pages of a v4 report, ensuring
+    the number of rows matches the total GA says there should be"""
+    header = report_list[0]['columnHeader']
+    metric_headers = header['metricHeader']['metricHeaderEntries']
+    data = report_list[0]['data']
+    rows = []
+    for report in report_list:
+        for row in report['data'].get('rows', []):
+            rows.append(row.get('dimensions', []) + row['metrics'][0]['values'])
+    total = data.get('rowCount', 0)
+    if len(rows) != total:
+        raise AssertionError("expected %s rows of results, received %s" % (total, len(rows)))
+    totals = data['totals'][0]['values'] if data.get('totals') else []
+    response = {
+        'kind': 'analytics#gaData',
+        'query': echoed_query(query_map),
+        'columnHeaders': [{'name': name, 'columnType': 'DIMENSION', 'dataType': 'STRING'} for name in header.get('dimensions', [])] + \
+                         [{'name': entry['name'], 'columnType': 'METRIC', 'dataType': entry['type']} for entry in metric_headers],
+        'itemsPerPage': query_map.get('max_results', 10000),
+        'totalResults': total,
+        'totalsForAllResults': dict(zip([entry['name'] for entry in metric_headers], totals)),
+        'containsSampledData': 'samplesReadCounts' in data,
+    }
+    if rows:
+        response['rows'] = rows
+    return response
+
+def batch_get(request_list, num_attempts=5, limiter=None):
+    "executes the given report requests as a single batchGet, returning a report for each"
+    query = core.reporting_service().reports().batchGet(body={'reportRequests': request_list})
+    return core.query_ga(query, num_attempts, limiter)['reports']
+
+def query_ga(query_list, num_attempts=5, limiter=None):
+    """returns a v3 response for each of the given v3 queries, fetched together. reports
+    with more than a page of rows have their remaining pages fetched together too"""
+    assert len(group_queries(query_list)) == 1, \
+      "queries fetched together must be for the same view and dates, at most %s of them" % MAX_REPORTS
+    request_list = map(report_request, query_list)
+    pages = [[] for _ in query_list]
+    page_tokens = {}
+    pending = range(len(query_list))
+    while pending:
+        LOG.info("querying %s reports for %s to %s ...", len(pending), query_list[0]['start_date'], query_list[0]['end_date'])
+        report_list = batch_get([dict(request_list[i], pageToken=page_tokens[i]) if i in page_tokens else request_list[i]
+                                 for i in pending], num_attempts, limiter)
+        assert len(report_list) == len(pending), "expected %s reports, received %s" % (len(pending), len(report_list))
+        next_pending = []
+        for i, report in zip(pending, report_list):
+            pages[i].append(report)
+            if report.get('nextPageToken'):
+                page_tokens[i] = report['nextPageToken']
+                next_pending.append(i)
+        pending = next_pending
+    return [to_v3(query_map, page_list) for query_map, page_list in zip(query_list, pages)]
+
+def query_ga_write_results(query_list, num_attempts=5, limiter=None):
+    """convenience. queries GA for each of the given v3 queries together, then writes the
+    results where v3 results would be written, returning a pair of (response, path) for each"""
+    return [(response, core.write_results(response, core.output_path_from_results(response)))
+            for response in query_ga(query_list, num_attempts, limiter)]
@@ -0,0 +1,191 @@
+__description__ = """When and how long to wait before retrying a failed GA query."""
+
+# Core Reporting API errors:
+# https://developers.google.com/analytics/devguides/reporting/core/v3/errors
+
+import json, time, random, threading
+from collections import Counter
+from datetime import datetime, timedelta
+from elife_ga_metrics import instrument
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+# what to do about a failed query
+RETRY = 'retry' # wait and try again
+QUOTA = 'quota' # the daily quota is exhausted, nothing will succeed until it resets
+FATAL = 'fatal' # trying again won't help. permissions, bad queries, etc
+
+RETRY_REASONS = ['userRateLimitExceeded', 'rateLimitExceeded', 'quotaExceeded', 'backendError', 'internalServerError']
+QUOTA_REASONS = ['dailyLimitExceeded']
+# errors without a reason we recognise are retried if they have one of these statuses
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# the daily quota resets at midnight Pacific time. daylight saving is ignored,
+# so for half the year we wait an hour longer than necessary
+QUOTA_RESET_OFFSET = timedelta(hours=-8)
+
+class RetriesExhausted(AssertionError):
+    pass
+
+class QuotaExhausted(AssertionError):
+    pass
+
+def error_reason(error):
+    "returns the reason GA gave for the given `HttpError`. ll: 'userRateLimitExceeded'"
+    try:
+        data = json.loads(error.content)
+    except (TypeError, ValueError):
+        return None
+    err = data.get('error') if isinstance(data, dict) else None
+    if isinstance(err, dict):
+        for item in err.get('errors') or []:
+            if isinstance(item, dict) and item.get('reason'):
+                return item['reason']
+    return None
+
+def retry_after(error):
+    "returns the seconds the `Retry-After` header of the given `HttpError` asks us to wait, if any"
+    headers = error.resp if hasattr(error.resp, 'get') else {}
+    try:
+        return max(0, float(headers.get('retry-after')))
+    except (TypeError, ValueError):
+        return None
+
+def classify(error):
+    "returns one of RETRY, QUOTA or FATAL for the given `HttpError`"
+    reason = error_reason(error)
+    if reason in QUOTA_REASONS:
+        return QUOTA
+    if reason in RETRY_REASONS:
+        return RETRY
+    if error.resp.status in RETRY_STATUSES:
+        return RETRY
+    return FATAL
+
+def next_quota_reset(now):
+    "returns the timestamp the daily quota next resets at after the given timestamp"
+    pacific = datetime.utcfromtimestamp(now) + QUOTA_RESET_OFFSET
+    midnight = datetime(pacific.year, pacific.month, pacific.day) + timedelta(days=1)
+    return now + (midnight - pacific).total_seconds()
+
+class CircuitBreaker(object):
+    """shared by all workers. opened when GA tells any of them the daily quota
+    is exhausted, after which every query fails immediately until the quota resets"""
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        with self.lock:
+            return self.clock() < self.open_until
+
+    def check(self):
+        "raises a `QuotaExhausted` error if the breaker is open"
+        with self.lock:
+            if self.clock() < self.open_until:
+                raise QuotaExhausted("daily quota exhausted, not querying until %s" % datetime.fromtimestamp(self.open_until))
+
+    def trip(self, until=None):
+        "opens the breaker until the given timestamp, by default when the daily quota resets"
+        with self.lock:
+            self.open_until = until or next_quota_reset(self.clock())
+        LOG.warn("daily quota exhausted, all queries stopped until %s", datetime.fromtimestamp(self.open_until))
+
+    def reset(self):
+        with self.lock:
+            self.open_until = 0
+
+class Stats(object):
+    "counts what happened to queries and how long was spent waiting to retry them"
+    def __init__(self):
+        self.counts = Counter()
+        self.wait_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def waited(self, seconds):
+        with self.lock:
+            self.counts['waits'] += 1
+            self.wait_seconds += seconds
+
+    def summary(self):
+        "ll: {'queries': 20, 'attempts': 23, 'retry:backendError': 3, 'waits': 3, 'wait_seconds': 4.1}"
+        with self.lock:
+            return dict(self.counts, wait_seconds=round(self.wait_seconds, 3))
+
+# shared by every policy not given their own
+BREAKER = CircuitBreaker()
+STATS = Stats()
+
+class RetryPolicy(object):
+    """executes a query, retrying it when GA says it might succeed later. waits grow
+    exponentially with 'full jitter', a random wait of up to `base * 2**attempt` seconds
+    capped at `cap`, unless GA asks for longer with a `Retry-After` header"""
+    def __init__(self, num_attempts=5, base=1, cap=64, breaker=None, stats=None, sleep=None, rand=random.random):
+        self.num_attempts = num_attempts
+        self.base = base
+        self.cap = cap
+        self.breaker = breaker or BREAKER
+        self.stats = stats or STATS
+        self.sleep = sleep or time.sleep
+        self.rand = rand
+
+    def delay(self, attempt, error=None):
+        "returns the seconds to wait after the given (zero-based) failed attempt"
+        seconds = self.rand() * min(self.cap, self.base * 2 ** attempt)
+        requested = retry_after(error) if error is not None else None
+        return max(seconds, requested or 0)
+
+    def execute(self, query, limiter=None):
+        """executes the query, returning the response. if an `executor.RateLimiter` is
+        given, queries wait their turn and waits pause all workers sharing it"""
+        from googleapiclient import errors
+        self.stats.add('queries')
+        for attempt in range(self.num_attempts):
+            self.breaker.check()
+            if attempt > 0:
+                LOG.info("query attempt %r", attempt + 1)
+            else:
+                LOG.info("querying ...")
+            if limiter:
+                limiter.acquire()
+            self.stats.add('attempts')
+            try:
+                with instrument.timer('ga.request'):
+                    response = query.execute()
+                if limiter:
+                    limiter.success()
+                return response
+
+            except errors.HttpError, e:
+                reason = error_reason(e) or e.resp.status
+                action = classify(e)
+                self.stats.add('%s:%s' % (action, reason))
+                instrument.incr('ga.error', action=action, reason=reason)
+                if action == QUOTA:
+                    self.breaker.trip()
+                    raise QuotaExhausted("daily quota exhausted (%s)" % reason)
+                if action == FATAL:
+                    LOG.error("query failed, not retrying: %s", e)
+                    raise
+                if attempt + 1 == self.num_attempts:
+                    break
+                seconds = self.delay(attempt, e)
+                self.stats.waited(seconds)
+                instrument.observe('ga.backoff', seconds)
+                if limiter:
+                    LOG.info("%s. backing off all workers %.2fs", reason, seconds)
+                    limiter.backoff(seconds)
+                else:
+                    LOG.info("%s. backing off %.2fs", reason, seconds)
+                    self.sleep(seconds)
+
+        self.stats.add('gave up')
+        raise RetriesExhausted("Failed to execute query after %s attempts" % self.num_attempts)
@@ -0,0 +1,313 @@
+__description__ = """Weekly, monthly, yearly and all-time article totals, summed from the cached daily results."""
+
+# ll: python -m elife_ga_metrics.rollup
+#
+# file layout:
+#
+#   output/rollup/views/weekly/2016-W22.pickle
+#   output/rollup/views/monthly/2016-06.pickle
+#   output/rollup/views/yearly/2016.pickle
+#   output/rollup/views/total.pickle
+#   output/rollup/views/.sources
+#
+# each bucket is the sum of the daily results within it. `.sources` records the daily results
+# each type was last built from, so a rebuild only sums again the buckets whose days have changed.
+# the daily results remain the canonical data, the rollups can always be rebuilt from them.
+
+import os, sys, shutil
+import cPickle as pickle
+from os.path import join
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from elife_ga_metrics import core, parsecache
+from elife_ga_metrics.utils import ymd, month_min_max
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+ROLLUP_SUBDIR = 'rollup'
+RESULTS_TYPES = ['views', 'downloads']
+GRANULARITIES = ['weekly', 'monthly', 'yearly']
+VIEW_TYPES = ('full', 'abstract', 'digest')
+
+SOURCES = '.sources'
+
+def rollup_dir(results_type):
+    return join(core.output_dir(), ROLLUP_SUBDIR, results_type)
+
+def bucket_path(results_type, granularity, key):
+    "ll: output/rollup/views/monthly/2016-06.pickle"
+    return join(rollup_dir(results_type), granularity, key + '.pickle')
+
+def total_path(results_type):
+    return join(rollup_dir(results_type), 'total.pickle')
+
+def bucket(granularity, dt):
+    """returns the key of the bucket the given day falls in. weeks are ISO weeks, starting on a monday.
+    ll: '2016-W22', '2016-06' or '2016'"""
+    if granularity == 'weekly':
+        year, week, _ = dt.isocalendar()
+        return "%s-W%02d" % (year, week)
+    if granularity == 'monthly':
+        return dt.strftime('%Y-%m')
+    return dt.strftime('%Y')
+
+def bucket_bounds(granularity, key):
+    "returns the first and last day of the given bucket. ll: (datetime(2016, 5, 30), datetime(2016, 6, 5))"
+    if granularity == 'weekly':
+        year, week = key.split('-W')
+        # the 4th of january is always in the first ISO week of it's year
+        jan4 = datetime(int(year), 1, 4)
+        monday = jan4 - timedelta(days=jan4.weekday()) + timedelta(weeks=int(week) - 1)
+        return monday, monday + timedelta(days=6)
+    if granularity == 'monthly':
+        return month_min_max(datetime.strptime(key, '%Y-%m'))
+    return datetime(int(key), 1, 1), datetime(int(key), 12, 31)
+
+#
+# reading and writing
+#
+
+def read_pickle(path):
+    with open(path, 'rb') as fh:
+        return pickle.load(fh)
+
+def write_pickle(path, data):
+    core.write_file(path, pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+def _pack(results_type, results):
+    "the rollups keep views as tuples, a Counter costs several times as much to store and load"
+    if results_type == 'downloads':
+        return results
+    return {doi: tuple(val[view_type] for view_type in VIEW_TYPES) for doi, val in results.iteritems()}
+
+def _unpack(results_type, counts):
+    "ll: {'10.7554/eLife.09560': Counter({'full': 12, 'abstract': 3, 'digest': 0})}"
+    if results_type == 'downloads':
+        return counts
+    results = {}
+    for doi, val in counts.iteritems():
+        # dict.update skips Counter.update, which is slow
+        results[doi] = counter = Counter()
+        dict.update(counter, zip(VIEW_TYPES, val))
+    return results
+
+def _merge(counts, other):
+    "adds one set of packed counts to another"
+    for doi, val in other.iteritems():
+        total = counts.get(doi)
+        if total is None:
+            counts[doi] = val
+        elif isinstance(val, tuple):
+            counts[doi] = tuple(a + b for a, b in zip(total, val))
+        else:
+            counts[doi] = total + val
+
+def read_bucket(results_type, granularity, key):
+    """returns the bucket with the given key or None if there are no daily results within it.
+    ll: {'from': '2016-06-01', 'to': '2016-06-30', 'days': 30, 'counts': {...}}"""
+    path = bucket_path(results_type, granularity, key)
+    if os.path.exists(path):
+        return read_pickle(path)
+
+def buckets(results_type, granularity):
+    "returns the keys of every bucket of the given type and granularity, ordered by date"
+    path = join(rollup_dir(results_type), granularity)
+    if not os.path.exists(path):
+        return []
+    return sorted(filename[:-len('.pickle')] for filename in os.listdir(path) if filename.endswith('.pickle'))
+
+#
+# building
+#
+
+def daily_sources(results_type):
+    """returns a map of each day with complete results to what those results were parsed from.
+    the rollups of a day are stale if it's raw results or the code parsing them change.
+    ll: {'2016-06-01': (1466000000.0, 35210, 'elife_ga_metrics.elife_v3:ab12...')}"""
+    manifest = core.cache_manifest(sync=True)
+    source_map = {}
+    for path, from_date, to_date in manifest.periods(results_type):
+        if from_date == to_date:
+            entry = manifest.get(path)
+            module = core.module_picker(from_date, to_date)
+            source_map[ymd(from_date)] = (entry['mtime'], entry['size'], parsecache.parser_version(module))
+    return source_map
+
+def dirty_buckets(source_map, previous):
+    "returns the keys of the buckets of each granularity containing days that have changed since last time"
+    changed = [day for day in set(source_map) | set(previous) if source_map.get(day) != previous.get(day)]
+    dirty = {granularity: set() for granularity in GRANULARITIES}
+    for day in changed:
+        dt = datetime.strptime(day, '%Y-%m-%d')
+        for granularity in GRANULARITIES:
+            dirty[granularity].add(bucket(granularity, dt))
+    return dirty
+
+def write_bucket(results_type, granularity, key, days, counts):
+    "writes a bucket, or removes it if there are no daily results within it"
+    path = bucket_path(results_type, granularity, key)
+    if not days:
+        if os.path.exists(path):
+            os.unlink(path)
+        return
+    from_date, to_date = bucket_bounds(granularity, key)
+    write_pickle(path, {'from': ymd(from_date), 'to': ymd(to_date), 'days': days, 'counts': counts})
+
+def build_daily_buckets(results_type, source_map, dirty):
+    """sums the dirty weekly and monthly buckets from the daily results. the days are
+    read in order and each is parsed once, adding it to it's week and month as needed"""
+    granularity_list = ['weekly', 'monthly']
+    remaining = {granularity: set(dirty[granularity]) for granularity in granularity_list}
+    open_buckets = {} # granularity => (key, days, counts)
+    for day in sorted(source_map) + [None]:
+        dt = datetime.strptime(day, '%Y-%m-%d') if day else None
+        results = None
+        for granularity in granularity_list:
+            key = bucket(granularity, dt) if dt else None
+            current = open_buckets.get(granularity)
+            if current and current[0] != key:
+                write_bucket(results_type, granularity, *current)
+                remaining[granularity].discard(current[0])
+                del open_buckets[granularity]
+            if key not in dirty[granularity]:
+                continue
+            if results is None:
+                results = _pack(results_type, core.cached_results(results_type, dt, dt, core.module_picker(dt, dt)) or {})
+            key, days, counts = open_buckets.get(granularity) or (key, 0, {})
+            _merge(counts, results)
+            open_buckets[granularity] = (key, days + 1, counts)
+    # dirty buckets without any days left
+    for granularity in granularity_list:
+        for key in remaining[granularity]:
+            write_bucket(results_type, granularity, key, 0, {})
+
+def build_yearly_buckets(results_type, key_list):
+    "sums the given yearly buckets from the monthly buckets"
+    for key in key_list:
+        days, counts = 0, {}
+        for month in range(1, 13):
+            data = read_bucket(results_type, 'monthly', "%s-%02d" % (key, month))
+            if data:
+                days += data['days']
+                _merge(counts, data['counts'])
+        write_bucket(results_type, 'yearly', key, days, counts)
+
+def build_total(results_type):
+    "the all-time totals, summed from the yearly buckets"
+    counts, days = {}, 0
+    for key in buckets(results_type, 'yearly'):
+        data = read_bucket(results_type, 'yearly', key)
+        days += data['days']
+        _merge(counts, data['counts'])
+    write_pickle(total_path(results_type), {'days': days, 'counts': counts})
+
+def build(results_type_list=RESULTS_TYPES, force=False):
+    """brings the rollups up to date with the cached daily results, summing again
+    only the buckets containing days that are new, changed or removed"""
+    for results_type in results_type_list:
+        source_map = daily_sources(results_type)
+        sources_path = join(rollup_dir(results_type), SOURCES)
+        if force and os.path.exists(rollup_dir(results_type)):
+            shutil.rmtree(rollup_dir(results_type))
+        previous = read_pickle(sources_path) if os.path.exists(sources_path) else {}
+        dirty = dirty_buckets(source_map, previous)
+        if not any(dirty.values()) and os.path.exists(total_path(results_type)):
+            LOG.info("%s rollups are up to date", results_type)
+            continue
+
+        LOG.info("rebuilding %s", ', '.join("%s %s %s rollups" % (len(dirty[granularity]), granularity, results_type)
+                                            for granularity in GRANULARITIES))
+        build_daily_buckets(results_type, source_map, dirty)
+        build_yearly_buckets(results_type, dirty['yearly'])
+        build_total(results_type)
+        # written last. if we die before now the same buckets are rebuilt next time
+        write_pickle(sources_path, source_map)
+
+#
+# interface
+#
+
+def totals(results_type):
+    """returns the all-time totals of every article in a single read, building the rollups first if
+    there are none. ll: {'10.7554/eLife.09560': Counter({'full': 1200, 'abstract': 30, 'digest': 4}), ...}"""
+    assert results_type in RESULTS_TYPES, "results type must be either 'views' or 'downloads'"
+    path = total_path(results_type)
+    if not os.path.exists(path):
+        build([results_type])
+    return _unpack(results_type, read_pickle(path)['counts'])
+
+def metrics_between(from_date, to_date, granularity='monthly'):
+    """returns the weekly, monthly or yearly views and downloads of every article in the buckets
+    between the two given dates, in the same shape as `bulk.metrics_for_range`. buckets with
+    no daily results are not included. run `build` first if the daily results have changed.
+
+    ll: OrderedDict([(('2016-06-01', '2016-06-30'), {'views': {...}, 'downloads': {...}}), ...])"""
+    assert granularity in GRANULARITIES, "granularity must be one of %r" % GRANULARITIES
+    lo, hi = bucket(granularity, from_date), bucket(granularity, to_date)
+    results = OrderedDict()
+    for results_type in RESULTS_TYPES:
+        for key in buckets(results_type, granularity):
+            if lo <= key <= hi:
+                data = read_bucket(results_type, granularity, key)
+                period = results.setdefault((data['from'], data['to']), {'views': {}, 'downloads': {}})
+                period[results_type] = _unpack(results_type, data['counts'])
+    return OrderedDict(sorted(results.items()))
+
+#
+# reconciliation
+#
+
+def _sum(results_type, results):
+    "the total count over every article"
+    if results_type == 'downloads':
+        return sum(results.values())
+    return sum(sum(val[view_type] for view_type in VIEW_TYPES) for val in results.values())
+
+def reconcile(results_type_list=RESULTS_TYPES):
+    """compares the monthly rollups with the monthly results GA gave us for the same months.
+    they differ where daily results are missing, where the daily and monthly queries are
+    parsed by different modules and where GA has sampled or thresholded either. returns
+    a list of dicts, one per month with both.
+
+    ll: [{'type': 'views', 'month': '2016-06', 'days': 30, 'expected_days': 30,
+          'ga': 41233, 'rollup': 41240, 'diff': 7, 'articles_differing': 3}, ...]"""
+    report = []
+    for results_type in results_type_list:
+        monthly = {}
+        for path, from_date, to_date in core.cached_periods(results_type):
+            if from_date != to_date:
+                monthly[from_date.strftime('%Y-%m')] = (from_date, to_date)
+        for key in buckets(results_type, 'monthly'):
+            if key not in monthly:
+                continue
+            from_date, to_date = monthly[key]
+            ga_results = core.cached_results(results_type, from_date, to_date, core.module_picker(from_date, to_date)) or {}
+            data = read_bucket(results_type, 'monthly', key)
+            rollup_results = _unpack(results_type, data['counts'])
+            ga_total, rollup_total = _sum(results_type, ga_results), _sum(results_type, rollup_results)
+            report.append({
+                'type': results_type,
+                'month': key,
+                'days': data['days'],
+                'expected_days': (to_date - from_date).days + 1,
+                'ga': ga_total,
+                'rollup': rollup_total,
+                'diff': rollup_total - ga_total,
+                'articles_differing': sum(1 for doi in set(ga_results) | set(rollup_results)
+                                          if ga_results.get(doi) != rollup_results.get(doi)),
+            })
+    return report
+
+def print_report(report):
+    print "%-10s %-8s %9s %10s %10s %8s %7s %9s" % ('type', 'month', 'days', 'ga', 'rollup', 'diff', 'diff %', 'articles')
+    for row in report:
+        percent = 100.0 * row['diff'] / row['ga'] if row['ga'] else 0
+        print "%-10s %-8s %4s/%-4s %10s %10s %8s %6.1f%% %9s" % (row['type'], row['month'], row['days'], row['expected_days'],
+            row['ga'], row['rollup'], row['diff'], percent, row['articles_differing'])
+
+if __name__ == '__main__':
+    build(force='--force' in sys.argv)
+    print_report(reconcile())
@@ -1,21 +1,98 @@
 """simple script that santizes the `output` directory.
-works even if no santitation required."""
-
-import sys, os, core, json
-from os.path import join
-
-def do():
-    output_dir = core.output_dir()
-    for dirname in os.listdir(output_dir):
-        for filename in os.listdir(join(output_dir, dirname)):
-            path = join(output_dir, dirname, filename)
-            if path.endswith('.json'):
-                sys.stdout.write('santizing %s' % path)
-                core.write_results( \
-                    core.sanitize_ga_response(json.load(open(path, 'r'))), \
-                    path)
-                sys.stdout.write(" ...done\n")
-                sys.stdout.flush()
+works even if no santitation required.
+
+the manifest records which results are already sanitised and whether they're compressed,
+so only results that need it are read and rewritten, across a pool of processes.
+results are written atomically and keep the format they're in unless `compress` is
+given or `core.compress_results` is True, so
+`GA_COMPRESS_RESULTS=1 python -m elife_ga_metrics.sanitize` compresses existing results"""
+
+import sys, os, core
+from elife_ga_metrics import manifest, executor, utils
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+# results are sent to the pool of processes this many at a time
+CHUNK_SIZE = 25
+
+def needs_work(path, entry, compress):
+    """returns True if the results at the given path need sanitising or converting to the
+    given format. results changed since the manifest last saw them, or recorded before it
+    knew whether they were clean, are checked"""
+    stat = os.stat(path)
+    if (entry['mtime'], entry['size']) != (stat.st_mtime, stat.st_size) or not entry.get('clean'):
+        return True
+    return compress is not None and entry.get('compressed') != compress
+
+def sanitize_file(path, compress=None):
+    """sanitises and rewrites the results at the given path if they need it, in the given
+    format or the format they're in. returns a pair of (what was done, manifest entry).
+    ll: ('sanitized', {...})"""
+    response = core.read_results(path)
+    compressed = core.is_compressed(path)
+    if compress is None:
+        compress = compressed
+    clean = core.is_sanitized(response)
+    if clean and compressed == compress:
+        # the manifest didn't know, it does now
+        return 'clean', manifest.entry_for(path, response)
+    action = 'sanitized' if not clean else ('compressed' if compress else 'decompressed')
+    core.write_file(path, core.encode_results(core.sanitize_ga_response(response), compress))
+    return action, manifest.entry_for(path, response)
+
+def _sanitize_chunk(args):
+    "`sanitize_file` for each path in a chunk. called within a process by `do`"
+    path_list, compress = args
+    results = []
+    for path in path_list:
+        try:
+            results.append((path,) + sanitize_file(path, compress))
+        except (IOError, OSError, ValueError), e:
+            LOG.warn("failed to sanitize %r: %s", path, e)
+            results.append((path, 'failed', None))
+    return results
+
+def do(compress=None, processes=executor.MAX_PROCESSES):
+    """sanitises every result in the output directory that needs it. returns a report
+    of what was done to which results. ll: {'clean': 4812, 'sanitized': ['/path/to/output/views/2016-01-01.json']}"""
+    if compress is None and core.compress_results():
+        compress = True
+    cache = manifest.get_manifest(sync=True)
+    report = {'clean': 0}
+    path_list = []
+    for results_type in manifest.RESULTS_TYPES:
+        for path, entry in cache.items(results_type):
+            if needs_work(path, entry, compress):
+                path_list.append(path)
+            else:
+                report['clean'] += 1
+    arg_list = [(chunk, compress) for chunk in utils.chunks(path_list, CHUNK_SIZE)]
+    changed = {}
+    recorded = []
+    for results in executor.process_map(_sanitize_chunk, arg_list, processes):
+        for path, action, entry in results:
+            if action == 'clean':
+                report['clean'] += 1
+            else:
+                changed.setdefault(action, []).append(path)
+            if entry:
+                recorded.append((path, entry))
+    # recorded by us rather than each process, which would leave the manifest scanning again
+    cache.record_many(recorded)
+    report.update(changed)
+    return report
+
+def print_report(report):
+    for action, path_list in sorted(report.items()):
+        if action == 'clean':
+            continue
+        for path in path_list:
+            sys.stdout.write('%s %s\n' % (action, path))
+    sys.stdout.write('%s results already clean, %s\n' % (report.get('clean', 0), ', '.join(
+        '%s %s' % (len(path_list), action) for action, path_list in sorted(report.items()) if action != 'clean') or 'nothing changed'))
 
 if __name__ == '__main__':
-    do()
+    print_report(do())
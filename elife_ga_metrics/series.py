@@ -0,0 +1,209 @@
+__description__ = """Per-article time series of views and downloads, backed by an index of all cached results."""
+
+import os, sys, fcntl, shelve, shutil, tempfile
+from os.path import join
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from elife_ga_metrics import core
+from elife_ga_metrics.utils import ymd, month_min_max
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+INDEX_SUBDIR = 'index'
+GRANULARITIES = ['daily', 'monthly']
+RESULTS_TYPES = ['views', 'downloads']
+
+# the index is a shelf keyed by DOI. this key holds details about the index itself
+META_KEY = '__meta__'
+
+def index_dir():
+    "a link to the directory holding the current index. ll: output/index -> index-Xy12Ab"
+    return join(core.output_dir(), INDEX_SUBDIR)
+
+def index_path(dirname=None):
+    return join(dirname or index_dir(), 'series')
+
+def granularity(from_date, to_date):
+    return 'daily' if from_date == to_date else 'monthly'
+
+def sources():
+    "returns a map of the path of every cached result to it's mtime and size"
+    manifest = core.cache_manifest(sync=True)
+    source_map = {}
+    for results_type in RESULTS_TYPES:
+        for path, entry in manifest.items(results_type):
+            if not entry['partial']:
+                source_map[path] = (entry['mtime'], entry['size'])
+    return source_map
+
+@contextmanager
+def locked():
+    "one process builds the index at a time. readers never wait"
+    if not os.path.exists(core.output_dir()):
+        os.makedirs(core.output_dir())
+    with open(join(core.output_dir(), '.index.lock'), 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+def is_current(source_map):
+    "returns True if the index was built from the given cached results"
+    if not os.path.exists(index_dir()):
+        return False
+    index = shelve.open(index_path(), 'r')
+    try:
+        return index[META_KEY]['sources'] == source_map
+    finally:
+        index.close()
+
+def swap(new_dir):
+    """points the index at the given directory in a single step, readers see either the
+    old index or the new one. the index replaced is kept as readers may still be using it"""
+    link = index_dir()
+    previous = os.path.realpath(link) if os.path.islink(link) else None
+    if os.path.isdir(link) and not os.path.islink(link):
+        # an index built before they were swapped into place
+        shutil.rmtree(link)
+    tmp_link = link + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.unlink(tmp_link)
+    os.symlink(os.path.basename(new_dir), tmp_link)
+    os.rename(tmp_link, link)
+    for name in os.listdir(core.output_dir()):
+        path = join(core.output_dir(), name)
+        if name.startswith(INDEX_SUBDIR + '-') and path not in [new_dir, previous]:
+            shutil.rmtree(path, ignore_errors=True)
+
+def _row(results_type, ordinal, val):
+    "ll: (735750, 12, 3, 0) or (735750, 2)"
+    if results_type == 'views':
+        return (ordinal, val['full'], val['abstract'], val['digest'])
+    return (ordinal, val)
+
+def build(force=False):
+    """builds the index from the cached results. the index is only rebuilt
+    if the cached results have changed since it was last built"""
+    with locked():
+        # another process may have just built it
+        source_map = sources()
+        if not force and is_current(source_map):
+            LOG.info("index is up to date")
+            return
+        _build(source_map)
+
+def _build(source_map):
+    # doi => granularity => results type => list of rows ordered by date
+    entries = {}
+    # (granularity, results type) => list of dates we have results for
+    covered = {}
+    for results_type in RESULTS_TYPES:
+        for path, from_date, to_date in core.cached_periods(results_type):
+            module = core.module_picker(from_date, to_date)
+            results = core.cached_results(results_type, from_date, to_date, module) or {}
+            period_granularity = granularity(from_date, to_date)
+            ordinal = from_date.toordinal()
+            covered.setdefault((period_granularity, results_type), []).append(ordinal)
+            for doi, val in results.items():
+                entry = entries.setdefault(doi, {})
+                entry.setdefault(period_granularity, {}).setdefault(results_type, []).append(_row(results_type, ordinal, val))
+
+    # build the new index alongside the old one and then swap them
+    new_dir = tempfile.mkdtemp(dir=core.output_dir(), prefix=INDEX_SUBDIR + '-')
+    os.chmod(new_dir, 0755)
+    index = shelve.open(index_path(new_dir), 'n', protocol=2)
+    for doi, entry in entries.items():
+        for granularity_map in entry.values():
+            for row_list in granularity_map.values():
+                row_list.sort()
+        index[doi.encode('utf8')] = entry
+    index[META_KEY] = {
+        'sources': source_map,
+        'covered': {key: sorted(ordinals) for key, ordinals in covered.items()},
+    }
+    index.close()
+    swap(new_dir)
+    LOG.info("indexed %s articles from %s results", len(entries), len(source_map))
+
+_INDEX = {}
+
+def _open_index():
+    "returns the index and it's details, re-using an already open index unless it has been rebuilt"
+    stat = os.stat(index_dir())
+    key = (index_dir(), stat.st_ino, stat.st_mtime)
+    if _INDEX.get('key') != key:
+        if _INDEX.get('index') is not None:
+            _INDEX['index'].close()
+        index = shelve.open(index_path(), 'r')
+        _INDEX.update({'key': key, 'index': index, 'meta': index[META_KEY]})
+    return _INDEX['index'], _INDEX['meta']
+
+def open_index():
+    """returns the index and it's details, building it first if it's missing or if
+    the cached results have changed since it was built"""
+    if not os.path.exists(index_dir()):
+        build()
+    index, meta = _open_index()
+    if meta['sources'] != sources():
+        LOG.info("cached results have changed, rebuilding index")
+        build()
+        index, meta = _open_index()
+    return index, meta
+
+def _period(ordinal, granularity):
+    "ll: ('2016-06-01', '2016-06-01') or ('2016-06-01', '2016-06-30')"
+    from_date = datetime.fromordinal(ordinal)
+    to_date = from_date if granularity == 'daily' else month_min_max(from_date)[1]
+    return ymd(from_date), ymd(to_date)
+
+def _empty(results_type):
+    if results_type == 'views':
+        return Counter({'full': 0, 'abstract': 0, 'digest': 0})
+    return 0
+
+def series(doi, from_date, to_date, granularity='daily'):
+    """returns the daily or monthly views and downloads of a single article
+    between the two given dates, in the same shape as `bulk.metrics_for_range`
+    but for just the one article. periods with no cached results are not included.
+
+    ll: OrderedDict([(('2016-06-01', '2016-06-01'), {'views': Counter(...), 'downloads': 3}), ...])"""
+    assert granularity in GRANULARITIES, "granularity must be one of %r" % GRANULARITIES
+    if granularity == 'monthly':
+        from_date = month_min_max(from_date)[0]
+    lo, hi = from_date.toordinal(), to_date.toordinal()
+
+    index, meta = open_index()
+    entry = index.get(doi.encode('utf8'), {}).get(granularity, {})
+
+    results = {}
+    for results_type in RESULTS_TYPES:
+        # every period we have results for is present, even if this article has none
+        covered = meta['covered'].get((granularity, results_type), [])
+        for ordinal in covered[bisect_left(covered, lo):bisect_right(covered, hi)]:
+            results.setdefault(ordinal, {})[results_type] = _empty(results_type)
+
+        row_list = entry.get(results_type, [])
+        for row in row_list[bisect_left(row_list, (lo,)):bisect_left(row_list, (hi + 1,))]:
+            if results_type == 'views':
+                ordinal, full, abstract, digest = row
+                val = Counter({'full': full, 'abstract': abstract, 'digest': digest})
+            else:
+                ordinal, val = row
+            results[ordinal][results_type] = val
+
+    return OrderedDict((_period(ordinal, granularity), results[ordinal]) for ordinal in sorted(results))
+
+if __name__ == '__main__':
+    # ll: python -m elife_ga_metrics.series 10.7554/eLife.09560 2016-01-01 2016-06-30 monthly
+    from pprint import pprint
+    args = sys.argv[1:]
+    build()
+    if args:
+        doi, from_date, to_date = args[0], datetime.strptime(args[1], "%Y-%m-%d"), datetime.strptime(args[2], "%Y-%m-%d")
+        pprint(dict(series(doi, from_date, to_date, *args[3:])))
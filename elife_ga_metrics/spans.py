@@ -0,0 +1,106 @@
+__description__ = """Fetches daily results a span of days at a time. A query for a span of
+days with `ga:date` as an extra dimension returns the rows of every day in the span, which
+are split into the same per-day results a query for each day would have returned and
+cached in the usual place, so nothing reading the cache knows the difference."""
+
+# ll: group_list = spans.group_queries(daily_query_list, 7)
+# ll: [(response, path), ...] = spans.query_ga_write_results(group_list[0])
+
+from datetime import datetime, timedelta
+from elife_ga_metrics import core, reporting
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+DATE_DIMENSION = 'ga:date'
+
+def parse_date(ymd):
+    return datetime.strptime(ymd, "%Y-%m-%d")
+
+def is_daily(query_map):
+    return isinstance(query_map, dict) and query_map['start_date'] == query_map['end_date']
+
+def span_key(query_map):
+    """daily queries can share a span if they differ only in their dates and their results
+    are parsed by the same `module_picker` module"""
+    module = core.module_picker(*[parse_date(query_map['start_date'])] * 2)
+    return (module.__name__,) + tuple(sorted((key, val) for key, val in query_map.items() if key not in ['start_date', 'end_date']))
+
+def group_queries(query_list, max_days):
+    """groups the given queries into lists of daily queries for consecutive days that can be
+    fetched as a single span of at most `max_days` days. other queries are alone in their group"""
+    group_list = []
+    spans = {} # the group the next day of each kind of query can be added to
+    for query_map in query_list:
+        if not is_daily(query_map):
+            group_list.append([query_map])
+            continue
+        key = span_key(query_map)
+        group = spans.get(key)
+        if group and len(group) < max_days and \
+          parse_date(group[-1]['start_date']) + timedelta(days=1) == parse_date(query_map['start_date']):
+            group.append(query_map)
+        else:
+            spans[key] = group = [query_map]
+            group_list.append(group)
+    return group_list
+
+def span_query(group):
+    "returns a query for every day of the given group of daily queries, with the date as the first dimension"
+    query_map = dict(group[0], end_date=group[-1]['end_date'])
+    for key in ['dimensions', 'sort']:
+        query_map[key] = ','.join([DATE_DIMENSION] + ([query_map[key]] if query_map.get(key) else []))
+    return query_map
+
+def total(val_list, data_type):
+    "ll: '1871'"
+    return str(sum(map(int if data_type == 'INTEGER' else float, val_list)))
+
+def split_response(group, response):
+    "returns the response for each day of the given group of daily queries from the response to their span"
+    assert response['columnHeaders'][0]['name'] == DATE_DIMENSION, "the date isn't the first dimension of the response"
+    headers = response['columnHeaders'][1:]
+    day_rows = {}
+    for row in response.get('rows', []):
+        day_rows.setdefault(row[0], []).append(row[1:])
+    response_list = []
+    for query_map in group:
+        rows = day_rows.pop(query_map['start_date'].replace('-', ''), [])
+        day = {
+            'kind': response.get('kind', 'analytics#gaData'),
+            'query': reporting.echoed_query(query_map),
+            'columnHeaders': headers,
+            'itemsPerPage': response.get('itemsPerPage', query_map.get('max_results')),
+            'totalResults': len(rows),
+            'containsSampledData': response.get('containsSampledData', False),
+            'totalsForAllResults': {header['name']: total([row[i] for row in rows], header['dataType'])
+                                    for i, header in enumerate(headers) if header['columnType'] == 'METRIC'},
+        }
+        if rows:
+            day['rows'] = rows
+        response_list.append(day)
+    if day_rows:
+        raise AssertionError("received rows for days not asked for: %s" % ', '.join(sorted(day_rows)))
+    return response_list
+
+def query_ga(group, num_attempts=5, limiter=None):
+    """returns the response for each of the given daily queries, fetching them as a single span.
+    GA returns at most `max_results` rows at a time, every page of the span is fetched. if GA
+    samples the results of a span, each half of it is fetched separately, down to single days"""
+    if len(group) == 1:
+        return [core.merge_pages(core.query_pages(group[0], num_attempts, limiter))]
+    LOG.info("querying %s days from %s to %s ...", len(group), group[0]['start_date'], group[-1]['end_date'])
+    response = core.merge_pages(core.query_pages(span_query(group), num_attempts, limiter))
+    if response.get('containsSampledData'):
+        LOG.warn("results from %s to %s are sampled, querying each half separately", group[0]['start_date'], group[-1]['end_date'])
+        half = len(group) // 2
+        return query_ga(group[:half], num_attempts, limiter) + query_ga(group[half:], num_attempts, limiter)
+    return split_response(group, response)
+
+def query_ga_write_results(group, num_attempts=5, limiter=None):
+    """convenience. queries GA for the given daily queries as a span, then writes the results
+    of each day where a query for that day would be written, returning a pair of (response, path) for each"""
+    return [(response, core.write_results(response, core.output_path_from_results(response)))
+            for response in query_ga(group, num_attempts, limiter)]
@@ -0,0 +1,262 @@
+__description__ = """A compact, columnar store of parsed GA results. One file per results type per month."""
+
+# file layout:
+#
+#   MAGIC
+#   header length (uint32, little-endian)
+#   header (json, padded): byte order, the string dictionary of DOIs and the table of periods
+#   period column (uint16, index into the table of periods)
+#   doi column (uint32, index into the DOI dictionary)
+#   type column (uint8, index into TYPES, padded to a multiple of 4 bytes)
+#   count column (uint32)
+#
+# rows are sorted by period so each period's rows are a contiguous slice of each column.
+# the raw GA responses remain the canonical data, the store can always be rebuilt from them.
+
+import os, sys, json, mmap, struct, tempfile
+from os.path import join
+from array import array
+from collections import Counter
+from elife_ga_metrics import core, parsecache
+from elife_ga_metrics.utils import ymd
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+LOG.level = logging.INFO
+
+STORE_SUBDIR = 'store'
+MAGIC = 'EGAS\x01'
+HEADER_LENGTH = struct.Struct('<I')
+
+TYPES = ['full', 'abstract', 'digest']
+TYPE_IDX = {name: idx for idx, name in enumerate(TYPES)}
+
+COLUMNS = [
+    # (name, array typecode)
+    ('period', 'H'),
+    ('doi', 'I'),
+    ('type', 'B'),
+    ('count', 'I'),
+]
+
+def store_path(results_type, dt):
+    "ll: output/store/views/2016-06.bin"
+    return join(core.output_dir(), STORE_SUBDIR, results_type, dt.strftime('%Y-%m') + '.bin')
+
+def period_key(from_date, to_date):
+    "ll: 2016-06-01_2016-06-01"
+    return "%s_%s" % (ymd(from_date), ymd(to_date))
+
+def source_key(raw_path):
+    "a period is stale if the raw results it was built from have changed since"
+    entry = core.cache_manifest().get(raw_path)
+    if entry:
+        return [entry['mtime'], entry['size']]
+    # raw results have been removed, trust the store
+
+#
+# (de)normalisation
+#
+
+def to_rows(results_type, results):
+    """yields (doi, type, count) triples for the given parsed results.
+    zero counts are implied for views, except 'full' which is always present"""
+    for doi, val in results.items():
+        if results_type == 'views':
+            for type_name in TYPES:
+                if val[type_name] or type_name == 'full':
+                    yield doi, TYPE_IDX[type_name], val[type_name]
+        else:
+            yield doi, 0, val
+
+def from_rows(results_type, rows):
+    "the inverse of `to_rows`, returns parsed results in the same shape the parsers do"
+    if results_type == 'views':
+        results = {}
+        for doi, type_idx, count in rows:
+            if doi not in results:
+                results[doi] = Counter({'full': 0, 'abstract': 0, 'digest': 0})
+            results[doi][TYPES[type_idx]] = count
+        return results
+    return {doi: count for doi, _, count in rows}
+
+#
+# reading
+#
+
+def _column(buf, typecode, offset, length, swap):
+    col = array(typecode)
+    col.fromstring(buf[offset:offset + length * col.itemsize])
+    if swap:
+        col.byteswap()
+    return col
+
+class StoreFile(object):
+    "a memory-mapped store file. only the header is decoded when opened"
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self.buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self.buf[:len(MAGIC)] == MAGIC, "not a store file: %r" % path
+        start = len(MAGIC) + HEADER_LENGTH.size
+        header_length, = HEADER_LENGTH.unpack(self.buf[len(MAGIC):start])
+        header = json.loads(self.buf[start:start + header_length])
+        self.swap = header['byteorder'] != sys.byteorder
+        self.dois = header['dois']
+        self.periods = header['periods']
+        self.index = {period['key']: idx for idx, period in enumerate(self.periods)}
+        # byte offset of each column
+        self.num_rows = header['rows']
+        self.offsets = {}
+        offset = start + header_length
+        for name, typecode in COLUMNS:
+            self.offsets[name] = offset
+            offset += _padded(self.num_rows * array(typecode).itemsize)
+
+    def close(self):
+        self.buf.close()
+
+    def columns(self, first=0, length=None):
+        "returns a map of column name to array for the given slice of rows"
+        length = self.num_rows if length is None else length
+        return {name: _column(self.buf, typecode, self.offsets[name] + first * array(typecode).itemsize, length, self.swap)
+                for name, typecode in COLUMNS}
+
+    def period(self, key):
+        idx = self.index.get(key)
+        return None if idx is None else self.periods[idx]
+
+    def period_columns(self, key):
+        "returns the columns for just the given period"
+        period = self.period(key)
+        return self.columns(period['offset'], period['length'])
+
+    def rows(self, key):
+        "yields the (doi, type, count) triples for the given period"
+        cols = self.period_columns(key)
+        for doi_idx, type_idx, count in zip(cols['doi'], cols['type'], cols['count']):
+            yield self.dois[doi_idx], type_idx, count
+
+    def all_periods(self):
+        "returns a map of period key to (period, rows) for every period in the file"
+        return {period['key']: (period, list(self.rows(period['key']))) for period in self.periods}
+
+_OPEN = {}
+
+def open_store(path):
+    "returns a StoreFile for the given path, re-using one already open if the file hasn't changed"
+    stat = os.stat(path)
+    key = (stat.st_mtime, stat.st_size)
+    if path not in _OPEN or _OPEN[path][0] != key:
+        store_file = StoreFile(path)
+        if path in _OPEN:
+            # rewritten since, the old file is unmapped rather than left open
+            _OPEN[path][1].close()
+        _OPEN[path] = (key, store_file)
+    return _OPEN[path][1]
+
+def find(results_type, from_date, to_date, module):
+    """returns a pair of (store file, period key) for the given period or
+    None if the period isn't in the store or is stale"""
+    path = store_path(results_type, from_date)
+    if not os.path.exists(path):
+        return None
+    store_file = open_store(path)
+    key = period_key(from_date, to_date)
+    period = store_file.period(key)
+    if not period or period['parser'] != parsecache.parser_version(module):
+        return None
+    raw_path = core.output_path(results_type, from_date, to_date)
+    source = source_key(raw_path)
+    if source and source != period['source']:
+        return None
+    return store_file, key
+
+def read(results_type, from_date, to_date, module):
+    """returns the parsed results for the given period or None if the
+    period isn't in the store or is stale"""
+    found = find(results_type, from_date, to_date, module)
+    if found:
+        store_file, key = found
+        return from_rows(results_type, store_file.rows(key))
+
+#
+# writing
+#
+
+def _padded(num_bytes):
+    return num_bytes + (-num_bytes % 4)
+
+def write(path, period_map):
+    """writes a store file. `period_map` is a map of period key to a
+    pair of (period, list of (doi, type, count) triples)"""
+    dois = sorted(set(doi for _, rows in period_map.values() for doi, _, _ in rows))
+    doi_idx = {doi: idx for idx, doi in enumerate(dois)}
+    cols = {name: array(typecode) for name, typecode in COLUMNS}
+    periods = []
+    for idx, key in enumerate(sorted(period_map.keys())):
+        period, rows = period_map[key]
+        period = dict(period, key=key, offset=len(cols['doi']), length=len(rows))
+        periods.append(period)
+        for doi, type_idx, count in sorted(rows):
+            cols['period'].append(idx)
+            cols['doi'].append(doi_idx[doi])
+            cols['type'].append(type_idx)
+            cols['count'].append(count)
+
+    header = json.dumps({
+        'byteorder': sys.byteorder,
+        'dois': dois,
+        'periods': periods,
+        'rows': len(cols['doi']),
+    })
+    # pad the header with whitespace so the columns are 4-byte aligned
+    header += ' ' * (-(len(MAGIC) + HEADER_LENGTH.size + len(header)) % 4)
+
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.store-')
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(HEADER_LENGTH.pack(len(header)))
+        fh.write(header)
+        for name, _ in COLUMNS:
+            data = cols[name].tostring()
+            fh.write(data + '\0' * (_padded(len(data)) - len(data)))
+    os.chmod(tmp_path, 0644)
+    os.rename(tmp_path, path)
+    LOG.info("wrote %s periods (%s rows) to %r", len(periods), len(cols['doi']), path)
+    return path
+
+#
+# migration
+#
+
+def migrate(results_type_list=('views', 'downloads')):
+    """converts the raw GA results in the output directory to the store.
+    periods already in the store that haven't changed are kept as-is.
+    partial results are never stored."""
+    for results_type in results_type_list:
+        months = {}
+        for raw_path, from_date, to_date in core.cached_periods(results_type):
+            months.setdefault(store_path(results_type, from_date), []).append((raw_path, from_date, to_date))
+
+        for path, period_list in sorted(months.items()):
+            existing = open_store(path).all_periods() if os.path.exists(path) else {}
+            period_map = dict(existing)
+            for raw_path, from_date, to_date in period_list:
+                key = period_key(from_date, to_date)
+                module = core.module_picker(from_date, to_date)
+                period = {'parser': parsecache.parser_version(module), 'source': source_key(raw_path)}
+                if key in existing and all(existing[key][0][k] == v for k, v in period.items()):
+                    period_map[key] = existing[key]
+                    continue
+                results = parsecache.parse(raw_path, module, core.PARSERS[results_type])
+                period_map[key] = (period, list(to_rows(results_type, results)))
+            if period_map != existing:
+                write(path, period_map)
+
+if __name__ == '__main__':
+    migrate()
@@ -1,8 +1,165 @@
 import unittest
-import os
+import os, shutil, tempfile, threading, time, json, urlparse
+import BaseHTTPServer, SocketServer
+from apiclient import errors
 
 class BaseCase(unittest.TestCase):
     table_id = 'ga:82618489'
     maxDiff = None
     this_dir = os.path.dirname(os.path.realpath(__file__))
     fixture_dir = os.path.join(this_dir, 'fixtures')
+    # the real results cached in the repository
+    cached_output_dir = os.path.join(os.path.dirname(os.path.dirname(this_dir)), 'output')
+
+    def temp_output_dir(self):
+        """returns a new temporary directory that results are written to and read from
+        for the rest of the test. it's removed and the environment restored afterwards"""
+        test_output_dir = tempfile.mkdtemp()
+        for key in ['TESTING', 'TEST_OUTPUT_DIR']:
+            self.addCleanup(restore_env, key, os.environ.get(key))
+        self.addCleanup(shutil.rmtree, test_output_dir, True)
+        os.environ['TESTING'] = "1"
+        os.environ['TEST_OUTPUT_DIR'] = test_output_dir
+        return test_output_dir
+
+def restore_env(key, val):
+    "sets an environment variable back to what it was, removing it if it wasn't set"
+    if val is None:
+        os.environ.pop(key, None)
+    else:
+        os.environ[key] = val
+
+class Object(object): pass
+
+class FakeClock(object):
+    "a clock that only moves when something sleeps"
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.now += seconds
+            self.slept += seconds
+
+class FakeQuery(object):
+    def __init__(self, service, query_map):
+        self.service = service
+        self.query_map = query_map
+
+    def execute(self):
+        time.sleep(self.service.latency)
+        with self.service.lock:
+            self.service.calls += 1
+            fail = self.service.failures > 0
+            if fail:
+                self.service.failures -= 1
+        if fail:
+            resp = Object()
+            resp.status, resp.reason = 503, 'backendError'
+            raise errors.HttpError(resp, '{"error": {"message": "backend error"}}')
+        start_index = self.query_map.get('start_index', 1)
+        per_page = self.query_map.get('max_results', 10000)
+        return {
+            'query': {
+                'start-date': self.query_map['start_date'],
+                'end-date': self.query_map['end_date'],
+                'filters': self.query_map['filters'],
+                'start-index': start_index,
+            },
+            'itemsPerPage': per_page,
+            'totalResults': len(self.service.rows) + self.service.missing,
+            'rows': self.service.rows[start_index - 1:start_index - 1 + per_page],
+        }
+
+class FakeGAService(object):
+    "stands in for the object returned by `core.ga_service`, simulating latency and quota errors"
+    def __init__(self, latency=0.01, failures=0, rows=None, missing=0):
+        self.latency = latency
+        self.failures = failures
+        self.rows = rows or []
+        self.missing = missing # rows GA claims to have but never returns
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def data(self):
+        return self
+
+    def ga(self):
+        return self
+
+    def get(self, **query_map):
+        return FakeQuery(self, query_map)
+
+class FakeBatch(object):
+    "stands in for `BatchHttpRequest`, executing each query it was given in turn"
+    instances = []
+
+    def __init__(self, callback=None, batch_uri=None):
+        self.callback = callback
+        self.requests = []
+        FakeBatch.instances.append(self)
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except errors.HttpError, e:
+                self.callback(request_id, None, e)
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class FakeGAServer(object):
+    """serves the Core Reporting API over HTTP from a `FakeGAService`, for testing
+    `client.Client` offline. requests must be signed with the current access token"""
+    def __init__(self, service, token='token'):
+        self.service = service
+        self.token = token
+        self.connections = set() # the address of every connection made to us
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive
+
+            def respond(self, status, data):
+                body = json.dumps(data)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                fake.connections.add(self.client_address)
+                if self.headers.get('Authorization') != 'Bearer ' + fake.token:
+                    return self.respond(401, {'error': {'message': 'invalid credentials'}})
+                params = urlparse.parse_qsl(urlparse.urlsplit(self.path).query)
+                query_map = {key.replace('-', '_'): val for key, val in params}
+                for key in ['max_results', 'start_index']:
+                    if key in query_map:
+                        query_map[key] = int(query_map[key])
+                try:
+                    self.respond(200, fake.service.get(**query_map).execute())
+                except errors.HttpError, e:
+                    self.respond(e.resp.status, json.loads(e.content))
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s/analytics/v3/data/ga' % self.httpd.server_port
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
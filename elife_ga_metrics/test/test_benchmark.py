@@ -0,0 +1,35 @@
+import os, shutil, tempfile
+from base import BaseCase
+from elife_ga_metrics import benchmark
+
+def result(cost, peak_kb=2000, rows_per_sec=1000):
+    return {'cost': cost, 'peak_kb': peak_kb, 'rows_per_sec': rows_per_sec}
+
+class TestBenchmark(BaseCase):
+    def test_regressions(self):
+        "cases are compared relative to the reference work, allowing for noise"
+        baseline = {'parse': result(2.0), 'load': result(2.0), 'read': result(2.0)}
+        results = {'parse': result(2.4), 'load': result(2.6), 'read': result(2.0, peak_kb=5000), 'new': result(9.0)}
+        regressions = benchmark.compare(results, baseline, tolerance=0.25)
+        self.assertEqual(sorted(name for name, _ in regressions), ['load', 'read'])
+        # on another machine only the cost is compared
+        regressions = benchmark.compare(results, baseline, tolerance=0.25, memory=False)
+        self.assertEqual([name for name, _ in regressions], ['load'])
+
+    def test_run_case(self):
+        "only the case itself is timed, in a child process"
+        seconds, peak_kb, ref = benchmark.run_case(lambda: range(1000), sum, min_time=0.01)
+        self.assertTrue(0 <= seconds < ref)
+        self.assertTrue(peak_kb >= 0)
+
+    def test_output_copies_removed(self):
+        "the output directories cases copy their results to are removed once they've run"
+        path = os.path.join(self.cached_output_dir, 'views', '2016-02-24.json')
+        tmp_root = tempfile.mkdtemp()
+        original_tempdir, tempfile.tempdir = tempfile.tempdir, tmp_root
+        try:
+            benchmark.run_case(lambda: benchmark.copy_output([path]), lambda _: None)
+            self.assertEqual(os.listdir(tmp_root), [])
+        finally:
+            tempfile.tempdir = original_tempdir
+            shutil.rmtree(tmp_root)
@@ -0,0 +1,88 @@
+import os, json, time, stat
+import httplib2
+from base import BaseCase
+from oauth2client.client import OAuth2Credentials
+from elife_ga_metrics import bootstrap
+
+class FakeHttp(object):
+    "stands in for `httplib2.Http`, returning the same response to every request"
+    def __init__(self, content, status=200):
+        self.content = content
+        self.status = status
+        self.calls = 0
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        self.calls += 1
+        return httplib2.Response({'status': str(self.status)}), self.content
+
+def token_http(token):
+    return FakeHttp(json.dumps({'access_token': token, 'expires_in': 3600}))
+
+def credentials():
+    return OAuth2Credentials(None, 'client-id', 'client-secret', 'refresh-token', None,
+                             'https://accounts.example.org/token', 'test')
+
+class TestBootstrap(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        bootstrap._DISCOVERY.clear()
+        self.document = json.dumps({'name': 'analytics', 'version': 'v3'})
+
+    def tearDown(self):
+        bootstrap._DISCOVERY.clear()
+
+    def test_discovery_document_cached(self):
+        "the discovery document is fetched once and read from disk by later runs"
+        http = FakeHttp(self.document)
+        self.assertEqual(bootstrap.discovery_document(http), self.document)
+        self.assertEqual(bootstrap.discovery_document(http), self.document)
+        bootstrap._DISCOVERY.clear() # a new process
+        self.assertEqual(bootstrap.discovery_document(http), self.document)
+        self.assertEqual(http.calls, 1)
+
+    def test_stale_discovery_document(self):
+        "an old discovery document is fetched again, but still used if that fails"
+        bootstrap.discovery_document(FakeHttp(self.document))
+        last_week = time.time() - bootstrap.DISCOVERY_MAX_AGE - 1
+        os.utime(bootstrap.discovery_path(), (last_week, last_week))
+        bootstrap._DISCOVERY.clear()
+        http = FakeHttp('{"error": {}}', status=500)
+        self.assertEqual(bootstrap.discovery_document(http), self.document)
+        self.assertEqual(http.calls, 1)
+
+    def test_discovery_document_unavailable(self):
+        self.assertRaises(AssertionError, bootstrap.discovery_document, FakeHttp('', status=500))
+
+    def test_token_reused(self):
+        "an unexpired access token is reused by the next run instead of a new one being requested"
+        first_run = bootstrap.reuse_tokens(credentials())
+        first_run.refresh(token_http('token-1'))
+        path = bootstrap.token_path(first_run)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0600)
+        with open(path, 'r') as fh:
+            self.assertEqual(sorted(json.load(fh).keys()), ['access_token', 'token_expiry'])
+
+        http = token_http('token-2')
+        second_run = bootstrap.reuse_tokens(credentials())
+        self.assertEqual(second_run.get_access_token(http).access_token, 'token-1')
+        self.assertEqual(http.calls, 0)
+
+    def test_expiring_token_not_reused(self):
+        first_run = bootstrap.reuse_tokens(credentials())
+        first_run.refresh(FakeHttp(json.dumps({'access_token': 'token-1', 'expires_in': 60})))
+        second_run = bootstrap.reuse_tokens(credentials())
+        self.assertEqual(second_run.access_token, None)
+        self.assertEqual(second_run.get_access_token(token_http('token-2')).access_token, 'token-2')
+
+    def test_token_refreshed_elsewhere(self):
+        "a token refreshed by another process is picked up rather than refreshing it again"
+        ours, theirs = bootstrap.reuse_tokens(credentials()), bootstrap.reuse_tokens(credentials())
+        theirs.refresh(token_http('token-1'))
+        http = token_http('token-2')
+        ours.refresh(http)
+        self.assertEqual(ours.access_token, 'token-1')
+        self.assertEqual(http.calls, 0)
+        # the token was refused, a new one is needed
+        ours.refresh(http)
+        self.assertEqual(ours.access_token, 'token-2')
+        self.assertEqual(http.calls, 1)
@@ -0,0 +1,100 @@
+import os, shutil
+from os.path import join
+from base import BaseCase, FakeGAService, FakeBatch
+from datetime import datetime, date
+from elife_ga_metrics import core, bulk, elife_v2, elife_v3, utils
+
+class TestFillGaps(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        self.original_ga_service = core.ga_service
+        self.service = FakeGAService(latency=0)
+        core.ga_service = lambda: self.service
+        self.original_batch = bulk.BatchHttpRequest
+        bulk.BatchHttpRequest = FakeBatch
+        # a week in june 2016 with everything but a day of views cached
+        self.from_date, self.to_date = datetime(2016, 6, 1), datetime(2016, 6, 7)
+        for results_type in ['views', 'downloads']:
+            os.makedirs(join(self.test_output_dir, 'output', results_type))
+            for f, t in utils.dt_range(self.from_date, self.to_date) + [(datetime(2016, 6, 1), datetime(2016, 6, 30))]:
+                self.cache(results_type, f, t)
+        os.unlink(core.output_path('views', datetime(2016, 6, 3), datetime(2016, 6, 3)))
+        # removed behind the manifest's back, found when a run starts by syncing
+        core.cache_manifest(sync=True)
+
+    def tearDown(self):
+        core.ga_service = self.original_ga_service
+        bulk.BatchHttpRequest = self.original_batch
+
+    def cache(self, results_type, f, t, path=None, module=elife_v3):
+        query_map = getattr(module, core.QUERY_FUNCS[results_type])(self.table_id, f, t)
+        response = {'query': {'start-date': query_map['start_date'], 'end-date': query_map['end_date'],
+                              'filters': query_map['filters']}, 'rows': []}
+        core.write_results(response, path or core.output_path(results_type, f, t))
+
+    def gaps(self):
+        return [(q['start_date'], q['end_date'], reason) for q, reason in bulk.find_gaps(self.table_id, self.from_date, self.to_date)]
+
+    def test_missing_results_found(self):
+        self.assertEqual(self.gaps(), [('2016-06-03', '2016-06-03', 'missing')])
+
+    def test_partial_results_found(self):
+        dt = datetime(2016, 6, 3)
+        self.cache('views', dt, dt, core.output_path('views', dt, dt) + '.partial')
+        self.assertEqual(self.gaps(), [('2016-06-03', '2016-06-03', 'partial')])
+
+    def test_outdated_results_found(self):
+        "results fetched with a query other than the one `module_picker` would use today are found"
+        dt = datetime(2016, 6, 4)
+        self.cache('downloads', dt, dt) # downloads queries are the same across modules
+        self.cache('views', dt, dt, module=elife_v2)
+        self.assertEqual(self.gaps(), [('2016-06-03', '2016-06-03', 'missing'), ('2016-06-04', '2016-06-04', 'outdated')])
+
+    def test_recent_results_found(self):
+        "results for periods ending in the last few days are fetched again, GA may still revise them"
+        refresh_days = (datetime.combine(date.today(), datetime.min.time()) - datetime(2016, 6, 5)).days
+        gaps = [(q['start_date'], q['end_date'], reason) for q, reason in \
+                bulk.find_gaps(self.table_id, self.from_date, self.to_date, refresh_days)]
+        recent = [('2016-06-0%s' % d, '2016-06-0%s' % d, 'recent') for d in [5, 6, 7]]
+        month = ('2016-06-01', '2016-06-30', 'recent')
+        self.assertEqual(gaps, [('2016-06-03', '2016-06-03', 'missing')] + recent + recent + [month, month])
+        self.assertEqual(self.gaps(), [('2016-06-03', '2016-06-03', 'missing')])
+
+    def test_fill_gaps(self):
+        "only the gaps are queried and stale partial results are removed"
+        dt = datetime(2016, 6, 3)
+        partial_path = core.output_path('views', dt, dt) + '.partial'
+        self.cache('views', dt, dt, partial_path)
+        results = bulk.fill_gaps(self.table_id, self.from_date, self.to_date)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(self.service.calls, 1)
+        self.assertTrue(os.path.exists(core.output_path('views', dt, dt)))
+        self.assertFalse(os.path.exists(partial_path))
+        self.assertEqual(self.gaps(), [])
+
+class TestParallelMetrics(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        # a few days either side of the switch to the new site
+        self.dt_range_list = utils.dt_range(datetime(2016, 2, 6), datetime(2016, 2, 12))
+        for results_type in ['views', 'downloads']:
+            os.makedirs(join(self.test_output_dir, 'output', results_type))
+            for dt, _ in self.dt_range_list:
+                path = core.output_path(results_type, dt, dt)
+                shutil.copy(join(self.cached_output_dir, results_type, os.path.basename(path)), path)
+
+    def test_chunks_respect_module_boundaries(self):
+        chunk_list = bulk.chunk_periods(self.dt_range_list, 3)
+        self.assertEqual(sum(chunk_list, []), self.dt_range_list)
+        for chunk in chunk_list:
+            self.assertTrue(len(chunk) <= 3)
+            self.assertEqual(len(set(core.module_picker(*dt_pair) for dt_pair in chunk)), 1)
+        self.assertEqual([len(chunk) for chunk in chunk_list], [3, 1, 3])
+
+    def test_parallel_metrics_for_range(self):
+        "periods parsed across processes are returned in order, the same as when parsed in one"
+        expected = bulk.metrics_for_range(self.table_id, self.dt_range_list, True, True)
+        self.assertTrue(all(metrics['views'] for metrics in expected.values()))
+        results = bulk.metrics_for_range(self.table_id, self.dt_range_list, True, True, processes=2)
+        self.assertEqual(results.keys(), expected.keys())
+        self.assertEqual(results, expected)
@@ -0,0 +1,94 @@
+import os
+from base import BaseCase, FakeClock, FakeGAService, FakeGAServer
+from datetime import datetime
+from oauth2client.client import AccessTokenInfo
+from apiclient import errors
+from elife_ga_metrics import core, bulk, executor, client, elife_v3, utils
+
+class FakeCredentials(object):
+    "stands in for the service-account credentials, refreshing gets the server's current token"
+    def __init__(self, server):
+        self.server = server
+        self.token = server.token
+        self.refreshes = 0
+
+    def get_access_token(self):
+        return AccessTokenInfo(access_token=self.token, expires_in=3600)
+
+    def refresh(self, http):
+        self.refreshes += 1
+        self.token = self.server.token
+
+class TestClient(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        self.service = FakeGAService(latency=0, rows=[['/content/5/e%05d' % i, '1'] for i in range(25)])
+        self.server = FakeGAServer(self.service)
+        self.credentials = FakeCredentials(self.server)
+        self.client = client.Client(workers=4, credentials=self.credentials, url=self.server.url)
+        self.clock = FakeClock()
+        self.limiter = executor.RateLimiter(clock=self.clock.time, sleep=self.clock.sleep)
+        dt = datetime(2016, 6, 1)
+        self.query_map = elife_v3.path_counts_query(self.table_id, dt, dt)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_query_params(self):
+        self.assertEqual(client.query_params({'start_date': '2016-06-01', 'max_results': 10, 'ids': u'ga:1'}),
+                         'ids=ga%3A1&max-results=10&start-date=2016-06-01')
+
+    def test_query_ga_async(self):
+        response = self.client.query_ga_async(self.query_map).result()
+        self.assertEqual(response['rows'], self.service.rows)
+        self.assertEqual(response['query']['filters'], self.query_map['filters'])
+
+    def test_connections_reused(self):
+        "many queries are made over no more connections than there are workers"
+        future_list = [self.client.query_ga_async(self.query_map) for _ in range(20)]
+        for future in future_list:
+            self.assertEqual(len(future.result()['rows']), 25)
+        self.assertEqual(self.service.calls, 20)
+        self.assertTrue(len(self.server.connections) <= 4)
+
+    def test_rate_limited_query_retried(self):
+        "the retry semantics are those of `core.query_ga`"
+        self.service.failures = 2
+        response = self.client.query_ga_async(self.query_map, limiter=self.limiter).result()
+        self.assertEqual(len(response['rows']), 25)
+        self.assertEqual(self.service.calls, 3)
+        self.assertTrue(self.clock.slept > 0)
+
+    def test_errors_raised(self):
+        self.service.failures = 5
+        future = self.client.query_ga_async(self.query_map, num_attempts=2, limiter=self.limiter)
+        self.assertRaises(AssertionError, future.result)
+        self.server.token = 'another-token'
+        self.credentials.refresh = lambda http: None # can't be refreshed
+        try:
+            self.client.query_ga_async(self.query_map).result()
+            self.fail("expected an HttpError")
+        except errors.HttpError, e:
+            self.assertEqual(e.resp.status, 401)
+
+    def test_access_token_refreshed(self):
+        "a refused access token is refreshed once and the query made again"
+        self.server.token = 'new-token'
+        response = self.client.query_ga_async(self.query_map).result()
+        self.assertEqual(len(response['rows']), 25)
+        self.assertEqual(self.credentials.refreshes, 1)
+
+    def test_bulk_query(self):
+        "queries are fetched, every page of them, and written by the client's workers"
+        self.query_map['max_results'] = 10
+        query_list = [elife_v3.path_counts_query(self.table_id, dt, dt) for dt, _ in
+                      utils.dt_range(datetime(2016, 6, 1), datetime(2016, 6, 5))]
+        for query_map in query_list:
+            query_map['max_results'] = 10
+        results = bulk.bulk_query(query_list, limiter=self.limiter, client=self.client)
+        self.assertEqual(self.service.calls, 15)
+        for (response, path), (dt, _) in zip(results, utils.dt_range(datetime(2016, 6, 1), datetime(2016, 6, 5))):
+            self.assertEqual(path, core.output_path('views', dt, dt))
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(response['rows'], self.service.rows)
@@ -1,3 +1,5 @@
+import os, sys, json, shutil, subprocess
+from os.path import join
 from base import BaseCase
 from datetime import datetime, timedelta
 from elife_ga_metrics import core, elife_v1, elife_v2, elife_v3, utils
@@ -58,3 +60,30 @@ class TestCore(BaseCase):
             except AssertionError:
                 print 'given:',dtpair,'expected:',expected_module,'got',actual
                 raise
+
+GOOGLE_LIBRARIES = ['googleapiclient', 'apiclient', 'oauth2client', 'httplib2']
+
+IMPORTS_SCRIPT = """
+import sys, json, logging
+from datetime import datetime
+logging.disable(logging.ERROR)
+from elife_ga_metrics import core
+dt = datetime(2016, 2, 24)
+metrics = core.article_metrics('ga:82618489', dt, dt, cached=True, only_cached=True)
+assert metrics['views'] and metrics['downloads'], "no cached results"
+print json.dumps(sorted(sys.modules))
+"""
+
+class TestImports(BaseCase):
+    def setUp(self):
+        # a copy of the results read, so nothing is written to the repository's output directory
+        self.test_output_dir = self.temp_output_dir()
+        for results_type in ['views', 'downloads']:
+            os.makedirs(join(self.test_output_dir, 'output', results_type))
+            shutil.copy(join(self.cached_output_dir, results_type, '2016-02-24.json'), join(self.test_output_dir, 'output', results_type))
+
+    def test_cached_metrics_without_google_libraries(self):
+        "cached results are read without importing the libraries needed to talk to GA"
+        output = subprocess.check_output([sys.executable, '-c', IMPORTS_SCRIPT], cwd=os.path.dirname(self.cached_output_dir))
+        imported = set(module.split('.')[0] for module in json.loads(output.splitlines()[-1]))
+        self.assertEqual(imported.intersection(GOOGLE_LIBRARIES), set())
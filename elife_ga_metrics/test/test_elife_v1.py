@@ -0,0 +1,92 @@
+import os, re, logging
+from os.path import join
+from base import BaseCase
+from collections import Counter
+from elife_ga_metrics import elife_v1, utils, benchmark
+
+def old_path_count(pair):
+    "`elife_v1.path_count` as it was before being replaced with a single regular expression"
+    try:
+        if pair[0].lower().startswith('/content/early/'):
+            bits = pair[0].split('/', 6)
+            bits[-1] = utils.deplumpen(bits[-1])
+        elif pair[0].lower().startswith('/content/elife/early/'):
+            bits = pair[0].split('/', 7)
+            bits[-1] = utils.deplumpen(bits[-1])
+        elif pair[0].lower().startswith('/content/elife/'):
+            bits = pair[0].split('/', 4)
+        else:
+            bits = pair[0].split('/', 3)
+        art = bits[-1]
+        art = art.lower()
+        more_bits = re.split(elife_v1.SPLITTER, art, maxsplit=1)
+        suffix = None
+        if len(more_bits) > 1:
+            art, suffix = more_bits
+        assert suffix in elife_v1.TYPE_MAP
+        return art, elife_v1.TYPE_MAP[suffix], int(pair[1])
+    except AssertionError:
+        pass
+
+class TestPathCount(BaseCase):
+    def setUp(self):
+        # unhandled paths are expected
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_path_count(self):
+        cases = [
+            ('/content/4/e06559', ('e06559', 'full', 1)),
+            ('/content/4/E06559.full', ('e06559', 'full', 1)),
+            ('/content/4/e06559.abstract', ('e06559', 'abstract', 1)),
+            ('/content/4/e06559/abstract-2', ('e06559', 'digest', 1)),
+            ('/content/elife/4/e06559', ('e06559', 'full', 1)),
+            ('/content/early/2015/12/10/eLife.11282', ('e11282', 'full', 1)),
+            ('/content/elife/early/2015/12/10/eLife.11282', ('e11282', 'full', 1)),
+            ('/content/4/e06559.pdf', None),
+            ('/content/5/e10147http:/elifesciences.org/content/5/e10147', None),
+        ]
+        for path, expected in cases:
+            self.assertEqual(elife_v1.path_count([path, '1']), expected)
+
+    def test_path_count_unchanged(self):
+        "every path in the cached results before 2016 is classified exactly as it used to be"
+        pair_list = set()
+        for results_dir in [join(self.cached_output_dir, 'views')]:
+            for filename in os.listdir(results_dir) if os.path.exists(results_dir) else []:
+                if filename < '2016' and filename.endswith('.json'):
+                    pair_list.update(tuple(row) for row in utils.iter_rows(join(results_dir, filename)))
+        if not pair_list:
+            self.skipTest("no cached results before 2016")
+        # paths that are awkward to classify
+        pair_list.update([('', '1'), ('/', '1'), ('/content/early/', '1'), ('/content/early/2015/11', '1'),
+                          ('/content/elife/', '1'), ('/content/elife/early/x.y.z', '1'), ('/a/b/c/d/e.f/g', '1'),
+                          ('/content/early/2015/11/14/e10230.abstract', '1'), (u'/content/4/e0655\u0130.full', '1'),
+                          ('/content/4/e06559.', '1'), ('/content/4/e06559\n.full', '1')])
+        for pair in pair_list:
+            self.assertEqual(elife_v1.path_count(pair), old_path_count(pair), pair)
+
+class TestGroupResults(BaseCase):
+    def test_group_results(self):
+        triplet_list = [('e06559', 'full', 3), ('e06559', 'digest', 1), ('e06559', 'full', 2), ('e11282', 'abstract', 0)]
+        expected = {
+            '10.7554/eLife.06559': Counter({'full': 5, 'abstract': 0, 'digest': 1}),
+            '10.7554/eLife.11282': Counter({'full': 0, 'abstract': 0, 'digest': 0}),
+        }
+        self.assertEqual(elife_v1.group_results(triplet_list), expected)
+        self.assertEqual(elife_v1.group_results(iter(triplet_list)), expected)
+
+    def test_group_results_unchanged(self):
+        "articles are grouped exactly as they were by reducing a list of Counters"
+        path = join(self.cached_output_dir, 'views', '2015-11-01_2015-11-30.json')
+        if not os.path.exists(path):
+            self.skipTest("no cached monthly results")
+        logging.disable(logging.ERROR)
+        try:
+            triplet_list = filter(None, map(elife_v1.path_count, utils.iter_rows(path)))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertTrue(triplet_list)
+        self.assertEqual(elife_v1.group_results(triplet_list), benchmark.counter_group_results(triplet_list))
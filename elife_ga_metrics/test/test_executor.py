@@ -0,0 +1,147 @@
+import os, threading
+from os.path import join
+from base import BaseCase, FakeClock, FakeGAService, FakeBatch
+from datetime import datetime
+from elife_ga_metrics import core, bulk, executor, retry, elife_v3, utils
+
+class TestRateLimiter(BaseCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def limiter(self, **kwargs):
+        return executor.RateLimiter(clock=self.clock.time, sleep=self.clock.sleep, **kwargs)
+
+    def test_burst_within_per_second_quota(self):
+        "a burst of queries up to the per-second quota doesn't wait"
+        limiter = self.limiter(per_second=10)
+        for _ in range(10):
+            limiter.acquire()
+        self.assertEqual(self.clock.slept, 0)
+
+    def test_per_second_quota(self):
+        "queries beyond the per-second quota wait for the bucket to refill"
+        limiter = self.limiter(per_second=10)
+        for _ in range(30):
+            limiter.acquire()
+        self.assertAlmostEqual(self.clock.slept, 2.0)
+
+    def test_per_day_quota(self):
+        "an error is raised once the daily quota is used up"
+        limiter = self.limiter(per_second=10, per_day=5)
+        for _ in range(5):
+            limiter.acquire()
+        self.assertRaises(AssertionError, limiter.acquire)
+
+    def test_backoff_slows_everybody(self):
+        "a backoff pauses all queries and reduces the shared rate"
+        limiter = self.limiter(per_second=10)
+        limiter.backoff(5)
+        self.assertEqual(limiter.rate, 5)
+        limiter.acquire()
+        self.assertTrue(self.clock.slept >= 5)
+
+    def test_rate_recovers(self):
+        limiter = self.limiter(per_second=10)
+        limiter.backoff(1)
+        for _ in range(100):
+            limiter.success()
+        self.assertEqual(limiter.rate, 10)
+
+class TestConcurrentBulkQuery(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        self.original_ga_service = core.ga_service
+        self.service = FakeGAService()
+        core.ga_service = lambda: self.service
+        self.clock = FakeClock()
+        self.limiter = executor.RateLimiter(clock=self.clock.time, sleep=self.clock.sleep)
+
+    def tearDown(self):
+        core.ga_service = self.original_ga_service
+
+    def query_list(self):
+        dt_range = utils.dt_range(datetime(2016, 6, 1), datetime(2016, 6, 20))
+        return [elife_v3.path_counts_query(self.table_id, f, t) for f, t in dt_range]
+
+    def test_pmap_preserves_order(self):
+        self.assertEqual(executor.pmap(lambda x: x * 2, range(50), workers=8), range(0, 100, 2))
+
+    def test_concurrent_bulk_query(self):
+        "queries executed concurrently are all written to the expected place"
+        results = bulk.bulk_query(self.query_list(), workers=5, limiter=self.limiter)
+        self.assertEqual(len(results), 20)
+        self.assertEqual(self.service.calls, 20)
+        for response, path in results:
+            self.assertEqual(path, join(self.test_output_dir, 'output', 'views', response['query']['start-date'] + '.json'))
+            self.assertTrue(os.path.exists(path))
+
+    def test_rate_limited_worker_slows_limiter(self):
+        "a worker receiving a quota error slows down the limiter shared by all workers"
+        self.service.failures = 3
+        results = bulk.bulk_query(self.query_list(), workers=5, limiter=self.limiter)
+        self.assertEqual(len(results), 20)
+        self.assertEqual(self.service.calls, 23)
+        self.assertTrue(self.limiter.rate < self.limiter.max_rate)
+        self.assertTrue(self.clock.slept > 0)
+
+class TestBatchedBulkQuery(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        self.original_ga_service = core.ga_service
+        self.service = FakeGAService(latency=0)
+        core.ga_service = lambda: self.service
+        self.original_batch = bulk.BatchHttpRequest
+        bulk.BatchHttpRequest = FakeBatch
+        FakeBatch.instances = []
+        self.original_sleep = retry.time.sleep
+        retry.time.sleep = lambda seconds: None
+
+    def tearDown(self):
+        core.ga_service = self.original_ga_service
+        bulk.BatchHttpRequest = self.original_batch
+        retry.time.sleep = self.original_sleep
+
+    def query_list(self):
+        dt_range = utils.dt_range(datetime(2016, 6, 1), datetime(2016, 6, 25))
+        return [elife_v3.path_counts_query(self.table_id, f, t) for f, t in dt_range]
+
+    def test_batched_bulk_query(self):
+        "queries are packed into as few batch requests as possible and written to the expected place"
+        results = bulk.bulk_query(self.query_list(), batched=True)
+        self.assertEqual(len(FakeBatch.instances), 3) # 10 + 10 + 5
+        self.assertEqual(len(results), 25)
+        for response, path in results:
+            self.assertEqual(path, core.output_path_from_results(response))
+            self.assertTrue(os.path.exists(path))
+
+    def test_batched_queries_in_flight_capped(self):
+        "no more queries are in flight at once than there are workers, each query in a batch counts"
+        self.assertEqual([bulk.batch_workers(n) for n in [1, 9, 10, 25]], [1, 1, 1, 2])
+        in_flight = {'now': 0, 'most': 0}
+        lock = threading.Lock()
+        class CountingBatch(FakeBatch):
+            def execute(self, http=None):
+                with lock:
+                    in_flight['now'] += len(self.requests)
+                    in_flight['most'] = max(in_flight['most'], in_flight['now'])
+                threading.Event().wait(0.01) # time.sleep is patched
+                try:
+                    FakeBatch.execute(self, http)
+                finally:
+                    with lock:
+                        in_flight['now'] -= len(self.requests)
+        bulk.BatchHttpRequest = CountingBatch
+        clock = FakeClock()
+        limiter = executor.RateLimiter(clock=clock.time, sleep=clock.sleep)
+        results = bulk.bulk_query(self.query_list(), workers=10, limiter=limiter, batched=True)
+        self.assertEqual(len(results), 25)
+        self.assertEqual(in_flight['most'], 10)
+
+    def test_failed_batch_queries_retried(self):
+        "queries that fail within a batch are retried individually"
+        self.service.failures = 2
+        results = bulk.bulk_query(self.query_list(), batched=True)
+        self.assertEqual(len(results), 25)
+        self.assertEqual(self.service.calls, 27)
+        self.assertEqual([r['query']['start-date'] for r, _ in results], \
+                         [q['start_date'] for q in self.query_list()])
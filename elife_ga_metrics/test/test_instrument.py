@@ -0,0 +1,75 @@
+import os, json, shutil
+from os.path import join
+from base import BaseCase
+from datetime import datetime
+from elife_ga_metrics import core, bulk, utils, instrument
+
+class TestInstrument(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        instrument.reset()
+        instrument.enable()
+
+    def tearDown(self):
+        instrument.disable()
+        instrument.reset()
+
+    def counters(self, name):
+        "the counters with the given name, summed across labels"
+        return sum(n for k, n in instrument.snapshot()['counters'].items() if k.split('{')[0] == name)
+
+    def test_disabled(self):
+        "nothing is recorded unless instrumentation is enabled"
+        instrument.disable()
+        instrument.incr('queries')
+        with instrument.timer('query'):
+            pass
+        self.assertEqual(instrument.snapshot(), {'counters': {}, 'histograms': {}})
+
+    def test_counters_and_timings(self):
+        instrument.incr('queries', type='views')
+        instrument.incr('queries', 2, type='views')
+        instrument.observe('query', 0.2, type='views')
+        instrument.observe('query', 3, type='views')
+        with instrument.timer('write'):
+            pass
+        summary = instrument.summary()
+        self.assertEqual(summary['counters'], {'queries{type=views}': 3})
+        hist = summary['histograms']['query{type=views}']
+        self.assertEqual((hist['count'], hist['sum'], hist['min'], hist['max'], hist['mean']), (2, 3.2, 0.2, 3, 1.6))
+        self.assertEqual(hist['buckets'], {'<=0.5': 1, '<=5': 1})
+        self.assertEqual(summary['histograms']['write']['count'], 1)
+
+        # what another process recorded is added to what was recorded here
+        recorded = instrument.collect()
+        self.assertEqual(instrument.snapshot(), {'counters': {}, 'histograms': {}})
+        instrument.observe('query', 0.1, type='views')
+        instrument.merge(recorded)
+        hist = instrument.summary()['histograms']['query{type=views}']
+        self.assertEqual((hist['count'], hist['min'], hist['max']), (3, 0.1, 3))
+
+        path = join(self.test_output_dir, 'instrument.json')
+        instrument.report(path)
+        self.assertEqual(json.load(open(path))['counters'], {'queries{type=views}': 3})
+
+    def test_parallel_metrics_instrumented(self):
+        "what's recorded parsing periods in other processes is returned to the parent"
+        dt_range_list = utils.dt_range(datetime(2016, 2, 6), datetime(2016, 2, 12))
+        for results_type in ['views', 'downloads']:
+            os.makedirs(join(self.test_output_dir, 'output', results_type))
+            for dt, _ in dt_range_list:
+                path = core.output_path(results_type, dt, dt)
+                shutil.copy(join(self.cached_output_dir, results_type, os.path.basename(path)), path)
+        profile_path = join(self.test_output_dir, 'metrics.pstats')
+        os.environ['GA_PROFILE'] = profile_path
+        try:
+            bulk.metrics_for_range(self.table_id, dt_range_list, True, True, processes=2)
+        finally:
+            del os.environ['GA_PROFILE']
+        self.assertTrue(os.path.exists(profile_path))
+        self.assertEqual(self.counters('cached_results'), len(dt_range_list) * 2)
+        self.assertEqual(self.counters('parse.cache'), len(dt_range_list) * 2)
+        histograms = instrument.snapshot()['histograms']
+        parsed = sum(hist['count'] for k, hist in histograms.items() if k.startswith('parse.parse{') and 'path_counts' in k)
+        self.assertEqual(parsed, len(dt_range_list))
+        self.assertEqual(histograms['metrics_for_range{processes=2}']['count'], 1)
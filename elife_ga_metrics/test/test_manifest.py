@@ -0,0 +1,186 @@
+import os, shutil
+from os.path import join
+from base import BaseCase
+from datetime import datetime
+from elife_ga_metrics import core, bulk, manifest, elife_v2, elife_v3
+
+class TestManifest(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        self.dt = datetime(2016, 2, 24)
+        self.raw_path = core.output_path('views', self.dt, self.dt)
+        os.makedirs(os.path.dirname(self.raw_path))
+        shutil.copy(join(self.cached_output_dir, 'views', '2016-02-24.json'), self.raw_path)
+        self.original_compact_after = manifest.COMPACT_AFTER
+
+    def tearDown(self):
+        manifest.COMPACT_AFTER = self.original_compact_after
+
+    def cache(self, results_type, dt, module=elife_v3):
+        query_map = getattr(module, core.QUERY_FUNCS[results_type])(self.table_id, dt, dt)
+        response = {'query': {'start-date': query_map['start_date'], 'end-date': query_map['end_date'],
+                              'filters': query_map['filters']}, 'rows': [['/foo', '1']]}
+        return core.write_results(response, core.output_path(results_type, dt, dt))
+
+    def test_built_from_output_dir(self):
+        entry = core.cache_manifest().get(self.raw_path)
+        self.assertEqual(entry['type'], 'views')
+        self.assertEqual((entry['from'], entry['to']), ('2016-02-24', '2016-02-24'))
+        self.assertEqual(entry['module'], 'elife_v2')
+        self.assertFalse(entry['partial'])
+        self.assertTrue(entry['rows'] > 0)
+        self.assertEqual(entry['size'], os.path.getsize(self.raw_path))
+
+    def test_written_results_recorded(self):
+        "results written by us are recorded without the output directory being scanned again"
+        core.cache_manifest()
+        scan = manifest.Manifest.scan
+        manifest.Manifest.scan = lambda *args: self.fail("output directory was scanned")
+        try:
+            path = self.cache('downloads', datetime(2016, 6, 1))
+            entry = core.cache_manifest(sync=True).get(path)
+        finally:
+            manifest.Manifest.scan = scan
+        self.assertEqual((entry['type'], entry['rows'], entry['module']), ('downloads', 1, 'elife_v3'))
+
+    def test_reloaded_from_journal(self):
+        "changes survive between processes"
+        path = self.cache('views', datetime(2016, 6, 1))
+        self.assertTrue(os.path.getsize(join(core.output_dir(), manifest.JOURNAL)))
+        self.assertEqual(manifest.Manifest(core.output_dir()).entries, core.cache_manifest().entries)
+        self.assertTrue(manifest.Manifest(core.output_dir()).exists(path))
+
+    def test_journal_compacted(self):
+        manifest.COMPACT_AFTER = 2
+        for day in [1, 2, 3]:
+            self.cache('views', datetime(2016, 6, day))
+        with open(join(core.output_dir(), manifest.JOURNAL), 'r') as fh:
+            self.assertEqual(len(fh.readlines()), 1)
+        self.assertEqual(len(manifest.Manifest(core.output_dir()).entries), 4)
+
+    def test_outside_changes_found(self):
+        "results added or removed without us knowing are found on the next sync"
+        core.cache_manifest()
+        path = core.output_path('views', datetime(2016, 2, 25), datetime(2016, 2, 25))
+        shutil.copy(self.raw_path, path)
+        os.unlink(self.raw_path)
+        cache = core.cache_manifest(sync=True)
+        self.assertFalse(cache.exists(self.raw_path))
+        self.assertTrue(cache.exists(path))
+
+    def test_lookups_trust_the_manifest(self):
+        "whether results are cached is answered without touching the results themselves"
+        cache = core.cache_manifest(sync=True)
+        calls = []
+        stat = os.stat
+        def counted(path):
+            calls.append(path)
+            return stat(path)
+        os.stat = counted
+        try:
+            self.assertTrue(all(cache.exists(self.raw_path) for _ in range(100)))
+        finally:
+            os.stat = stat
+        self.assertEqual(calls, [])
+
+    def test_changes_in_place_found_by_scan(self):
+        "results rewritten in place, leaving their directory looking untouched, are read again when scanned"
+        cache = core.cache_manifest()
+        with open(self.raw_path, 'w') as fh:
+            fh.write('{"query": {}, "rows": [["/foo", "1"]]}')
+        cache.scan('views')
+        self.assertEqual(cache.get(self.raw_path)['rows'], 1)
+        self.assertEqual(manifest.Manifest(core.output_dir()).get(self.raw_path)['rows'], 1)
+
+    def test_other_writers_seen(self):
+        "what other processes record is seen the next time we record something, without the directory being listed"
+        ours, theirs = core.cache_manifest(), manifest.Manifest(core.output_dir())
+        listing = manifest.Manifest.listing
+        manifest.Manifest.listing = lambda *args: self.fail("output directory was listed")
+        try:
+            path = self.cache('views', datetime(2016, 6, 1))
+            theirs.record(self.cache('views', datetime(2016, 6, 2)))
+            self.assertTrue(theirs.exists(path))
+            ours.record(self.cache('views', datetime(2016, 6, 3)))
+        finally:
+            manifest.Manifest.listing = listing
+        self.assertEqual(len(ours.entries), 4)
+        self.assertEqual(manifest.Manifest(core.output_dir()).entries, ours.entries)
+
+    def test_scan_journaled(self):
+        "what a scan finds is journaled and only compacted once the journal is long enough"
+        cache = core.cache_manifest()
+        self.assertFalse(os.path.exists(join(core.output_dir(), manifest.SNAPSHOT)))
+        self.assertTrue(0 < cache.journal_length < manifest.COMPACT_AFTER)
+        self.assertEqual(manifest.Manifest(core.output_dir()).entries, cache.entries)
+
+    def test_compressed_results(self):
+        "compressed results are indexed and read as if they weren't"
+        expected = core.article_views(self.table_id, self.dt, self.dt, cached=True, only_cached=True)
+        entry = core.cache_manifest().get(self.raw_path)
+        core.write_results(core.read_results(self.raw_path), self.raw_path, compress=True)
+        cache = manifest.Manifest(core.output_dir())
+        self.assertEqual(cache.get(self.raw_path)['rows'], entry['rows'])
+        self.assertTrue(cache.get(self.raw_path)['size'] < entry['size'])
+        self.assertEqual(core.article_views(self.table_id, self.dt, self.dt, cached=True, only_cached=True), expected)
+        self.assertEqual(bulk.generate_queries(self.table_id, 'path_counts_query', [(self.dt, self.dt)], use_cached=True), [])
+
+    def test_partial_results(self):
+        dt = datetime(2016, 6, 1)
+        partial_path = core.output_path('views', dt, dt) + '.partial'
+        core.write_results({'query': {'filters': elife_v3.path_counts_query('', dt, dt)['filters']}}, partial_path)
+        cache = core.cache_manifest()
+        self.assertTrue(cache.get(partial_path)['partial'])
+        self.assertEqual([p for p, _, _ in cache.periods('views', partial=True)], [partial_path])
+        self.assertEqual([p for p, _, _ in core.cached_periods('views')], [self.raw_path])
+
+    def test_coverage(self):
+        self.cache('views', datetime(2016, 6, 1), module=elife_v2)
+        coverage = core.cache_manifest().coverage()
+        self.assertEqual(coverage['views']['daily']['count'], 2)
+        self.assertEqual(coverage['views']['daily']['from'], '2016-02-24')
+        self.assertEqual(coverage['views']['daily']['to'], '2016-06-01')
+
+    def test_batched_writes(self):
+        "results written in a batch are recorded together without the output directory being scanned"
+        core.cache_manifest()
+        scan = manifest.Manifest.scan
+        manifest.Manifest.scan = lambda *args: self.fail("output directory was scanned")
+        try:
+            with core.batched_writes(size=3):
+                path_list = [self.cache('views', datetime(2016, 6, day)) for day in range(1, 6)]
+                recorded = [core.cache_manifest().entries.has_key(manifest_key) for manifest_key in
+                            [core.cache_manifest().key(path) for path in path_list]]
+                self.assertEqual(recorded, [True, True, True, False, False])
+            cache = core.cache_manifest(sync=True)
+            self.assertTrue(all(cache.exists(path) for path in path_list))
+        finally:
+            manifest.Manifest.scan = scan
+        self.assertEqual(manifest.Manifest(core.output_dir()).entries, core.cache_manifest().entries)
+
+    def test_unrecorded_writes_found(self):
+        "results written but never recorded, because we crashed part way through a batch, are found next time"
+        with core.batched_writes():
+            path = self.cache('views', datetime(2016, 6, 1))
+            self.assertTrue(manifest.Manifest(core.output_dir()).exists(path))
+
+    def test_write_is_atomic(self):
+        "a write that fails part way leaves the old results in place and nothing else behind"
+        with open(self.raw_path, 'r') as fh:
+            original = fh.read()
+        rename = os.rename
+        def crash(*args):
+            raise OSError("crashed")
+        os.rename = crash
+        try:
+            self.assertRaises(OSError, core.write_results, {'query': {}, 'rows': []}, self.raw_path)
+        finally:
+            os.rename = rename
+        with open(self.raw_path, 'r') as fh:
+            self.assertEqual(fh.read(), original)
+        self.assertEqual(os.listdir(os.path.dirname(self.raw_path)), [os.path.basename(self.raw_path)])
+
+    def test_directories_made(self):
+        path = self.cache('downloads', datetime(2016, 6, 1))
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(os.stat(path).st_mode & 0777, 0644)
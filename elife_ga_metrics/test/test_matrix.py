@@ -0,0 +1,82 @@
+import os, shutil, unittest
+from os.path import join
+from base import BaseCase
+from datetime import datetime
+from collections import Counter, OrderedDict
+from elife_ga_metrics import core, bulk, store, matrix
+
+def views(full, abstract=0, digest=0):
+    return Counter({'full': full, 'abstract': abstract, 'digest': digest})
+
+@unittest.skipIf(matrix.np is None, "numpy not installed")
+class TestMatrix(BaseCase):
+    def setUp(self):
+        # the shape `bulk.metrics_for_range` returns
+        self.results = OrderedDict([
+            (('2016-06-01', '2016-06-01'), {'views': {'10.7554/eLife.00002': views(5, 1), '10.7554/eLife.00001': views(1)},
+                                            'downloads': {'10.7554/eLife.00002': 2}}),
+            (('2016-06-02', '2016-06-02'), {'views': {'10.7554/eLife.00001': views(3, 0, 1)},
+                                            'downloads': {}}),
+            (('2016-06-03', '2016-06-03'), {'views': {'10.7554/eLife.00002': views(1), '10.7554/eLife.00003': views(4)},
+                                            'downloads': {'10.7554/eLife.00003': 1}}),
+        ])
+        self.metrics = matrix.from_metrics(self.results)
+
+    def test_from_metrics(self):
+        self.assertEqual(self.metrics.dois, ['10.7554/eLife.00001', '10.7554/eLife.00002', '10.7554/eLife.00003'])
+        self.assertEqual(self.metrics.views.shape, (3, 3, 3))
+        self.assertEqual(self.metrics.downloads.shape, (3, 3))
+        for period_idx, period in enumerate(self.metrics.periods):
+            for doi, counts in self.results[period]['views'].items():
+                self.assertEqual(list(self.metrics.views[period_idx, self.metrics.doi_idx[doi]]),
+                                 [counts['full'], counts['abstract'], counts['digest']])
+
+    def test_totals(self):
+        views, downloads = self.metrics.totals()
+        self.assertEqual(views.tolist(), [[4, 0, 1], [6, 1, 0], [4, 0, 0]])
+        self.assertEqual(downloads.tolist(), [0, 2, 1])
+        views, downloads = self.metrics.totals(datetime(2016, 6, 2), datetime(2016, 6, 3))
+        self.assertEqual(views.tolist(), [[3, 0, 1], [1, 0, 0], [4, 0, 0]])
+
+    def test_rolling(self):
+        rolled = self.metrics.rolling(2)
+        self.assertEqual(rolled[:, :, 0].tolist(), [[4, 5, 0], [3, 1, 4]])
+        self.assertEqual(self.metrics.rolling(1, 'downloads').tolist(), self.metrics.downloads.tolist())
+        self.assertRaises(AssertionError, self.metrics.rolling, 4)
+
+    def test_top(self):
+        self.assertEqual(self.metrics.top(2), [('10.7554/eLife.00002', 6), ('10.7554/eLife.00001', 4)])
+        self.assertEqual(self.metrics.top(1, 'downloads'), [('10.7554/eLife.00002', 2)])
+        self.assertEqual(self.metrics.top(5, view_type='digest')[0], ('10.7554/eLife.00001', 1))
+        self.assertEqual(self.metrics.top(1, from_date=datetime(2016, 6, 3)), [('10.7554/eLife.00003', 4)])
+
+    def test_article(self):
+        views, downloads = self.metrics.article('10.7554/eLife.00002')
+        self.assertEqual(views[:, 0].tolist(), [5, 0, 1])
+        self.assertEqual(downloads.tolist(), [2, 0, 0])
+
+@unittest.skipIf(matrix.np is None, "numpy not installed")
+class TestLoad(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        self.dt_list = [(datetime(2016, 2, 24), datetime(2016, 2, 24)), (datetime(2016, 2, 25), datetime(2016, 2, 25))]
+        for results_type in ['views', 'downloads']:
+            os.makedirs(join(self.test_output_dir, 'output', results_type))
+        shutil.copy(join(self.cached_output_dir, 'views', '2016-02-24.json'), core.output_path('views', *self.dt_list[0]))
+        shutil.copy(join(self.cached_output_dir, 'downloads', '2016-02-24.json'), core.output_path('downloads', *self.dt_list[0]))
+        shutil.copy(join(self.cached_output_dir, 'views', '2016-02-25.json'), core.output_path('views', *self.dt_list[1]))
+
+    def assertMatches(self, metrics):
+        expected = matrix.from_metrics(bulk.metrics_for_range(self.table_id, self.dt_list, True, True))
+        self.assertTrue(expected.dois)
+        self.assertEqual(metrics.dois, expected.dois)
+        self.assertEqual(metrics.periods, expected.periods)
+        self.assertEqual(metrics.views.tolist(), expected.views.tolist())
+        self.assertEqual(metrics.downloads.tolist(), expected.downloads.tolist())
+
+    def test_load(self):
+        self.assertMatches(matrix.load(self.dt_list))
+
+    def test_load_from_store(self):
+        store.migrate()
+        self.assertMatches(matrix.load(self.dt_list))
@@ -0,0 +1,63 @@
+import os, re, json, shutil, tempfile, time
+from os.path import join
+from base import BaseCase
+from elife_ga_metrics import parsecache, utils, elife_v2, elife_v3
+
+class TestParseCache(BaseCase):
+    def setUp(self):
+        self.test_output_dir = tempfile.mkdtemp()
+        self.path = join(self.test_output_dir, '2016-02-24.json')
+        shutil.copy(join(self.cached_output_dir, 'views', '2016-02-24.json'), self.path)
+        self.original_iter_rows = parsecache.utils.iter_rows
+
+    def tearDown(self):
+        parsecache.utils.iter_rows = self.original_iter_rows
+        shutil.rmtree(self.test_output_dir)
+
+    def fail_to_load(self, *args, **kwargs):
+        raise AssertionError("raw results were parsed again")
+
+    def test_parsed_results_cached(self):
+        "parsed results are written next to the raw results and re-used"
+        expected = elife_v2.path_counts(json.load(open(self.path, 'r'))['rows'])
+        self.assertTrue(expected)
+        self.assertEqual(parsecache.parse(self.path, elife_v2, 'path_counts'), expected)
+        self.assertTrue(os.path.exists(self.path + parsecache.PARSED_SUFFIX))
+        parsecache.utils.iter_rows = self.fail_to_load
+        self.assertEqual(parsecache.parse(self.path, elife_v2, 'path_counts'), expected)
+
+    def test_modified_raw_results_parsed_again(self):
+        parsecache.parse(self.path, elife_v2, 'path_counts')
+        later = time.time() + 10
+        os.utime(self.path, (later, later))
+        parsecache.utils.iter_rows = self.fail_to_load
+        self.assertRaises(AssertionError, parsecache.parse, self.path, elife_v2, 'path_counts')
+
+    def test_different_parser_parses_again(self):
+        parsecache.parse(self.path, elife_v2, 'path_counts')
+        parsecache.utils.iter_rows = self.fail_to_load
+        self.assertRaises(AssertionError, parsecache.parse, self.path, elife_v3, 'path_counts')
+
+    def test_corrupt_parsed_results_ignored(self):
+        expected = parsecache.parse(self.path, elife_v2, 'path_counts')
+        open(self.path + parsecache.PARSED_SUFFIX, 'w').write('garbage')
+        self.assertEqual(parsecache.parse(self.path, elife_v2, 'path_counts'), expected)
+
+    def test_parser_version(self):
+        "only a change to the code parsing results changes the parser version"
+        def version(**patches):
+            originals = dict((name, getattr(module, name)) for name, (module, _) in patches.items())
+            try:
+                for name, (module, value) in patches.items():
+                    setattr(module, name, value)
+                parsecache._VERSIONS.clear()
+                return parsecache.parser_version(elife_v2)
+            finally:
+                for name, (module, _) in patches.items():
+                    setattr(module, name, originals[name])
+                parsecache._VERSIONS.clear()
+        original = version()
+        self.assertNotEqual(version(PATH_RE=(elife_v2, re.compile('/content/'))), original)
+        self.assertNotEqual(version(deplumpen=(utils, lambda artid: artid)), original)
+        self.assertEqual(version(ymd=(utils, lambda dt: dt)), original)
+        self.assertEqual(version(path_counts_query=(elife_v2, lambda *args: {})), original)
@@ -1,5 +1,7 @@
+import os, json
 import base
-from elife_ga_metrics import core
+from datetime import datetime
+from elife_ga_metrics import core, elife_v3
 from apiclient import errors
 
 import logging
@@ -33,3 +35,36 @@ class TestQueryGA(base.BaseCase):
     def test_exponential_backoff_applied_on_rate_limit(self):
         query = DummyQuery(raises=503)
         self.assertRaises(AssertionError, core.query_ga, query, num_attempts=1)
+
+class TestPagination(base.BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        self.original_ga_service = core.ga_service
+        self.service = base.FakeGAService(latency=0, rows=[['/content/5/e%05d' % i, '1'] for i in range(25)])
+        core.ga_service = lambda: self.service
+        dt = datetime(2016, 6, 1)
+        self.query_map = elife_v3.path_counts_query(self.table_id, dt, dt)
+        self.query_map['max_results'] = 10
+
+    def tearDown(self):
+        core.ga_service = self.original_ga_service
+
+    def test_all_pages_fetched(self):
+        "results beyond the first page are fetched and merged"
+        pages = list(core.query_pages(self.query_map))
+        self.assertEqual([len(page['rows']) for page in pages], [10, 10, 5])
+        self.assertEqual(core.merge_pages(pages)['rows'], self.service.rows)
+
+    def test_pages_fetched_concurrently(self):
+        pages = list(core.query_pages(self.query_map, workers=3))
+        self.assertEqual(core.merge_pages(pages)['rows'], self.service.rows)
+        self.assertEqual(self.service.calls, 3)
+
+    def test_merged_results_written(self):
+        response, path = core.query_ga_write_results(self.query_map)
+        self.assertEqual(len(json.load(open(path, 'r'))['rows']), 25)
+
+    def test_truncated_results(self):
+        "an error is raised if the merged rows don't match the total GA reported"
+        self.service.missing = 1
+        self.assertRaises(AssertionError, core.query_ga_write_results, self.query_map)
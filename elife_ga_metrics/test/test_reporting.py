@@ -0,0 +1,104 @@
+import os
+from os.path import join
+from base import BaseCase
+from datetime import datetime
+from elife_ga_metrics import core, bulk, reporting, elife_v3
+
+class FakeBatchGet(object):
+    def __init__(self, service, body):
+        self.service = service
+        self.body = body
+
+    def execute(self):
+        self.service.calls += 1
+        report_list = []
+        for request in self.body['reportRequests']:
+            start_date = request['dateRanges'][0]['startDate']
+            response = self.service.responses[(request['filtersExpression'], start_date)]
+            start, size = int(request.get('pageToken', 0)), request['pageSize']
+            metric_headers = [header for header in response['columnHeaders'] if header['columnType'] == 'METRIC']
+            report = {
+                'columnHeader': {
+                    'dimensions': [header['name'] for header in response['columnHeaders'] if header['columnType'] == 'DIMENSION'],
+                    'metricHeader': {'metricHeaderEntries': [{'name': header['name'], 'type': header['dataType']} for header in metric_headers]},
+                },
+                'data': {
+                    'rows': [{'dimensions': row[:-1], 'metrics': [{'values': row[-1:]}]} for row in response['rows'][start:start + size]],
+                    'rowCount': response['totalResults'],
+                    'totals': [{'values': [response['totalsForAllResults'][header['name']] for header in metric_headers]}],
+                },
+            }
+            if start + size < len(response['rows']):
+                report['nextPageToken'] = str(start + size)
+            report_list.append(report)
+        return {'reports': report_list}
+
+class FakeReportingService(object):
+    "stands in for the object returned by `core.reporting_service`, serving reports from cached v3 responses"
+    def __init__(self, responses):
+        self.responses = responses # ll: {(filters, start date): response}
+        self.calls = 0
+
+    def reports(self):
+        return self
+
+    def batchGet(self, body):
+        return FakeBatchGet(self, body)
+
+class TestReporting(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        self.days = [datetime(2016, 6, 1), datetime(2016, 6, 2)]
+        responses = {}
+        for dt in self.days:
+            for results_type in ['views', 'downloads']:
+                response = core.read_results(self.cached_path(results_type, dt))
+                responses[(response['query']['filters'], core.ymd(dt))] = response
+        self.service = FakeReportingService(responses)
+        self.original_reporting_service = core.reporting_service
+        core.reporting_service = lambda: self.service
+
+    def tearDown(self):
+        core.reporting_service = self.original_reporting_service
+        os.environ.pop('GA_COMBINED_QUERIES', None)
+
+    def cached_path(self, results_type, dt):
+        return join(self.cached_output_dir, results_type, core.ymd(dt) + '.json')
+
+    def test_report_request(self):
+        request = reporting.report_request(elife_v3.path_counts_query(self.table_id, self.days[0], self.days[0]))
+        self.assertEqual(request['viewId'], self.table_id[len('ga:'):])
+        self.assertEqual(request['dateRanges'], [{'startDate': '2016-06-01', 'endDate': '2016-06-01'}])
+        self.assertEqual(request['metrics'], [{'expression': 'ga:pageviews'}])
+        self.assertEqual(request['dimensions'], [{'name': 'ga:pagePath'}])
+        self.assertEqual(request['orderBys'], [{'fieldName': 'ga:pagePath', 'sortOrder': 'ASCENDING'}])
+
+    def test_combined_bulk_query(self):
+        "views and downloads for a period are fetched together and written as if fetched by v3"
+        query_list = [query_map for dt in self.days for query_map in reporting.period_queries(self.table_id, dt, dt)]
+        results = bulk.bulk_query(sorted(query_list, key=lambda query_map: query_map['metrics']), combined=True)
+        self.assertEqual(self.service.calls, 2)
+        self.assertEqual(len(results), 4)
+        for dt in self.days:
+            for results_type in ['views', 'downloads']:
+                path = core.output_path(results_type, dt, dt)
+                self.assertEqual(open(path).read(), open(self.cached_path(results_type, dt)).read())
+
+    def test_pages(self):
+        "reports with more rows than fit on a page have their remaining pages fetched together"
+        query_list = [dict(query_map, max_results=500) for query_map in reporting.period_queries(self.table_id, self.days[0], self.days[0])]
+        views, downloads = reporting.query_ga(query_list)
+        # 1871 views rows, 888 downloads rows
+        self.assertEqual(self.service.calls, 4)
+        self.assertEqual(views['rows'], core.read_results(self.cached_path('views', self.days[0]))['rows'])
+        self.assertEqual(downloads['rows'], core.read_results(self.cached_path('downloads', self.days[0]))['rows'])
+
+    def test_article_metrics(self):
+        dt = self.days[0]
+        os.environ['GA_COMBINED_QUERIES'] = '1'
+        results = core.article_metrics(self.table_id, dt, dt)
+        self.assertEqual(self.service.calls, 1)
+        self.assertEqual(results['views'], elife_v3.path_counts(core.read_results(self.cached_path('views', dt))['rows']))
+        # already cached
+        core.article_metrics(self.table_id, dt, dt, cached=True)
+        self.assertEqual(self.service.calls, 1)
@@ -0,0 +1,112 @@
+import json, calendar
+import httplib2
+from base import BaseCase, FakeClock
+from datetime import datetime
+from apiclient import errors
+from elife_ga_metrics import core, retry
+
+def http_error(status, reason=None, headers=None):
+    content = {'error': {'code': status, 'message': 'dummy error message'}}
+    if reason:
+        content['error']['errors'] = [{'domain': 'usageLimits', 'reason': reason, 'message': 'dummy error message'}]
+    resp = httplib2.Response(dict(headers or {}, status=str(status)))
+    return errors.HttpError(resp, json.dumps(content))
+
+class ScriptedQuery(object):
+    "raises each of the given errors in turn, then succeeds"
+    def __init__(self, *error_list):
+        self.error_list = list(error_list)
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        if self.error_list:
+            raise self.error_list.pop(0)
+        return {'rows': []}
+
+class TestRetry(BaseCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = retry.CircuitBreaker(clock=self.clock.time)
+        self.stats = retry.Stats()
+
+    def policy(self, **kwargs):
+        kwargs.setdefault('rand', lambda: 0.5)
+        return retry.RetryPolicy(breaker=self.breaker, stats=self.stats, sleep=self.clock.sleep, **kwargs)
+
+    def test_classify(self):
+        cases = [
+            (http_error(403, 'userRateLimitExceeded'), retry.RETRY),
+            (http_error(403, 'rateLimitExceeded'), retry.RETRY),
+            (http_error(503, 'backendError'), retry.RETRY),
+            (http_error(503), retry.RETRY),
+            (http_error(429), retry.RETRY),
+            (http_error(403, 'dailyLimitExceeded'), retry.QUOTA),
+            (http_error(403, 'insufficientPermissions'), retry.FATAL),
+            (http_error(403), retry.FATAL),
+            (http_error(400, 'invalidParameter'), retry.FATAL),
+        ]
+        for error, expected in cases:
+            self.assertEqual(retry.classify(error), expected, error)
+
+    def test_full_jitter(self):
+        "waits are anywhere up to the exponentially growing, capped, maximum"
+        self.assertEqual([self.policy(rand=lambda: 1.0, cap=10).delay(n) for n in range(6)], [1, 2, 4, 8, 10, 10])
+        self.assertEqual([self.policy().delay(n) for n in range(3)], [0.5, 1, 2])
+        self.assertEqual(self.policy(rand=lambda: 0.0).delay(3), 0)
+
+    def test_retry_after(self):
+        "GA asking us to wait longer is respected"
+        error = http_error(503, 'backendError', {'retry-after': '30'})
+        self.assertEqual(retry.retry_after(error), 30)
+        self.assertEqual(self.policy().delay(0, error), 30)
+        self.assertEqual(retry.retry_after(http_error(503)), None)
+
+    def test_retried(self):
+        query = ScriptedQuery(http_error(403, 'userRateLimitExceeded'), http_error(503, 'backendError'))
+        self.assertEqual(self.policy().execute(query), {'rows': []})
+        self.assertEqual(query.calls, 3)
+        self.assertEqual(self.clock.slept, 0.5 + 1)
+        summary = self.stats.summary()
+        self.assertEqual(summary['attempts'], 3)
+        self.assertEqual(summary['retry:userRateLimitExceeded'], 1)
+        self.assertEqual(summary['wait_seconds'], 1.5)
+
+    def test_retries_exhausted(self):
+        "no time is wasted waiting after the last attempt"
+        query = ScriptedQuery(*[http_error(503)] * 3)
+        self.assertRaises(AssertionError, self.policy(num_attempts=3).execute, query)
+        self.assertEqual(query.calls, 3)
+        self.assertEqual(self.clock.slept, 0.5 + 1)
+
+    def test_permission_error_not_retried(self):
+        query = ScriptedQuery(http_error(403, 'insufficientPermissions'))
+        self.assertRaises(errors.HttpError, self.policy().execute, query)
+        self.assertEqual(query.calls, 1)
+        self.assertEqual(self.clock.slept, 0)
+
+    def test_daily_quota_stops_everybody(self):
+        "once the daily quota is exhausted, queries sharing the breaker fail without being made"
+        self.assertRaises(retry.QuotaExhausted, self.policy().execute, ScriptedQuery(http_error(403, 'dailyLimitExceeded')))
+        self.assertTrue(self.breaker.is_open())
+        query = ScriptedQuery()
+        self.assertRaises(retry.QuotaExhausted, self.policy().execute, query)
+        self.assertEqual(query.calls, 0)
+        # the quota resets
+        self.clock.sleep(self.breaker.open_until - self.clock.time())
+        self.assertEqual(self.policy().execute(query), {'rows': []})
+
+    def test_next_quota_reset(self):
+        "the daily quota resets at midnight Pacific time"
+        now = calendar.timegm(datetime(2016, 6, 1, 12, 0).utctimetuple())
+        self.assertEqual(retry.next_quota_reset(now) - now, 20 * 60 * 60)
+        now = calendar.timegm(datetime(2016, 6, 1, 7, 0).utctimetuple())
+        self.assertEqual(retry.next_quota_reset(now) - now, 60 * 60)
+
+    def test_query_ga_policy(self):
+        "`core.query_ga` retries with the policy it's given"
+        query = ScriptedQuery(http_error(503))
+        policy = self.policy(num_attempts=2)
+        self.assertEqual(core.query_ga(query, policy=policy), {'rows': []})
+        self.assertEqual(self.stats.summary()['queries'], 1)
+        self.assertRaises(AssertionError, core.query_ga, ScriptedQuery(*[http_error(503)] * 2), policy=policy)
@@ -0,0 +1,111 @@
+import os, shutil
+from os.path import join
+from base import BaseCase
+from collections import Counter
+from datetime import datetime
+from elife_ga_metrics import core, rollup, utils
+
+class TestRollup(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        # ISO week 26 of 2016 ends on the 3rd of July
+        self.days = [datetime(2016, 6, 29), datetime(2016, 6, 30), datetime(2016, 7, 1), datetime(2016, 7, 4)]
+        for dt in self.days:
+            self.cache(dt, dt)
+        self.original_cached_results = core.cached_results
+
+    def tearDown(self):
+        core.cached_results = self.original_cached_results
+
+    def cache(self, from_date, to_date):
+        for results_type in rollup.RESULTS_TYPES:
+            path = core.output_path(results_type, from_date, to_date)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            shutil.copy(join(self.cached_output_dir, results_type, os.path.basename(path)), path)
+
+    def expected(self, results_type, day_list):
+        total = Counter() if results_type == 'downloads' else {}
+        for dt in day_list:
+            results = core.cached_results(results_type, dt, dt, core.module_picker(dt, dt))
+            for doi, val in results.items():
+                if results_type == 'downloads':
+                    total[doi] += val
+                else:
+                    total.setdefault(doi, Counter({'full': 0, 'abstract': 0, 'digest': 0})).update(val)
+        return dict(total)
+
+    def count_parsed(self):
+        "counts the days parsed from now on"
+        parsed = []
+        def cached_results(results_type, from_date, to_date, module):
+            parsed.append((results_type, from_date))
+            return self.original_cached_results(results_type, from_date, to_date, module)
+        core.cached_results = cached_results
+        return parsed
+
+    def test_buckets(self):
+        self.assertEqual(rollup.bucket('weekly', datetime(2016, 7, 3)), '2016-W26')
+        self.assertEqual(rollup.bucket('weekly', datetime(2016, 1, 1)), '2015-W53')
+        self.assertEqual(rollup.bucket_bounds('weekly', '2016-W26'), (datetime(2016, 6, 27), datetime(2016, 7, 3)))
+        self.assertEqual(rollup.bucket_bounds('weekly', '2015-W53'), (datetime(2015, 12, 28), datetime(2016, 1, 3)))
+        self.assertEqual(rollup.bucket_bounds('monthly', '2016-02'), (datetime(2016, 2, 1), datetime(2016, 2, 29)))
+
+    def test_rollups(self):
+        "each day is parsed once and summed into it's week, month, year and the all-time totals"
+        parsed = self.count_parsed()
+        rollup.build()
+        self.assertEqual(len(parsed), len(self.days) * 2)
+        core.cached_results = self.original_cached_results
+        for results_type in rollup.RESULTS_TYPES:
+            self.assertEqual(rollup.buckets(results_type, 'weekly'), ['2016-W26', '2016-W27'])
+            self.assertEqual(rollup.buckets(results_type, 'monthly'), ['2016-06', '2016-07'])
+            self.assertEqual(rollup.read_bucket(results_type, 'monthly', '2016-07')['days'], 2)
+            self.assertEqual(rollup.totals(results_type), self.expected(results_type, self.days))
+
+        weekly = rollup.metrics_between(datetime(2016, 6, 1), datetime(2016, 7, 1), 'weekly')
+        self.assertEqual(weekly.keys(), [('2016-06-27', '2016-07-03')])
+        self.assertEqual(weekly.values()[0]['views'], self.expected('views', self.days[:3]))
+        yearly = rollup.metrics_between(datetime(2016, 1, 1), datetime(2016, 12, 31), 'yearly')
+        self.assertEqual(yearly[('2016-01-01', '2016-12-31')]['downloads'], self.expected('downloads', self.days))
+
+    def test_incremental(self):
+        "only the buckets of days that have changed are summed again"
+        rollup.build()
+        parsed = self.count_parsed()
+        rollup.build()
+        self.assertEqual(parsed, [])
+
+        # a day is added and another removed
+        self.cache(datetime(2016, 7, 2), datetime(2016, 7, 2))
+        os.unlink(core.output_path('views', self.days[0], self.days[0]))
+        rollup.build()
+        # the days of the weeks and months with changes are parsed again, each of them once
+        days = self.days[1:3] + [datetime(2016, 7, 2)] + self.days[3:]
+        self.assertEqual(sorted(parsed), sorted([('downloads', dt) for dt in sorted(self.days + [datetime(2016, 7, 2)])] +
+                                                [('views', dt) for dt in days]))
+        core.cached_results = self.original_cached_results
+        self.assertEqual(rollup.totals('views'), self.expected('views', days))
+        self.assertEqual(rollup.read_bucket('views', 'weekly', '2016-W26')['days'], 3)
+
+    def test_forced(self):
+        rollup.build()
+        for dt in self.days:
+            os.unlink(core.output_path('downloads', dt, dt))
+        rollup.build(['downloads'], force=True)
+        self.assertEqual(rollup.buckets('downloads', 'weekly'), [])
+        self.assertEqual(rollup.totals('downloads'), {})
+
+    def test_reconcile(self):
+        "the monthly rollups are compared with the monthly results from GA"
+        month = utils.month_min_max(datetime(2016, 7, 1))
+        self.cache(*month)
+        rollup.build()
+        report = rollup.reconcile()
+        self.assertEqual([(row['type'], row['month']) for row in report], [('views', '2016-07'), ('downloads', '2016-07')])
+        for row in report:
+            self.assertEqual((row['days'], row['expected_days']), (2, 31))
+            self.assertEqual(row['rollup'], sum(sum(val.values()) if row['type'] == 'views' else val
+                                                for val in self.expected(row['type'], self.days[2:]).values()))
+            self.assertEqual(row['diff'], row['rollup'] - row['ga'])
+            self.assertTrue(row['ga'] > row['rollup'])
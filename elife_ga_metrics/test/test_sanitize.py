@@ -0,0 +1,58 @@
+import os, json, shutil
+from os.path import join
+from base import BaseCase
+from datetime import datetime
+from elife_ga_metrics import core, manifest, sanitize, utils
+
+class TestSanitize(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        self.path_list = []
+        for results_type in ['views', 'downloads']:
+            for dt, _ in utils.dt_range(datetime(2016, 6, 1), datetime(2016, 6, 3)):
+                path = core.output_path(results_type, dt, dt)
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                shutil.copy(join(self.cached_output_dir, results_type, os.path.basename(path)), path)
+                self.path_list.append(path)
+        self.original_chunk_size = sanitize.CHUNK_SIZE
+
+    def tearDown(self):
+        sanitize.CHUNK_SIZE = self.original_chunk_size
+
+    def dirty(self, path):
+        "adds identifiers GA includes in it's responses back into the results, without the manifest knowing"
+        response = core.read_results(path)
+        response['profileInfo'] = {'accountId': '1234'}
+        response['query']['ids'] = 'ga:1234'
+        stat = os.stat(path)
+        with open(path, 'w') as fh:
+            json.dump(response, fh)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+    def test_clean_results_untouched(self):
+        mtimes = [os.stat(path).st_mtime for path in self.path_list]
+        self.assertEqual(sanitize.do(processes=1), {'clean': len(self.path_list)})
+        self.assertEqual([os.stat(path).st_mtime for path in self.path_list], mtimes)
+
+    def test_dirty_results_sanitized(self):
+        sanitize.do(processes=1)
+        self.dirty(self.path_list[0])
+        self.dirty(self.path_list[-1])
+        sanitize.CHUNK_SIZE = 1
+        report = sanitize.do(processes=2)
+        self.assertEqual(report, {'clean': len(self.path_list) - 2, 'sanitized': [self.path_list[0], self.path_list[-1]]})
+        for path in [self.path_list[0], self.path_list[-1]]:
+            self.assertTrue(core.is_sanitized(core.read_results(path)))
+            self.assertTrue(manifest.get_manifest().get(path)['clean'])
+        self.assertEqual(sanitize.do(processes=1), {'clean': len(self.path_list)})
+
+    def test_compress(self):
+        expected = [core.read_results(path) for path in self.path_list]
+        report = sanitize.do(compress=True, processes=1)
+        self.assertEqual(report, {'clean': 0, 'compressed': self.path_list})
+        self.assertTrue(all(core.is_compressed(path) for path in self.path_list))
+        self.assertEqual([core.read_results(path) for path in self.path_list], expected)
+        # results stay compressed unless told otherwise
+        self.assertEqual(sanitize.do(processes=1), {'clean': len(self.path_list)})
+        self.assertEqual(sanitize.do(compress=False, processes=1)['decompressed'], self.path_list)
@@ -0,0 +1,61 @@
+import os, shutil
+from os.path import join
+from base import BaseCase
+from datetime import datetime
+from collections import Counter
+from elife_ga_metrics import core, series, parsecache, elife_v2
+
+class TestSeries(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        self.dt_list = [datetime(2016, 2, 24), datetime(2016, 2, 25)]
+        for dt in self.dt_list:
+            path = core.output_path('views', dt, dt)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            shutil.copy(join(self.cached_output_dir, 'views', '2016-02-24.json'), path)
+        self.expected = parsecache.parse(path, elife_v2, 'path_counts')
+        series.build()
+
+    def test_daily_series(self):
+        doi = sorted(self.expected)[0]
+        expected = [
+            (('2016-02-24', '2016-02-24'), {'views': self.expected[doi]}),
+            (('2016-02-25', '2016-02-25'), {'views': self.expected[doi]}),
+        ]
+        self.assertEqual(series.series(doi, self.dt_list[0], self.dt_list[1]).items(), expected)
+
+    def test_series_within_range(self):
+        doi = sorted(self.expected)[0]
+        self.assertEqual(series.series(doi, self.dt_list[1], self.dt_list[1]).keys(), [('2016-02-25', '2016-02-25')])
+
+    def test_article_without_results(self):
+        "periods we have results for are zeroed for articles that have none"
+        results = series.series('10.7554/eLife.99999', self.dt_list[0], self.dt_list[1])
+        self.assertEqual(results.values(), [{'views': Counter({'full': 0, 'abstract': 0, 'digest': 0})}] * 2)
+
+    def test_no_monthly_results(self):
+        self.assertEqual(series.series('10.7554/eLife.10778', self.dt_list[0], self.dt_list[1], 'monthly'), {})
+
+    def test_index_rebuilt_when_results_change(self):
+        dt = datetime(2016, 2, 26)
+        shutil.copy(core.output_path('views', self.dt_list[0], self.dt_list[0]), core.output_path('views', dt, dt))
+        series.build()
+        self.assertEqual(len(series.series(sorted(self.expected)[0], self.dt_list[0], dt)), 3)
+
+    def test_stale_index_rebuilt_when_read(self):
+        "results fetched since the index was built are seen without building it again by hand"
+        dt = datetime(2016, 2, 26)
+        self.assertEqual(len(series.series(sorted(self.expected)[0], self.dt_list[0], dt)), 2)
+        shutil.copy(core.output_path('views', self.dt_list[0], self.dt_list[0]), core.output_path('views', dt, dt))
+        self.assertEqual(len(series.series(sorted(self.expected)[0], self.dt_list[0], dt)), 3)
+
+    def test_index_swapped_into_place(self):
+        "a rebuilt index replaces the old one in a single step, keeping only the one it replaced"
+        previous = os.path.realpath(series.index_dir())
+        series.build(force=True)
+        series.build(force=True)
+        self.assertTrue(os.path.islink(series.index_dir()))
+        built = sorted(name for name in os.listdir(core.output_dir()) if name.startswith('index-'))
+        self.assertEqual(len(built), 2)
+        self.assertFalse(os.path.basename(previous) in built)
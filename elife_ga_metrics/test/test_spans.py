@@ -0,0 +1,105 @@
+import os
+from os.path import join
+from base import BaseCase
+from datetime import datetime
+from elife_ga_metrics import core, bulk, spans, utils, elife_v3
+
+class FakeSpanQuery(object):
+    def __init__(self, service, query_map):
+        self.service = service
+        self.query_map = query_map
+
+    def execute(self):
+        self.service.calls += 1
+        query_map = self.query_map
+        results_type = 'downloads' if 'ga:eventLabel' in query_map['filters'] else 'views'
+        day_list = [dt for dt, _ in utils.dt_range(spans.parse_date(query_map['start_date']), spans.parse_date(query_map['end_date']))]
+        if not query_map['dimensions'].startswith(spans.DATE_DIMENSION):
+            assert len(day_list) == 1, "only daily queries can be made without the date"
+            return core.read_results(self.service.cached_path(results_type, day_list[0]))
+        rows = []
+        for dt in day_list:
+            response = core.read_results(self.service.cached_path(results_type, dt))
+            rows.extend([dt.strftime("%Y%m%d")] + row for row in response.get('rows', []))
+        start_index, per_page = query_map.get('start_index', 1), query_map['max_results']
+        return {
+            'kind': 'analytics#gaData',
+            'query': {'start-date': query_map['start_date'], 'end-date': query_map['end_date'], 'filters': query_map['filters']},
+            'columnHeaders': [{'name': spans.DATE_DIMENSION, 'columnType': 'DIMENSION', 'dataType': 'STRING'}] + response['columnHeaders'],
+            'containsSampledData': 0 < self.service.sampled_over < len(day_list),
+            'itemsPerPage': per_page,
+            'totalResults': len(rows),
+            'rows': rows[start_index - 1:start_index - 1 + per_page],
+        }
+
+class FakeSpanService(object):
+    "stands in for the object returned by `core.ga_service`, serving spans of days from the cached results"
+    def __init__(self, cached_output_dir, sampled_over=0):
+        self.cached_output_dir = cached_output_dir
+        self.sampled_over = sampled_over # spans of more days than this are sampled
+        self.calls = 0
+
+    def cached_path(self, results_type, dt):
+        return join(self.cached_output_dir, results_type, core.ymd(dt) + '.json')
+
+    def data(self):
+        return self
+
+    def ga(self):
+        return self
+
+    def get(self, **query_map):
+        return FakeSpanQuery(self, query_map)
+
+class TestSpans(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        self.service = FakeSpanService(self.cached_output_dir)
+        self.original_ga_service = core.ga_service
+        core.ga_service = lambda: self.service
+
+    def tearDown(self):
+        core.ga_service = self.original_ga_service
+
+    def daily_queries(self, query_func_name, from_date, to_date):
+        return [getattr(core.module_picker(dt, dt), query_func_name)(self.table_id, dt, dt) for dt, _ in utils.dt_range(from_date, to_date)]
+
+    def assertCached(self, results_type, from_date, to_date):
+        "the results written for each day are the same as those written by a query for that day"
+        for dt, _ in utils.dt_range(from_date, to_date):
+            self.assertEqual(open(core.output_path(results_type, dt, dt)).read(), open(self.service.cached_path(results_type, dt)).read())
+
+    def test_groups_respect_module_boundaries(self):
+        "spans never cross the days `module_picker` switches parsers and aren't longer than asked for"
+        from_date, to_date = datetime(2016, 5, 1), datetime(2016, 5, 9)
+        monthly = elife_v3.path_counts_query(self.table_id, *utils.month_min_max(from_date))
+        query_list = self.daily_queries('path_counts_query', from_date, to_date) + [monthly] + \
+                     self.daily_queries('event_counts_query', from_date, to_date)
+        group_list = spans.group_queries(query_list, 3)
+        self.assertEqual(sum(group_list, []), query_list)
+        self.assertEqual([(group[0]['start_date'], len(group)) for group in group_list], [
+            ('2016-05-01', 3), ('2016-05-04', 2), ('2016-05-06', 3), ('2016-05-09', 1), # views
+            ('2016-05-01', 1), # monthly
+            ('2016-05-01', 3), ('2016-05-04', 2), ('2016-05-06', 3), ('2016-05-09', 1), # downloads
+        ])
+        self.assertEqual(spans.span_query(group_list[0])['dimensions'], 'ga:date,ga:pagePath')
+
+    def test_spanned_bulk_query(self):
+        "a week of daily results are fetched with a single query, paging through the rows"
+        from_date, to_date = datetime(2016, 6, 1), datetime(2016, 6, 9)
+        query_list = self.daily_queries('path_counts_query', from_date, to_date) + \
+                     self.daily_queries('event_counts_query', from_date, to_date)
+        results = bulk.bulk_query(query_list, span_days=7)
+        self.assertEqual(len(results), len(query_list))
+        # two pages for the first week of views and one for the rest. one for each span of downloads
+        self.assertEqual(self.service.calls, 5)
+        self.assertCached('views', from_date, to_date)
+        self.assertCached('downloads', from_date, to_date)
+
+    def test_sampled_spans_split(self):
+        "spans GA samples are fetched again in halves"
+        self.service.sampled_over = 2
+        from_date, to_date = datetime(2016, 6, 1), datetime(2016, 6, 4)
+        spans.query_ga_write_results(self.daily_queries('event_counts_query', from_date, to_date))
+        self.assertEqual(self.service.calls, 3)
+        self.assertCached('downloads', from_date, to_date)
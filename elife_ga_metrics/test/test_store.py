@@ -0,0 +1,67 @@
+import os, json, shutil
+from os.path import join
+from base import BaseCase
+from datetime import datetime
+from elife_ga_metrics import core, store, parsecache, elife_v2
+
+class TestStore(BaseCase):
+    def setUp(self):
+        self.test_output_dir = self.temp_output_dir()
+        self.dt = datetime(2016, 2, 24)
+        self.raw_path = core.output_path('views', self.dt, self.dt)
+        os.makedirs(os.path.dirname(self.raw_path))
+        shutil.copy(join(self.cached_output_dir, 'views', '2016-02-24.json'), self.raw_path)
+        self.expected = parsecache.parse(self.raw_path, elife_v2, 'path_counts')
+        self.original_parse = parsecache.parse
+
+    def tearDown(self):
+        parsecache.parse = self.original_parse
+
+    def fail_to_parse(self, *args):
+        raise AssertionError("results were parsed, not read from the store")
+
+    def test_migrate(self):
+        "raw results are converted to the store and can be read back"
+        self.assertTrue(self.expected)
+        store.migrate()
+        path = store.store_path('views', self.dt)
+        self.assertEqual(path, join(self.test_output_dir, 'output', 'store', 'views', '2016-02.bin'))
+        self.assertEqual(store.read('views', self.dt, self.dt, elife_v2), self.expected)
+
+    def test_article_views_read_through_store(self):
+        store.migrate()
+        parsecache.parse = self.fail_to_parse
+        self.assertEqual(core.article_views(self.table_id, self.dt, self.dt, cached=True), self.expected)
+
+    def test_stale_period_ignored(self):
+        "periods whose raw results have changed since they were stored are not used"
+        store.migrate()
+        with open(self.raw_path, 'r') as fh:
+            core.write_results(json.load(fh), self.raw_path)
+        self.assertEqual(store.read('views', self.dt, self.dt, elife_v2), None)
+        store.migrate()
+        self.assertEqual(store.read('views', self.dt, self.dt, elife_v2), self.expected)
+
+    def test_missing_period(self):
+        store.migrate()
+        dt = datetime(2016, 2, 25)
+        self.assertEqual(store.read('views', dt, dt, elife_v2), None)
+
+    def test_downloads_round_trip(self):
+        results = {'10.7554/eLife.00001': 3, '10.7554/eLife.00002': 70000}
+        path = store.store_path('downloads', self.dt)
+        store.write(path, {'2016-02-24_2016-02-24': ({'parser': 'foo', 'source': None}, list(store.to_rows('downloads', results)))})
+        store_file = store.open_store(path)
+        self.assertEqual(store.from_rows('downloads', store_file.rows('2016-02-24_2016-02-24')), results)
+
+    def test_replaced_file_closed(self):
+        "a store file rewritten since it was opened is unmapped once the new one is opened"
+        path = store.store_path('downloads', self.dt)
+        store.write(path, {'2016-02-24_2016-02-24': ({'parser': 'foo', 'source': None}, [('10.7554/eLife.00001', 0, 3)])})
+        old = store.open_store(path)
+        store.write(path, {'2016-02-24_2016-02-24': ({'parser': 'foo', 'source': None}, [('10.7554/eLife.00001', 0, 4)])})
+        os.utime(path, (0, 0))
+        new = store.open_store(path)
+        self.assertNotEqual(old, new)
+        self.assertRaises(ValueError, lambda: old.buf[:1])
+        self.assertEqual(list(new.rows('2016-02-24_2016-02-24')), [('10.7554/eLife.00001', 0, 4)])
@@ -7,14 +7,7 @@ from elife_ga_metrics import core, bulk, utils
 
 class TestUtils(BaseCase):
     def setUp(self):
-        self.test_output_dir = '/tmp/elife-ga-metrics/'
-        os.system('mkdir ' + self.test_output_dir)
-        os.environ['TESTING'] = "1"
-        os.environ['TEST_OUTPUT_DIR'] = self.test_output_dir
-        
-    def tearDown(self):
-        os.system('rm -rf ' + self.test_output_dir)
-        pass
+        self.test_output_dir = self.temp_output_dir()
 
     def test_ymd(self):
         dt = datetime(year=1997, month=8, day=29, hour=6, minute=14) # UTC ;)
@@ -114,3 +107,49 @@ class TestUtils(BaseCase):
         for key in core.SANITISE_THESE:
             self.assertTrue(not response.has_key(key))
 
+
+    def test_iter_rows(self):
+        "rows are streamed from cached results exactly as they would be loaded"
+        path = join(self.fixture_dir, 'views-2016-02-24.json')
+        expected = json.load(open(path, 'r'))['rows']
+        self.assertTrue(expected)
+        self.assertEqual(list(utils.iter_rows(path)), expected)
+        # rows split across many reads
+        self.assertEqual(list(utils.iter_rows(path, chunk_size=7)), expected)
+
+    def test_iter_rows_no_rows(self):
+        "GA leaves out the rows entirely when there are no results"
+        path = join(self.test_output_dir, 'foo.json')
+        json.dump({'query': {'filters': 'rows'}, 'totalResults': 0}, open(path, 'w'), indent=4, sort_keys=True)
+        self.assertEqual(list(utils.iter_rows(path, chunk_size=7)), [])
+
+    def test_compressed_results(self):
+        "compressed results are read exactly as they would be uncompressed"
+        fixture = join(self.fixture_dir, 'views-2016-02-24.json')
+        expected = json.load(open(fixture, 'r'))
+        path = core.write_results(expected, join(self.test_output_dir, 'foo.json'), compress=True)
+        self.assertEqual(open(path, 'rb').read(2), utils.GZIP_MAGIC)
+        self.assertTrue(os.path.getsize(path) < os.path.getsize(fixture) / 5)
+        self.assertEqual(core.read_results(path), expected)
+        self.assertEqual(core.cached_query(path), expected['query'])
+        self.assertEqual(list(utils.iter_rows(path, chunk_size=7)), expected['rows'])
+        # the same results are always written the same way
+        content = open(path, 'rb').read()
+        core.write_results(expected, path, compress=True)
+        self.assertEqual(open(path, 'rb').read(), content)
+
+    def test_compress_results_setting(self):
+        os.environ['GA_COMPRESS_RESULTS'] = '1'
+        try:
+            path = core.write_results({'query': {}}, join(self.test_output_dir, 'foo.json'))
+        finally:
+            del os.environ['GA_COMPRESS_RESULTS']
+        self.assertEqual(open(path, 'rb').read(2), utils.GZIP_MAGIC)
+        path = core.write_results({'query': {}}, path)
+        self.assertEqual(json.load(open(path, 'r')), {'query': {}})
+
+    def test_iter_rows_truncated(self):
+        path = join(self.test_output_dir, 'foo.json')
+        data = open(join(self.fixture_dir, 'views-2016-02-24.json'), 'r').read()
+        open(path, 'w').write(data[:data.index('"totalResults"') - 50])
+        self.assertRaises(ValueError, list, utils.iter_rows(path))
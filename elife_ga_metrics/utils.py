@@ -1,4 +1,4 @@
-import calendar, collections, functools
+import calendar, collections, functools, gzip, json, re
 from datetime import datetime, date, timedelta
 import logging
 
@@ -56,6 +56,61 @@ def dt_month_range_gen(from_date, to_date):
 def dt_month_range(from_date, to_date):
     return list(dt_month_range_gen(from_date, to_date))
 
+def chunks(x, n):
+    "splits the given list into lists of at most `n` items"
+    return [x[i:i + n] for i in range(0, len(x), n)]
+
+# the first two bytes of every gzip file
+GZIP_MAGIC = '\x1f\x8b'
+
+def open_results(path):
+    """opens the raw results at the given path for reading, decompressing
+    them as they're read if they were written compressed"""
+    with open(path, 'rb') as fh:
+        compressed = fh.read(2) == GZIP_MAGIC
+    return gzip.open(path, 'rb') if compressed else open(path, 'r')
+
+ROWS_RE = re.compile(r'"rows"\s*:\s*\[')
+WHITESPACE = ' \t\n\r,'
+
+def iter_rows(path, chunk_size=65536):
+    """yields each row of the GA response at the given path without reading
+    the whole response into memory. yields nothing if the response has no rows.
+    ll: [u'/content/5/e10719v1', u'12'], [u'/content/5/e10719v1/abstract', u'3'], ..."""
+    decoder = json.JSONDecoder()
+    with open_results(path) as fh:
+        # find the start of the rows, keeping only enough of what came before to match across chunks
+        buf = ''
+        while True:
+            chunk = fh.read(chunk_size)
+            buf += chunk
+            match = ROWS_RE.search(buf)
+            if match:
+                buf = buf[match.end():]
+                break
+            if not chunk:
+                return
+            buf = buf[-32:]
+
+        # decode one row at a time, reading more of the file whenever a row is incomplete
+        idx = 0
+        while True:
+            while idx < len(buf) and buf[idx] in WHITESPACE:
+                idx += 1
+            if idx < len(buf) and buf[idx] == ']':
+                return
+            try:
+                row, end = decoder.raw_decode(buf, idx)
+            except ValueError:
+                chunk = fh.read(chunk_size)
+                if not chunk:
+                    raise ValueError("unexpected end of rows in %r" % path)
+                buf = buf[idx:] + chunk
+                idx = 0
+                continue
+            idx = end
+            yield row
+
 def firstof(fn, x):
     for i in x:
         if fn(i):
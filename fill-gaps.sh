@@ -0,0 +1,11 @@
+#!/bin/bash
+# Fetches only the views and downloads we don't have yet,
+# refreshing any still in progress or recent enough for GA to still revise.
+# Use `regenerate-results.sh` when the query or table changes.
+set -e
+source install.sh &> /dev/null
+if [ -f .env ]; then
+    set -a # all vars are exported
+    source .env
+fi
+python -c "import os; from elife_ga_metrics import bulk; bulk.fill_gaps(os.environ['GA_TABLE']);"
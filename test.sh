@@ -3,3 +3,4 @@ set -e
 source install.sh &> /dev/null
 source .lint.sh
 source .test.sh
+source .benchmark.sh